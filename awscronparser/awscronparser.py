@@ -6,7 +6,6 @@ https://docs.aws.amazon.com/AmazonCloudWatch/latest/events/ScheduledEvents.html#
 From the doc:
     "Cron expressions have six required fields, which are separated by white space."
 
-TODO Validate cron expression
 TODO Docstring
 
 Minutes parser - done
@@ -33,9 +32,29 @@ for Sun - calendarday  - 5
 
 """
 
+import array
+import bisect
+import collections
 import datetime
 import calendar
-import time
+import itertools
+import json
+import mmap
+import os
+import re
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only required for next_runs_batch and matches_many
+    np = None
+
+try:
+    import zoneinfo
+except ImportError:
+    # zoneinfo (Python 3.9+) is only required for schedules in a time zone
+    zoneinfo = None
 
 FIELDS = ['Minutes', 'Hours', 'DoM', 'Month', 'DoW', 'Year']
 VALUES = [[list(range(60)), ',', '-', '*', '/'], [list(range(24)), ',', '-', '*', '/'], [list(range(1, 32)), ',', '-', '*', '?', '/', 'L', 'W'], [dict(zip(range(1, 13), ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC'])), ',', '-', '*', '/'], [dict(zip(range(1-8), ['SUN', 'MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT'])), ',', '-', '*', '?', 'L', '#'], list(range(1970, 2200))]
@@ -46,23 +65,1444 @@ DAYS = ['SUN', 'MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT']
 DAYS_NUMBER = dict(zip(DAYS, range(1, 8)))
 
 
+# Lowest and highest value allowed in each of the fields. A field is compiled into an integer
+# bitmask where bit (value - lowest) is set for every value the field matches
+FIELD_BOUNDS = {'Minutes': (0, 59), 'Hours': (0, 23), 'DoM': (1, 31), 'Month': (1, 12), 'DoW': (1, 7), 'Year': (1970, 2199)}
+FIELD_NAMES = {'Month': MONTHS_NUMBER, 'DoW': DAYS_NUMBER}
+
+# _WEEKDAY_STRIDE[n] has the bits set for the days n+1, n+8, n+15, ... of a month i.e. every
+# day that falls on the same weekday as the (n+1)th day
+_WEEKDAY_STRIDE = [sum(1 << d for d in range(n, 31, 7)) for n in range(7)]
+
+
+class LRUCache():
+    """ Bounded least recently used cache that counts its hits and misses"""
+
+    def __init__(self, maxsize=4096):
+        """ Arguments:
+        maxsize - Maximum number of entries kept in the cache
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """ Returns the cached value for the key (marking it as recently used) or default"""
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """ Adds the value to the cache, evicting the least recently used entry when full"""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        """ Removes all the entries and resets the counters"""
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """ Returns a dict with the hits, misses, current size and maximum size of the cache"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+# Resolved days of a month keyed by (day fields of a compiled schedule, year, month). Schedules
+# with the same DoM/DoW fields share their entries
+DAYS_CACHE = LRUCache(maxsize=4096)
+# Compiled schedules keyed by the normalised expression, and the interned schedules keyed by their
+# fields so that equivalent expressions (e.g. MON and 2, */1 and *) share one CronSchedule
+EXPRESSION_CACHE = LRUCache(maxsize=16384)
+SCHEDULE_CACHE = LRUCache(maxsize=16384)
+_MISSING = object()
+
+# Instrumentation counters, None while instrumentation is off so that the hot paths only pay for
+# an is None check. See enable_stats
+_STATS = None
+STAT_NAMES = ('compile_calls', 'compiles', 'calendar_lookups', 'next_fire', 'prev_fire', 'candidates', 'rejected')
+
+
+def enable_stats(enabled=True):
+    """ Turns the instrumentation counters on or off (off by default)
+
+    The counters are:
+    compile_calls - Calls of CronParser.compile
+    compiles - Expressions actually parsed (compile_schedule)
+    calendar_lookups - Months whose days were resolved from the calendar (DAYS_CACHE misses)
+    next_fire, prev_fire - Searches for the next/previous run of a CronSchedule
+    candidates - Steps of those searches, each a candidate (year, month, day, hour) examined
+    rejected - Candidates that didn't match and carried into the next value of a higher field
+    """
+    global _STATS
+    if not enabled:
+        _STATS = None
+    elif _STATS is None:
+        _STATS = collections.Counter()
+
+
+def stats():
+    """ Returns a snapshot of the instrumentation counters and the cache statistics
+
+    Return:
+    A dict with enabled (True or False), the counters (see enable_stats, 0 while off) and
+    caches, a dict of the info of every cache
+    """
+    counters = _STATS or {}
+    snapshot = dict((name, counters.get(name, 0)) for name in STAT_NAMES)
+    snapshot['enabled'] = _STATS is not None
+    snapshot['caches'] = {
+        'days': DAYS_CACHE.info(),
+        'expressions': EXPRESSION_CACHE.info(),
+        'schedules': SCHEDULE_CACHE.info()}
+    return snapshot
+
+
+def reset_stats():
+    """ Zeroes the instrumentation counters and the cache hits and misses (keeping the entries)"""
+    if _STATS is not None:
+        _STATS.clear()
+    for cache in (DAYS_CACHE, EXPRESSION_CACHE, SCHEDULE_CACHE):
+        cache.hits = 0
+        cache.misses = 0
+
+
+def _mask_values(mask, offset=0):
+    """ Returns a sorted list of the values whose bits are set in the mask
+
+    Arguments:
+    mask - An integer bitmask
+    offset - Value represented by the lowest bit
+
+    Return:
+    A list of integers
+    """
+    values = []
+    while mask:
+        lowest = mask & -mask
+        values.append(lowest.bit_length() - 1 + offset)
+        mask ^= lowest
+    return values
+
+
+def _popcount(mask):
+    """ Returns the number of bits set in the mask"""
+    return bin(mask).count('1')
+
+
+def _iter_mask(mask, offset=0, start=None):
+    """ Lazily yields the values whose bits are set in the mask in ascending order
+
+    Arguments:
+    mask - An integer bitmask
+    offset - Value represented by the lowest bit
+    start - Smallest value to yield, defaults to offset
+
+    Return:
+    A generator of integers
+    """
+    if start is not None and start > offset:
+        mask = (mask >> (start - offset)) << (start - offset)
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1 + offset
+        mask ^= lowest
+
+
+def _next_value(mask, offset, start):
+    """ Returns the smallest value >= start whose bit is set in the mask, None if there is none"""
+    shift = start - offset
+    if shift > 0:
+        mask >>= shift
+    else:
+        shift = 0
+    if not mask:
+        return None
+    return (mask & -mask).bit_length() - 1 + shift + offset
+
+
+def _prev_value(mask, offset, end):
+    """ Returns the largest value <= end whose bit is set in the mask, None if there is none"""
+    if end < offset:
+        return None
+    mask &= (1 << (end - offset + 1)) - 1
+    if not mask:
+        return None
+    return mask.bit_length() - 1 + offset
+
+
+def _missed_runs(schedule, since, until, executed, tolerance):
+    """ Merges the expected runs of a schedule in [since, until) with the times it actually ran,
+    see CronSchedule.missed_runs"""
+    executed = iter(sorted(_utc_naive(value) for value in executed))
+    done = next(executed, None)
+    missed = []
+    runs = schedule.iter_runs(since)
+    run = next(runs, None)
+    until = _utc_naive(until)
+    while run is not None and run < until:
+        following = next(runs, None)
+        # Executions before the run belong to an earlier run (or to none)
+        while done is not None and done < run:
+            done = next(executed, None)
+        if done is not None and done < run + tolerance and (following is None or done < following):
+            done = next(executed, None)
+        else:
+            missed.append(run)
+        run = following
+    return missed
+
+
+def _ceil_minute(value):
+    """ Rounds a datetime up to the next whole minute"""
+    if value.second or value.microsecond:
+        return value.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+    return value
+
+
+def _build_calendar_table(first_year, last_year):
+    """ Builds the calendar table for the given (inclusive) range of years
+
+    Return:
+    A tuple of two arrays indexed by (year - first_year) * 12 + (month - 1), holding the weekday
+    of the first day of the month (SUN - 0, MON - 1, ..., SAT - 6) and the number of days in
+    the month
+    """
+    first_weekday = array.array('B')
+    month_days = array.array('B')
+    # calendar module weekdays start with MON - 0
+    weekday = (calendar.weekday(first_year, 1, 1) + 1) % 7
+    for year in range(first_year, last_year + 1):
+        leap = year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+        for days in (31, 29 if leap else 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31):
+            first_weekday.append(weekday)
+            month_days.append(days)
+            weekday = (weekday + days) % 7
+    return (first_weekday, month_days)
+
+
+# Weekday of the 1st and number of days of every month in the years allowed by the Year field
+_FIRST_WEEKDAY, _MONTH_DAYS = _build_calendar_table(*FIELD_BOUNDS['Year'])
+
+
+def _month_info(year, month):
+    """ Returns a tuple of the weekday of the first day of the month (SUN - 0, MON - 1, ..., SAT - 6)
+    and the number of days in the month"""
+    index = (year - FIELD_BOUNDS['Year'][0]) * 12 + month - 1
+    if 0 <= index < len(_MONTH_DAYS):
+        return (_FIRST_WEEKDAY[index], _MONTH_DAYS[index])
+    # Outside the years supported by AWS
+    weekday, days = calendar.monthrange(year, month)
+    return ((weekday + 1) % 7, days)
+
+
+def _canonical_field(field, mask):
+    """ Renders a field mask as the shortest list of values and ranges e.g. 1,3-5 or *"""
+    low, high = FIELD_BOUNDS[field]
+    if mask == (1 << (high - low + 1)) - 1:
+        return '*'
+    values = _mask_values(mask, low)
+    terms = []
+    first = 0
+    while first < len(values):
+        last = first
+        while last + 1 < len(values) and values[last + 1] == values[last] + 1:
+            last += 1
+        if last - first >= 2:
+            terms.append('{0}-{1}'.format(values[first], values[last]))
+        else:
+            terms.extend(str(value) for value in values[first:last + 1])
+        first = last + 1
+    return ','.join(terms)
+
+
+class CronSchedule():
+    """ Compiled form of a cron expression
+
+    Every field is stored as an integer bitmask (bit 0 is the lowest value of the field) so that
+    the expression is parsed only once and all the later queries are a few integer operations:
+
+    minutes - 60 bits (0-59)
+    hours - 24 bits (0-23)
+    dom - 31 bits (1-31), 0 when the field is '?'
+    months - 12 bits (1-12)
+    dow - 7 bits (SUN - bit 0, ..., SAT - bit 6), 0 when the field is '?'
+    years - 230 bits (1970-2199)
+
+    The special Day-of-month and Day-of-week values are kept next to the masks:
+
+    dom_last - True for L (last day of the month)
+    dom_weekday - n for nW (weekday nearest to the nth day of the month), else 0
+    dow_nth - k for n#k (kth weekday n of the month), else 0
+    dow_last - True for nL (last weekday n of the month)
+
+    Compiled schedules are immutable, and two schedules are equal when they run at exactly the
+    same times, however their expressions were written. Times are naive UTC datetimes, aware
+    datetimes are converted to UTC
+    """
+
+    __slots__ = ('minutes', 'hours', 'dom', 'months', 'dow', 'years', 'dom_last', 'dom_weekday', 'dow_nth', 'dow_last', '_day_key', '_key')
+
+    def __init__(self, minutes, hours, dom, months, dow, years, dom_last=False, dom_weekday=0, dow_nth=0, dow_last=False):
+        day_key = (dom, dom_last, dom_weekday, dow, dow_nth, dow_last)
+        object.__setattr__(self, 'minutes', minutes)
+        object.__setattr__(self, 'hours', hours)
+        object.__setattr__(self, 'dom', dom)
+        object.__setattr__(self, 'months', months)
+        object.__setattr__(self, 'dow', dow)
+        object.__setattr__(self, 'years', years)
+        object.__setattr__(self, 'dom_last', dom_last)
+        object.__setattr__(self, 'dom_weekday', dom_weekday)
+        object.__setattr__(self, 'dow_nth', dow_nth)
+        object.__setattr__(self, 'dow_last', dow_last)
+        object.__setattr__(self, '_day_key', day_key)
+        object.__setattr__(self, '_key', (minutes, hours, months, years, day_key))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CronSchedule is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("CronSchedule is immutable")
+
+    def __reduce__(self):
+        # pickle and copy can't set the fields of an immutable object, rebuild it from its record
+        return (CronSchedule.from_bytes, (self.to_bytes(),))
+
+    def __eq__(self, other):
+        return isinstance(other, CronSchedule) and self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        return "CronSchedule('{0}')".format(self.expression)
+
+    def to_bytes(self):
+        """ Returns the schedule packed into a fixed width record of RECORD_SIZE bytes"""
+        flags = bool(self.dom_last) | bool(self.dow_last) << 1
+        years = self.years.to_bytes(29, 'little')
+        return _RECORD.pack(self.minutes, self.hours, self.dom, self.months, self.dow, flags, self.dom_weekday, self.dow_nth, years)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Returns the schedule packed by to_bytes
+
+        Raises ValueError if data is not a record
+        """
+        if len(data) != RECORD_SIZE:
+            raise ValueError("Schedule record must be {0} bytes and not {1}".format(RECORD_SIZE, len(data)))
+        minutes, hours, dom, months, dow, flags, dom_weekday, dow_nth, years = _RECORD.unpack(data)
+        return cls(minutes, hours, dom, months, dow, int.from_bytes(years, 'little'), bool(flags & 1), dom_weekday, dow_nth, bool(flags & 2))
+
+    @property
+    def expression(self):
+        """ Returns the canonical expression of the schedule e.g. 0 8 ? * 2-6 * for 0 8 ? * MON-FRI *"""
+        if self.day_field == 'DoM':
+            if self.dom_last:
+                dom = 'L'
+            elif self.dom_weekday:
+                dom = '{0}W'.format(self.dom_weekday)
+            else:
+                dom = _canonical_field('DoM', self.dom)
+            dow = '?'
+        else:
+            dom = '?'
+            weekday = (self.dow & -self.dow).bit_length()
+            if self.dow_nth:
+                dow = '{0}#{1}'.format(weekday, self.dow_nth)
+            elif self.dow_last:
+                dow = '{0}L'.format(weekday)
+            else:
+                dow = _canonical_field('DoW', self.dow)
+        return ' '.join([
+            _canonical_field('Minutes', self.minutes),
+            _canonical_field('Hours', self.hours),
+            dom,
+            _canonical_field('Month', self.months),
+            dow,
+            _canonical_field('Year', self.years)])
+
+    @property
+    def day_field(self):
+        """ Returns the field (DoM or DoW) that decides the days on which the cron runs"""
+        if self.dom or self.dom_last or self.dom_weekday:
+            return 'DoM'
+        return 'DoW'
+
+    def days_mask(self, year, month):
+        """ Returns the days of the given month on which the cron runs
+
+        Arguments:
+        year - Year as an integer
+        month - Month as an integer (1-12)
+
+        Return:
+        An integer bitmask with bit (day - 1) set for each matching day
+        """
+        key = (self._day_key, year, month)
+        mask = DAYS_CACHE.get(key, _MISSING)
+        if mask is _MISSING:
+            if _STATS is not None:
+                _STATS['calendar_lookups'] += 1
+            mask = self._resolve_days(year, month)
+            DAYS_CACHE.put(key, mask)
+        return mask
+
+    def _resolve_days(self, year, month):
+        """ Computes the days_mask of the given month from the calendar"""
+        first, days = _month_info(year, month)
+        if self.day_field == 'DoM':
+            mask = self.dom & ((1 << days) - 1)
+            if self.dom_last:
+                mask |= 1 << (days - 1)
+            if self.dom_weekday and self.dom_weekday <= days:
+                day = self.dom_weekday
+                weekday = (first + day - 1) % 7
+                if weekday == 6:
+                    # Saturday - the day before or the Monday after if the 1st is a Saturday
+                    day = day - 1 if day > 1 else day + 2
+                elif weekday == 0:
+                    # Sunday - the day after or the Friday before if it is the last day of the month
+                    day = day + 1 if day < days else day - 2
+                mask |= 1 << (day - 1)
+            return mask
+
+        weekdays = _mask_values(self.dow)
+        if self.dow_nth:
+            day = (weekdays[0] - first) % 7 + 7 * (self.dow_nth - 1) + 1
+            return 1 << (day - 1) if day <= days else 0
+        if self.dow_last:
+            last_weekday = (first + days - 1) % 7
+            return 1 << (days - 1 - (last_weekday - weekdays[0]) % 7)
+        mask = 0
+        for weekday in weekdays:
+            mask |= _WEEKDAY_STRIDE[(weekday - first) % 7]
+        return mask & ((1 << days) - 1)
+
+    def count_runs(self, start, end):
+        """ Returns the number of runs of the cron in [start, end) without enumerating them
+
+        Every full day contributes (hours x minutes) runs, so only the matching days are counted,
+        one popcount of the cached day mask per month. The first and the last day are counted
+        from the start and up to the end time
+
+        Arguments:
+        start - datetime (UTC), inclusive
+        end - datetime (UTC), exclusive
+
+        Return:
+        An integer
+        """
+        start = _ceil_minute(_utc_naive(start))
+        end = _ceil_minute(_utc_naive(end))
+        if start >= end:
+            return 0
+        start_minute = start.hour * 60 + start.minute
+        end_minute = end.hour * 60 + end.minute
+        first_day = start.date()
+        last_day = end.date()
+        if first_day == last_day:
+            if not self._runs_on(first_day):
+                return 0
+            return self._runs_from(start_minute) - self._runs_from(end_minute)
+
+        total = self._runs_from(start_minute) if self._runs_on(first_day) else 0
+        if self._runs_on(last_day):
+            total += self._runs_from(0) - self._runs_from(end_minute)
+        days = self._count_days(first_day + datetime.timedelta(days=1), last_day - datetime.timedelta(days=1))
+        return total + days * self._runs_from(0)
+
+    def _runs_on(self, day):
+        """ Checks if the cron runs on the given date (or datetime)"""
+        shift = day.year - FIELD_BOUNDS['Year'][0]
+        return bool(
+            0 <= shift < 230
+            and (self.years >> shift) & 1
+            and (self.months >> (day.month - 1)) & 1
+            and (self.days_mask(day.year, day.month) >> (day.day - 1)) & 1)
+
+    def _runs_from(self, minute):
+        """ Returns the number of runs in a day at or after the given minute of the day (0-1440)"""
+        hour, minute = divmod(minute, 60)
+        return _popcount(self.hours >> (hour + 1)) * _popcount(self.minutes) + ((self.hours >> hour) & 1) * _popcount(self.minutes >> minute)
+
+    def _count_days(self, first, last):
+        """ Returns the number of days in [first, last] (dates, inclusive) on which the cron runs"""
+        year_low = FIELD_BOUNDS['Year'][0]
+        total = 0
+        year, month = first.year, first.month
+        while (year, month) <= (last.year, last.month):
+            next_year = _next_value(self.years, year_low, year)
+            if next_year is None:
+                break
+            if next_year != year:
+                year, month = next_year, 1
+                continue
+            next_month = _next_value(self.months, 1, month)
+            if next_month is None:
+                year, month = year + 1, 1
+                continue
+            if next_month != month:
+                month = next_month
+                continue
+            mask = self.days_mask(year, month)
+            if (year, month) == (first.year, first.month):
+                mask &= ~((1 << (first.day - 1)) - 1)
+            if (year, month) == (last.year, last.month):
+                mask &= (1 << last.day) - 1
+            total += _popcount(mask)
+            year, month = year + month // 12, month % 12 + 1
+        return total
+
+    def matches(self, value):
+        """ Checks if the cron runs at the given time. Seconds and microseconds are ignored
+
+        Arguments:
+        value - datetime (UTC)
+
+        Return:
+        True if the cron runs in that minute, else False
+        """
+        value = _utc_naive(value)
+        return bool((self.minutes >> value.minute) & 1 and (self.hours >> value.hour) & 1 and self._runs_on(value))
+
+    def matches_many(self, timestamps):
+        """ Vectorised matches over an array of timestamps
+
+        Arguments:
+        timestamps - NumPy datetime64 array (or anything numpy.asarray converts to one), UTC
+
+        Return:
+        A NumPy boolean array of the same shape, NaT never matches
+
+        Raises ImportError if numpy is not installed
+        """
+        if np is None:
+            raise ImportError("numpy is required for matches_many")
+        timestamps = np.asarray(timestamps, dtype='datetime64[m]')
+        minutes = timestamps.astype(np.int64)
+        months = timestamps.astype('datetime64[M]').astype(np.int64)
+        days = (timestamps.astype('datetime64[D]') - timestamps.astype('datetime64[M]')).astype(np.int64)
+        in_range = ~np.isnat(timestamps) & (months >= 0) & (months < 230 * 12)
+        months = np.where(in_range, months, 0)
+
+        matched = _unpack_masks([self.minutes], 60)[0][minutes % 60]
+        matched &= _unpack_masks([self.hours], 24)[0][(minutes // 60) % 24]
+        # Year, month and day are checked together with a table of day masks for the months
+        # spanned by the timestamps (at most 2760)
+        first = int(months.min()) if months.size else 0
+        month_masks = np.zeros(int(months.max()) - first + 1 if months.size else 0, dtype=np.uint64)
+        for position in range(len(month_masks)):
+            year, month = divmod(first + position, 12)
+            if (self.years >> year) & 1 and (self.months >> month) & 1:
+                month_masks[position] = self.days_mask(year + FIELD_BOUNDS['Year'][0], month + 1)
+        day_bits = (month_masks[months - first] >> days.astype(np.uint64)) & np.uint64(1)
+        return matched & day_bits.astype(bool) & in_range
+
+    def next_fire(self, after=None):
+        """ Returns the first run time of the cron strictly after the given time
+
+        Each field jumps straight to its next allowed value and carries into the higher field
+        (minute -> hour -> day -> month -> year) when it overflows, so no candidate times are
+        enumerated
+
+        Arguments:
+        after - datetime (UTC), defaults to now
+
+        Return:
+        datetime object, None if the cron doesn't run again before the end of 2199
+        """
+        after = _utc_naive(after) if after is not None else datetime.datetime.utcnow()
+        if _STATS is not None:
+            _STATS['next_fire'] += 1
+        # minute + 1 may be 60, which simply carries into the next hour
+        return self._first_run(after.year, after.month, after.day, after.hour, after.minute + 1)
+
+    def _first_run(self, year, month, day, hour, minute):
+        """ Returns the first run time at or after the given date and time, None if there is none"""
+        year_low = FIELD_BOUNDS['Year'][0]
+        stats = _STATS
+        while True:
+            if stats is not None:
+                stats['candidates'] += 1
+            next_year = _next_value(self.years, year_low, year)
+            if next_year is None:
+                return None
+            if next_year != year:
+                year, month, day, hour, minute = next_year, 1, 1, 0, 0
+
+            next_month = _next_value(self.months, 1, month)
+            if next_month is None:
+                year, month, day, hour, minute = year + 1, 1, 1, 0, 0
+                if stats is not None:
+                    stats['rejected'] += 1
+                continue
+            if next_month != month:
+                month, day, hour, minute = next_month, 1, 0, 0
+
+            next_day = _next_value(self.days_mask(year, month), 1, day)
+            if next_day is None:
+                month, day, hour, minute = month + 1, 1, 0, 0
+                if stats is not None:
+                    stats['rejected'] += 1
+                continue
+            if next_day != day:
+                day, hour, minute = next_day, 0, 0
+
+            next_hour = _next_value(self.hours, 0, hour)
+            if next_hour is None:
+                day, hour, minute = day + 1, 0, 0
+                if stats is not None:
+                    stats['rejected'] += 1
+                continue
+            if next_hour != hour:
+                hour, minute = next_hour, 0
+
+            next_minute = _next_value(self.minutes, 0, minute)
+            if next_minute is None:
+                hour, minute = hour + 1, 0
+                if stats is not None:
+                    stats['rejected'] += 1
+                continue
+            return datetime.datetime(year, month, day, hour, next_minute)
+
+    def prev_fire(self, before=None):
+        """ Returns the last run time of the cron strictly before the given time
+
+        Mirror image of next_fire: each field jumps straight to its previous allowed value and
+        borrows from the higher field when it underflows
+
+        Arguments:
+        before - datetime (UTC), defaults to now
+
+        Return:
+        datetime object, None if the cron didn't run before (since 1970)
+        """
+        before = _ceil_minute(_utc_naive(before) if before is not None else datetime.datetime.utcnow())
+        if _STATS is not None:
+            _STATS['prev_fire'] += 1
+        # minute - 1 may be -1, which simply borrows from the previous hour
+        return self._last_run(before.year, before.month, before.day, before.hour, before.minute - 1)
+
+    def _last_run(self, year, month, day, hour, minute):
+        """ Returns the last run time at or before the given date and time, None if there is none"""
+        year_low = FIELD_BOUNDS['Year'][0]
+        stats = _STATS
+        while True:
+            if stats is not None:
+                stats['candidates'] += 1
+            prev_year = _prev_value(self.years, year_low, year)
+            if prev_year is None:
+                return None
+            if prev_year != year:
+                year, month, day, hour, minute = prev_year, 12, 31, 23, 59
+
+            prev_month = _prev_value(self.months, 1, month)
+            if prev_month is None:
+                year, month, day, hour, minute = year - 1, 12, 31, 23, 59
+                if stats is not None:
+                    stats['rejected'] += 1
+                continue
+            if prev_month != month:
+                month, day, hour, minute = prev_month, 31, 23, 59
+
+            prev_day = _prev_value(self.days_mask(year, month), 1, day)
+            if prev_day is None:
+                month, day, hour, minute = month - 1, 31, 23, 59
+                if stats is not None:
+                    stats['rejected'] += 1
+                continue
+            if prev_day != day:
+                day, hour, minute = prev_day, 23, 59
+
+            prev_hour = _prev_value(self.hours, 0, hour)
+            if prev_hour is None:
+                day, hour, minute = day - 1, 23, 59
+                if stats is not None:
+                    stats['rejected'] += 1
+                continue
+            if prev_hour != hour:
+                hour, minute = prev_hour, 59
+
+            prev_minute = _prev_value(self.minutes, 0, minute)
+            if prev_minute is None:
+                hour, minute = hour - 1, 59
+                if stats is not None:
+                    stats['rejected'] += 1
+                continue
+            return datetime.datetime(year, month, day, hour, prev_minute)
+
+    def missed_runs(self, since, until, executed, tolerance=datetime.timedelta(minutes=1)):
+        """ Returns the runs in [since, until) that have no matching execution
+
+        The expected runs and the sorted execution times are merged in a single pass. An
+        execution matches a run if it happened at or after the run, within the tolerance and
+        before the next run; each execution matches at most one run
+
+        Arguments:
+        since - datetime (UTC), start of the window
+        until - datetime (UTC), end of the window
+        executed - Iterable of the datetimes (UTC) the job actually ran at, in any order
+        tolerance - How late an execution may start and still count for its run, defaults to
+        within the same minute
+
+        Return:
+        A list of datetime objects, in ascending order
+        """
+        return _missed_runs(self, since, until, executed, tolerance)
+
+    def iter_runs(self, start=None):
+        """ Lazily yields the run times of the cron in ascending order
+
+        Only the values needed by the caller are computed, so taking the next few runs of a
+        schedule (e.g. with itertools.islice) costs a few steps irrespective of the Year field
+
+        Arguments:
+        start - datetime (UTC) from which the runs are evaluated, defaults to now. A run at
+        start itself is included
+
+        Return:
+        A generator of datetime objects
+        """
+        start = _ceil_minute(_utc_naive(start) if start is not None else datetime.datetime.utcnow())
+        for year in _iter_mask(self.years, FIELD_BOUNDS['Year'][0], start.year):
+            first_month = year == start.year
+            for month in _iter_mask(self.months, 1, start.month if first_month else None):
+                first_day = first_month and month == start.month
+                for day in _iter_mask(self.days_mask(year, month), 1, start.day if first_day else None):
+                    first_hour = first_day and day == start.day
+                    for hour in _iter_mask(self.hours, 0, start.hour if first_hour else None):
+                        first_minute = first_hour and hour == start.hour
+                        for minute in _iter_mask(self.minutes, 0, start.minute if first_minute else None):
+                            yield datetime.datetime(year, month, day, hour, minute)
+
+
+# Fixed width binary record of a CronSchedule (little endian): minutes, hours, dom, months, dow,
+# flags (bit 0 dom_last, bit 1 dow_last), dom_weekday, dow_nth, years (230 bits in 29 bytes)
+_RECORD = struct.Struct('<QIIHBBBB29sx')
+RECORD_SIZE = _RECORD.size
+# Header of a file of schedule records: magic and record size
+_FILE_HEADER = struct.Struct('<8sI')
+_FILE_MAGIC = b'AWSCRON1'
+# Schedules decoded from records keyed by the record, files of rules repeat the same schedules
+RECORD_CACHE = LRUCache(maxsize=16384)
+
+
+def _load_record(data):
+    """ Returns the (interned) schedule of a record read from a file"""
+    schedule = RECORD_CACHE.get(data)
+    if schedule is None:
+        schedule = CronSchedule.from_bytes(data)
+        interned = SCHEDULE_CACHE.get(schedule._key)
+        if interned is None:
+            SCHEDULE_CACHE.put(schedule._key, schedule)
+        else:
+            schedule = interned
+        RECORD_CACHE.put(data, schedule)
+    return schedule
+
+
+def dump_schedules(schedules, path):
+    """ Writes compiled schedules to a file of fixed width records, see ScheduleFile
+
+    Arguments:
+    schedules - Iterable of CronSchedule objects. The records are in the same order, so keep the
+    rule ids alongside (e.g. in a list) to map them back
+    path - Path of the file
+
+    Return:
+    Number of schedules written
+    """
+    count = 0
+    with open(path, 'wb') as f:
+        f.write(_FILE_HEADER.pack(_FILE_MAGIC, RECORD_SIZE))
+        for schedule in schedules:
+            f.write(schedule.to_bytes())
+            count += 1
+    return count
+
+
+class ScheduleFile():
+    """ Read only sequence of the schedules in a file written by dump_schedules
+
+    The file is memory mapped and each record is decoded only when it's accessed, so opening
+    a file of a million schedules (about 50 MB) reads nothing up front
+    """
+
+    def __init__(self, path):
+        """ Arguments:
+        path - Path of the file
+
+        Raises ValueError if the file is not a schedule file
+        """
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        if len(self._map) < _FILE_HEADER.size:
+            self.close()
+            raise ValueError("{0} is not a schedule file".format(path))
+        magic, record_size = _FILE_HEADER.unpack_from(self._map, 0)
+        if magic != _FILE_MAGIC or record_size != RECORD_SIZE or (len(self._map) - _FILE_HEADER.size) % RECORD_SIZE:
+            self.close()
+            raise ValueError("{0} is not a schedule file".format(path))
+        self._count = (len(self._map) - _FILE_HEADER.size) // RECORD_SIZE
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("Schedule index out of range")
+        offset = _FILE_HEADER.size + index * RECORD_SIZE
+        return _load_record(self._map[offset:offset + RECORD_SIZE])
+
+    def __iter__(self):
+        for offset in range(_FILE_HEADER.size, _FILE_HEADER.size + self._count * RECORD_SIZE, RECORD_SIZE):
+            yield _load_record(self._map[offset:offset + RECORD_SIZE])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Unmaps the file"""
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+
+# Error found in a cron expression. field is one of FIELDS (None when the expression itself is
+# malformed), position is the offset of the offending character in the expression
+CronError = collections.namedtuple('CronError', ['field', 'position', 'reason'])
+
+# The whole grammar is tokenised by this one expression: numbers, names (JAN, MON, L, W),
+# operators and any other character, which is always an error
+_TOKEN_RE = re.compile(r'(?P<number>\d+)|(?P<name>[A-Za-z]+)|(?P<op>[*?,/#-])|(?P<invalid>.)', re.DOTALL | re.ASCII)
+_FIELD_RE = re.compile(r'\S+')
+_FULL_MASKS = dict((field, (1 << (high - low + 1)) - 1) for field, (low, high) in FIELD_BOUNDS.items())
+
+# Grammar of a well formed expression, matched in one go by the regex engine. Only the values
+# are checked afterwards; anything that doesn't fit goes through the tokenizer for the errors.
+# All the expressions are ASCII only, \d would otherwise match the digits of other scripts
+_VALUE = r'(?:\d+|[A-Za-z]+)'
+_LIST = r'(?:\*|{0}(?:-{0})?)(?:/\d+)?(?:,(?:\*|{0}(?:-{0})?)(?:/\d+)?)*'.format(_VALUE)
+_EXPRESSION_RE = re.compile(r'\s*({0})\s+({0})\s+(\?|L|\d+W|{0})\s+({0})\s+(\?|L|{1}#\d+|\d+L|{0})\s+({0})\s*$'.format(_LIST, _VALUE), re.IGNORECASE | re.ASCII)
+_TERM_RE = re.compile(r'(?:(\*)|({0})(?:-({0}))?)(?:/(\d+))?'.format(_VALUE), re.ASCII)
+# Numbers with more digits than this are out of range in every field, they are converted to
+# _NUMBER_CAP instead of a huge integer (or going over the int conversion limit)
+_NUMBER_DIGITS = 9
+_NUMBER_CAP = 10 ** _NUMBER_DIGITS
+
+
+def _number(text):
+    """ Converts a string of digits to an integer, capped at _NUMBER_CAP"""
+    text = text.lstrip('0') or '0'
+    return int(text) if len(text) <= _NUMBER_DIGITS else _NUMBER_CAP
+
+
+def _step_mask(start, stop, step, low):
+    """ Returns the mask with the bits of start, start + step, ..., stop set. Built as a geometric
+    series instead of a loop over the values"""
+    # A step longer than the range only sets start, clamping it keeps the series small
+    step = min(step, stop - start + 1)
+    count = (stop - start) // step + 1
+    return ((1 << (step * count)) - 1) // ((1 << step) - 1) << (start - low)
+
+
+def _match_value(field, text):
+    """ Converts a matched value to an integer, None if it is not allowed in the field"""
+    if text.isdigit():
+        value = _number(text)
+    else:
+        value = FIELD_NAMES.get(field, {}).get(text.upper())
+        if value is None:
+            return None
+    low, high = FIELD_BOUNDS[field]
+    return value if low <= value <= high else None
+
+
+def _match_mask(field, text):
+    """ Builds the mask of a field matched by the grammar, None if any value is not allowed"""
+    if text == '*':
+        return _FULL_MASKS[field]
+    low, high = FIELD_BOUNDS[field]
+    mask = 0
+    for term in text.split(','):
+        star, first, last, step = _TERM_RE.match(term).groups()
+        if star:
+            start, stop = low, high
+        else:
+            start = _match_value(field, first)
+            if start is None:
+                return None
+            if last:
+                stop = _match_value(field, last)
+                if stop is None or start > stop:
+                    return None
+            else:
+                # e.g. 6/6 starts at 6 and goes up to the highest value of the field
+                stop = high if step else start
+        step = _number(step) if step else 1
+        if not step:
+            return None
+        mask |= _step_mask(start, stop, step, low)
+    return mask
+
+
+def _match_schedule(minutes, hours, dom, months, dow, years):
+    """ Compiles the fields of an expression matched by the grammar, None if it is not valid"""
+    if (dom == '?') == (dow == '?'):
+        return None
+    values = dict(dom=0, dom_last=False, dom_weekday=0, dow=0, dow_nth=0, dow_last=False)
+    dom, dow = dom.upper(), dow.upper()
+    if dom == 'L':
+        values['dom_last'] = True
+    elif dom.endswith('W'):
+        values['dom_weekday'] = _match_value('DoM', dom[:-1])
+    elif dom != '?':
+        values['dom'] = _match_mask('DoM', dom)
+    if dow == 'L':
+        # L on its own is the last day of the week i.e. Saturday
+        values['dow'] = 1 << 6
+    elif '#' in dow:
+        weekday, _, nth = dow.partition('#')
+        weekday = _match_value('DoW', weekday)
+        if weekday is None or not 1 <= _number(nth) <= 5:
+            return None
+        values['dow'], values['dow_nth'] = 1 << (weekday - 1), _number(nth)
+    elif dow.endswith('L'):
+        weekday = _match_value('DoW', dow[:-1])
+        values['dow'], values['dow_last'] = (1 << (weekday - 1) if weekday else None), True
+    elif dow != '?':
+        values['dow'] = _match_mask('DoW', dow)
+    masks = [_match_mask('Minutes', minutes), _match_mask('Hours', hours), _match_mask('Month', months), _match_mask('Year', years)]
+    if None in masks or None in values.values():
+        return None
+    return CronSchedule(masks[0], masks[1], values['dom'], masks[2], values['dow'], masks[3], dom_last=values['dom_last'], dom_weekday=values['dom_weekday'], dow_nth=values['dow_nth'], dow_last=values['dow_last'])
+
+
+class _FieldParser():
+    """ Recursive descent over the tokens of one field. Errors are collected, never raised"""
+
+    def __init__(self, field, text, offset, errors):
+        self.field = field
+        self.low, self.high = FIELD_BOUNDS[field]
+        self.names = FIELD_NAMES.get(field, {})
+        self.end = offset + len(text)
+        # The end token saves bounds checks while looking ahead
+        self.tokens = [(m.lastgroup, m.group().upper(), offset + m.start()) for m in _TOKEN_RE.finditer(text)]
+        self.tokens.append(('end', '', self.end))
+        self.errors = errors
+
+    def error(self, reason, token):
+        """ Records an error at the token and returns None"""
+        self.errors.append(CronError(self.field, token[2], reason))
+        return None
+
+    def value(self, token):
+        """ Converts a number or a name token to a value within the bounds of the field"""
+        kind, text, _ = token
+        if kind == 'number':
+            if self.low <= _number(text) <= self.high:
+                return _number(text)
+            return self.error("Value {0} is out of range {1}-{2}".format(text, self.low, self.high), token)
+        if kind == 'name' and text in self.names:
+            return self.names[text]
+        if kind == 'name':
+            return self.error("Invalid name {0}".format(text), token)
+        if kind == 'end':
+            return self.error("Value missing", token)
+        return self.error("Expected a value, found {0}".format(text), token)
+
+    def mask(self):
+        """ Parses a comma separated list of *, values, ranges and increments into a bitmask"""
+        tokens = self.tokens
+        low, high = self.low, self.high
+        mask = 0
+        index = 0
+        while True:
+            if tokens[index][1] == '*':
+                start, stop, single = low, high, False
+                index += 1
+            else:
+                start = self.value(tokens[index])
+                if start is None:
+                    return None
+                stop, single = start, True
+                index += 1
+                if tokens[index][1] == '-':
+                    stop = self.value(tokens[index + 1])
+                    if stop is None:
+                        return None
+                    if start > stop:
+                        return self.error("Invalid range {0}-{1}".format(start, stop), tokens[index + 1])
+                    single = False
+                    index += 2
+            step = 1
+            if tokens[index][1] == '/':
+                token = tokens[index + 1]
+                if token[0] != 'number' or _number(token[1]) == 0:
+                    return self.error("Increment must be a positive number", token)
+                step = _number(token[1])
+                index += 2
+                if single:
+                    # e.g. 6/6 starts at 6 and goes up to the highest value of the field
+                    stop = high
+            mask |= _step_mask(start, stop, step, low)
+
+            token = tokens[index]
+            if token[0] == 'end':
+                return mask
+            if token[1] != ',':
+                return self.error("Unexpected {0}".format(token[1]), token)
+            index += 1
+            if tokens[index][0] == 'end':
+                return self.error("Value missing after ,", tokens[index])
+
+    def shape(self):
+        """ Returns the texts of the tokens with every number replaced by None"""
+        return tuple(None if kind == 'number' else text for kind, text, _ in self.tokens[:-1])
+
+    def dom(self):
+        """ Returns a tuple of (dom, dom_last, dom_weekday) or None"""
+        shape = self.shape()
+        if shape == ('L',):
+            return (0, True, 0)
+        if shape == (None, 'W'):
+            day = self.value(self.tokens[0])
+            return None if day is None else (0, False, day)
+        mask = self.mask()
+        return None if mask is None else (mask, False, 0)
+
+    def dow(self):
+        """ Returns a tuple of (dow, dow_nth, dow_last) or None"""
+        shape = self.shape()
+        if shape == ('L',):
+            # L on its own is the last day of the week i.e. Saturday
+            return (1 << 6, 0, False)
+        if len(shape) == 3 and shape[1] == '#':
+            weekday = self.value(self.tokens[0])
+            if weekday is None:
+                return None
+            token = self.tokens[2]
+            if token[0] != 'number' or not 1 <= _number(token[1]) <= 5:
+                return self.error("Occurrence after # must be 1-5", token)
+            return (1 << (weekday - 1), _number(token[1]), False)
+        if len(shape) == 2 and shape[1] == 'L':
+            weekday = self.value(self.tokens[0])
+            return None if weekday is None else (1 << (weekday - 1), 0, True)
+        if len(shape) == 1 and shape[0] and shape[0][:-1] in self.names and shape[0].endswith('L'):
+            # e.g. FRIL is tokenised as a single name
+            return (1 << (self.names[shape[0][:-1]] - 1), 0, True)
+        mask = self.mask()
+        return None if mask is None else (mask, 0, False)
+
+
+def _parse_expression(expression):
+    """ Parses a cron expression without raising any exception
+
+    Well formed expressions are matched by the precompiled grammar and compiled from its groups.
+    Anything else is tokenised in a single pass by _FieldParser, which reports every error with
+    its field and position
+
+    Arguments:
+    expression - A string with six white space separated fields
+
+    Return:
+    A tuple of the CronSchedule (None if there are errors) and a list of CronError
+    """
+    if type(expression) is not str:
+        return (None, [CronError(None, 0, "Cron expression must be string type and not {0}".format(type(expression)))])
+    match = _EXPRESSION_RE.match(expression)
+    if match:
+        schedule = _match_schedule(*match.groups())
+        if schedule is not None:
+            return (schedule, [])
+
+    fields = [(m.group(), m.start()) for m in _FIELD_RE.finditer(expression)]
+    if len(fields) != len(FIELDS):
+        return (None, [CronError(None, 0, "Cron expression must have {0} fields and not {1}".format(len(FIELDS), len(fields)))])
+
+    errors = []
+    values = {}
+    for field, (text, offset) in zip(FIELDS, fields):
+        if text == '?':
+            if field not in ('DoM', 'DoW'):
+                errors.append(CronError(field, offset, "? is only allowed in DoM and DoW"))
+            values[field] = None
+            continue
+        if text == '*' and field not in ('DoM', 'DoW'):
+            values[field] = _FULL_MASKS[field]
+            continue
+        parser = _FieldParser(field, text, offset, errors)
+        if field == 'DoM':
+            values[field] = parser.dom()
+        elif field == 'DoW':
+            values[field] = parser.dow()
+        else:
+            values[field] = parser.mask()
+    if (fields[2][0] == '?') == (fields[4][0] == '?'):
+        errors.append(CronError('DoW', fields[4][1], "Out of DoM and DoW, exactly one field must be '?'"))
+    if errors:
+        return (None, errors)
+
+    dom, dom_last, dom_weekday = values['DoM'] or (0, False, 0)
+    dow, dow_nth, dow_last = values['DoW'] or (0, 0, False)
+    return (CronSchedule(
+        values['Minutes'],
+        values['Hours'],
+        dom,
+        values['Month'],
+        dow,
+        values['Year'],
+        dom_last=dom_last,
+        dom_weekday=dom_weekday,
+        dow_nth=dow_nth,
+        dow_last=dow_last), [])
+
+
+def validate(expression):
+    """ Validates a cron expression without raising any exception
+
+    Arguments:
+    expression - A string with six white space separated fields
+
+    Return:
+    A list of CronError (field, position, reason) tuples, empty if the expression is valid
+    """
+    return _parse_expression(expression)[1]
+
+
+def compile_schedule(expression):
+    """ Compiles a cron expression into a CronSchedule
+
+    Arguments:
+    expression - A string with six white space separated fields
+
+    Return:
+    CronSchedule object
+
+    Raises ValueError if the expression is not valid
+    """
+    if _STATS is not None:
+        _STATS['compiles'] += 1
+    schedule, errors = _parse_expression(expression)
+    if errors:
+        field, position, reason = errors[0]
+        raise ValueError("{0} (field {1}, position {2})".format(reason, field, position))
+    return schedule
+
+
+def _utc_naive(value):
+    """ Converts an aware datetime to a naive UTC datetime. Naive datetimes are taken as UTC"""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class ZoneTable():
+    """ UTC offset transitions of a time zone over the years allowed by the Year field
+
+    The table is built once per zone from zoneinfo, after which converting between UTC and local
+    wall clock time is a bisect over a list of datetimes, with no further tz lookups.
+
+    Local times that don't exist (skipped when the clocks go forward) are moved to the moment of
+    the transition, and local times that occur twice (when the clocks go back) resolve to their
+    first occurrence, so a cron in the zone runs once per wall clock time
+    """
+
+    def __init__(self, tz):
+        """ Arguments:
+        tz - IANA time zone name (e.g. Europe/London) or a tzinfo object
+        """
+        if type(tz) is str:
+            if zoneinfo is None:
+                raise ImportError("zoneinfo (Python 3.9+) is required for time zone names")
+            try:
+                tz = zoneinfo.ZoneInfo(tz)
+            except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+                raise ValueError("Unknown time zone {0}".format(tz))
+        self.tz = tz
+        # transitions[i] is the UTC time from which offsets[i] applies (transitions[0] is the
+        # start of the table)
+        self.transitions = []
+        self.offsets = []
+        low, high = FIELD_BOUNDS['Year']
+        current = datetime.datetime(low, 1, 1)
+        end = datetime.datetime(high + 1, 1, 1)
+        offset = self._offset(current)
+        self.transitions.append(current)
+        self.offsets.append(offset)
+        # Offsets change at most a few times a year, so weekly samples find every transition
+        # which is then narrowed down by bisection
+        week = datetime.timedelta(days=7)
+        while current < end:
+            following = min(current + week, end)
+            if self._offset(following) != offset:
+                before, after = current, following
+                while after - before > datetime.timedelta(seconds=1):
+                    middle = before + datetime.timedelta(seconds=(after - before).total_seconds() // 2)
+                    if self._offset(middle) == offset:
+                        before = middle
+                    else:
+                        after = middle
+                offset = self._offset(after)
+                self.transitions.append(after)
+                self.offsets.append(offset)
+                following = after
+            current = following
+        # Local wall clock time from which offsets[i] applies, see to_utc
+        self.local_starts = [self.transitions[0] + self.offsets[0]]
+        for i in range(1, len(self.transitions)):
+            self.local_starts.append(self.transitions[i] + max(self.offsets[i - 1], self.offsets[i]))
+        changes = [abs(b - a) for a, b in zip(self.offsets, self.offsets[1:])]
+        self.max_change = max(changes) if changes else datetime.timedelta(0)
+
+    def _offset(self, value):
+        """ Returns the UTC offset of the zone at the given naive UTC time"""
+        return value.replace(tzinfo=datetime.timezone.utc).astimezone(self.tz).utcoffset()
+
+    def offset(self, value):
+        """ Returns the UTC offset (timedelta) at the given naive UTC time"""
+        return self.offsets[max(bisect.bisect_right(self.transitions, value) - 1, 0)]
+
+    def to_local(self, value):
+        """ Converts a naive UTC datetime to the naive local wall clock time"""
+        return value + self.offset(value)
+
+    def to_utc(self, value):
+        """ Converts a naive local wall clock time to a naive UTC datetime"""
+        index = max(bisect.bisect_right(self.local_starts, value) - 1, 0)
+        result = value - self.offsets[index]
+        if index + 1 < len(self.transitions) and result >= self.transitions[index + 1]:
+            # Skipped local time, runs when the clocks go forward
+            result = self.transitions[index + 1]
+        return result
+
+    def segments(self, start, end):
+        """ Yields a tuple of (index, UTC start, UTC end) for each stretch of [start, end) with a
+        constant offset"""
+        index = max(bisect.bisect_right(self.transitions, start) - 1, 0)
+        while index < len(self.transitions) and self.transitions[index] < end:
+            following = self.transitions[index + 1] if index + 1 < len(self.transitions) else end
+            yield (index, max(start, self.transitions[index]), min(end, following))
+            index += 1
+
+
+# ZoneTable per time zone
+ZONE_CACHE = LRUCache(maxsize=64)
+
+
+def zone_table(tz):
+    """ Returns the cached ZoneTable of a time zone (IANA name or tzinfo object)"""
+    table = ZONE_CACHE.get(tz)
+    if table is None:
+        table = ZoneTable(tz)
+        ZONE_CACHE.put(tz, table)
+    return table
+
+
+class ZonedSchedule():
+    """ A CronSchedule evaluated in the wall clock time of a time zone
+
+    The fields of the expression are matched against local time. Arguments and results are
+    naive UTC datetimes (aware datetimes are converted to UTC), the same as for CronSchedule
+    """
+
+    def __init__(self, schedule, tz):
+        """ Arguments:
+        schedule - CronSchedule object
+        tz - IANA time zone name (e.g. Europe/London) or a tzinfo object
+        """
+        self.schedule = schedule
+        self.zone = zone_table(tz)
+
+    def __repr__(self):
+        return "ZonedSchedule('{0}', {1})".format(self.schedule.expression, self.zone.tz)
+
+    def iter_runs(self, start=None):
+        """ Lazily yields the run times (UTC) in ascending order, from start (UTC, defaults to now)"""
+        start = _ceil_minute(_utc_naive(start) if start is not None else datetime.datetime.utcnow())
+        last = None
+        # Local runs skipped by the clocks going forward just before start still run at start
+        for run in self.schedule.iter_runs(self.zone.to_local(start) - self.zone.max_change):
+            run = self.zone.to_utc(run)
+            if run >= start and run != last:
+                last = run
+                yield run
+
+    def next_fire(self, after=None):
+        """ Returns the first run time (UTC) strictly after the given time (UTC, defaults to now)"""
+        after = (_utc_naive(after) if after is not None else datetime.datetime.utcnow()).replace(second=0, microsecond=0)
+        return next(self.iter_runs(after + datetime.timedelta(minutes=1)), None)
+
+    def prev_fire(self, before=None):
+        """ Returns the last run time (UTC) strictly before the given time (UTC, defaults to now)"""
+        before = _utc_naive(before) if before is not None else datetime.datetime.utcnow()
+        # Local to UTC never goes backwards, so the local runs are walked back from the latest
+        # one that can be before the given time
+        local = self.schedule.prev_fire(self.zone.to_local(before) + self.zone.max_change + datetime.timedelta(minutes=1))
+        while local is not None:
+            run = self.zone.to_utc(local)
+            if run < before:
+                return run
+            local = self.schedule.prev_fire(local)
+        return None
+
+    def missed_runs(self, since, until, executed, tolerance=datetime.timedelta(minutes=1)):
+        """ Returns the runs (UTC) in [since, until) that have no matching execution, see
+        CronSchedule.missed_runs"""
+        return _missed_runs(self, since, until, executed, tolerance)
+
+    def matches(self, value):
+        """ Checks if the cron runs at the given time (UTC, minute resolution)"""
+        value = _utc_naive(value).replace(second=0, microsecond=0)
+        local = self.zone.to_local(value)
+        if self.zone.to_utc(local) == value and self.schedule.matches(local):
+            return True
+        return self._skipped_runs(value) > 0
+
+    def _skipped_runs(self, value):
+        """ Returns the number of local runs skipped by the clocks going forward at the UTC time,
+        which all run at that time"""
+        index = bisect.bisect_left(self.zone.transitions, value)
+        if index == 0 or index >= len(self.zone.transitions) or self.zone.transitions[index] != value:
+            return 0
+        before, after = self.zone.offsets[index - 1], self.zone.offsets[index]
+        if after <= before:
+            return 0
+        return self.schedule.count_runs(value + before, value + after)
+
+    def matches_many(self, timestamps):
+        """ Vectorised matches over a NumPy datetime64 array of UTC timestamps"""
+        if np is None:
+            raise ImportError("numpy is required for matches_many")
+        timestamps = np.asarray(timestamps, dtype='datetime64[m]')
+        transitions = np.array(self.zone.transitions, dtype='datetime64[m]')
+        offsets = np.array(self.zone.offsets, dtype='timedelta64[m]')
+        local_starts = np.array(self.zone.local_starts, dtype='datetime64[m]')
+        # UTC -> local, then back to UTC to drop the second occurrence of repeated local times
+        local = timestamps + offsets[np.maximum(np.searchsorted(transitions, timestamps, side='right') - 1, 0)]
+        index = np.maximum(np.searchsorted(local_starts, local, side='right') - 1, 0)
+        back = local - offsets[index]
+        following = transitions[np.minimum(index + 1, len(transitions) - 1)]
+        back = np.where((index + 1 < len(transitions)) & (back >= following), following, back)
+        matched = self.schedule.matches_many(local) & (back == timestamps)
+        # Transitions at which skipped local runs are run
+        present = transitions[np.isin(transitions, timestamps)]
+        skipped = [t for t in present.tolist() if self._skipped_runs(t)]
+        if skipped:
+            matched |= np.isin(timestamps, np.array(skipped, dtype='datetime64[m]'))
+        return matched
+
+    def count_runs(self, start, end):
+        """ Returns the number of runs in [start, end) (UTC)
+
+        Each stretch of constant UTC offset is counted by CronSchedule.count_runs in local time.
+        Local runs skipped by the clocks going forward count once, at the transition
+        """
+        start = _ceil_minute(_utc_naive(start))
+        end = _ceil_minute(_utc_naive(end))
+        total = 0
+        for index, first, last in self.zone.segments(start, end):
+            offset = self.zone.offsets[index]
+            if index > 0 and self.zone.offsets[index - 1] > offset:
+                # The first stretch of UTC after the clocks go back repeats local times that
+                # already ran
+                first = max(first, self.zone.transitions[index] + self.zone.offsets[index - 1] - offset)
+            if first < last:
+                total += self.schedule.count_runs(first + offset, last + offset)
+            if index > 0 and start <= self.zone.transitions[index] < end:
+                skipped = self._skipped_runs(self.zone.transitions[index])
+                if skipped and not self.schedule.matches(self.zone.transitions[index] + offset):
+                    total += 1
+        return total
+
+
 class CronParser():
     """Returns the runtimes for the provided cron expression"""
 
-    def __init__(self, cron_expression):
+    def __init__(self, cron_expression, tz=None):
         """ Takes a cron expression as argument to initialize the object and extracts the field values
 
         Arguments:
         cron_expression - A string with six space separated fields
+        tz - Time zone (IANA name or tzinfo object) the fields are matched in. Defaults to UTC
 
         Return:
         None
         """
+        self._schedule = None
+        self._zoned = None
+        self.tz = tz
         if type(cron_expression) is not str:
             print("Cron expression must be string type and not {0}".format(type(cron_expression)))
         else:
             self.expression = cron_expression.strip()
-            self._expression_field_values = dict(zip(FIELDS, self.expression.split(' ')))
+            self._expression_field_values = dict(zip(FIELDS, self.expression.split()))
+
+    @staticmethod
+    def compile(expression):
+        """ Returns the shared CronSchedule of a cron expression
+
+        The expression is normalised (white space and case) and looked up in EXPRESSION_CACHE, so
+        every distinct expression is parsed only once. Newly compiled schedules are interned in
+        SCHEDULE_CACHE, so equivalent expressions get the same immutable object
+
+        Arguments:
+        expression - A string with six white space separated fields
+
+        Return:
+        CronSchedule object
+
+        Raises ValueError if the expression is not valid
+        """
+        if type(expression) is not str:
+            raise ValueError("Cron expression must be string type and not {0}".format(type(expression)))
+        if _STATS is not None:
+            _STATS['compile_calls'] += 1
+        normalised = ' '.join(expression.split()).upper()
+        schedule = EXPRESSION_CACHE.get(normalised)
+        if schedule is None:
+            schedule = compile_schedule(normalised)
+            interned = SCHEDULE_CACHE.get(schedule._key)
+            if interned is None:
+                SCHEDULE_CACHE.put(schedule._key, schedule)
+            else:
+                schedule = interned
+            EXPRESSION_CACHE.put(normalised, schedule)
+        return schedule
+
+    @property
+    def schedule(self):
+        """ Returns the compiled CronSchedule of the expression. The expression is compiled on first use"""
+        if self._schedule is None:
+            self._schedule = CronParser.compile(self.expression)
+        return self._schedule
+
+    @property
+    def _runs(self):
+        """ Returns the object the run time methods are evaluated on, the CronSchedule or a
+        ZonedSchedule if a time zone was given"""
+        if self.tz is None:
+            return self.schedule
+        if self._zoned is None:
+            self._zoned = ZonedSchedule(self.schedule, self.tz)
+        return self._zoned
 
     
     def _check_dom_dotw(self):
@@ -86,190 +1526,30 @@ class CronParser():
     
     def minute_parser(self):
         """ Returns a list of minute values in the cron expression"""
-
-        minute = []
-        try:
-            minute.append(int(self._expression_field_values['Minutes']))
-            # minute = int(self._expression_field_values['Minutes'])
-            # return minute[0]
-            return minute
-        except:
-            if self._expression_field_values['Minutes'] == '*':
-                for i in list(range(datetime.datetime.utcnow().minute, 60)):
-                    minute.append(i)
-                # minute = datetime.datetime.utcnow().minute
-                # return minute[0]
-                return minute
-            else:
-                for i in self._expression_field_values['Minutes'].split(','):
-                    try:
-                        # minute = int(i)
-                        minute.append(int(i))
-                        # return minute[0]
-                    except:
-                        minute = []
-                        j = i.split('/')
-                        k = j[0].split('-')
-                        if len(j) > 1:
-                            if len(k) > 1:
-                                l = range(int(k[0]), int(k[1])+1, int(j[1])) # Adding 1 to the stop value to make it inlcusive of the last value
-                            else:
-                                l = range(int(k[0]), 2*int(k[0]) + 1, int(j[1]))
-                        else:
-                            if len(k) > 1:
-                                l = range(int(k[0]), int((k[1]) + 1))
-                            else:
-                                l = range(int(k[0], 2*int((k[0]) + 1)))
-                        for i in list(l):
-                            minute.append(i)
-                # return minute[0]
-                return minute
+        return _mask_values(self.schedule.minutes)
 
     
     def hour_parser(self):
         """ Returns a list of hour values as per the cron expression"""
-
-        hour = []
-        try:
-            hour.append(int(self._expression_field_values['Hours']))
-            # return hour[0]
-            return hour
-        except:
-            if self._expression_field_values['Hours'] == '*':
-                for i in list(range(datetime.datetime.utcnow().hour, 24)):
-                    hour.append(i)
-                # return hour[0]
-                return hour
-            else:
-                for i in self._expression_field_values['Hours'].split(','):
-                    try:
-                        hour.append(int(i))
-                    except:
-                        j = i.split('/')
-                        k = j[0].split('-')
-                        # if len(j) > 1:
-                        #     l = range(int(k[0]), int(k[1])+1, int(j[1]))
-                        # else:
-                        #     l = range(int(k[0]), int(k[1])+1)
-                        # hour.append(list(l))
-                        if len(j) > 1:
-                            if len(k) > 1:
-                                l = range(int(k[0]), int(k[1])+1, int(j[1]))
-                            else:
-                                # If there is only one value before / e.g. 6/6. It will go upto the next value
-                                l = range(int(k[0]), 2*int(k[0]) + 1, int(j[1]))
-                        else:
-                            if len(k) > 1:
-                                l = range(int(k[0]), int(k[1])+1)
-                            else:
-                                l = range(int(k[0]), 2*int(k[0])+1)
-                        for i in list(l):
-                            hour.append(i)
-
-                # return hour[0]
-                return hour
+        return _mask_values(self.schedule.hours)
 
     
-    def dom_parser(self, month, year=datetime.datetime.utcnow().year):
+    def dom_parser(self, month, year=None):
         """ Returns a list of DoM values in the cron expression
         
         Arguments:
-        month - A list of months in which the cron is scheduled to run
-        year - A list of years in which this cron is scheduled to run
+        month - Month for which the days are evaluated (required for L and W)
+        year - Year for which the days are evaluated, defaults to the current year
 
         Return:
-        A list of days in a month on which this cron will run
+        A list of days in a month on which this cron will run, '' if the field is '?'
         """
-
-        dom = []
-        try:
-            dom.append(int(self._expression_field_values['DoM']))
-            # return dom[0]
-            return dom
-        except:
-            if self._expression_field_values['DoM'] == '*':
-                # Return dates till the last of the month
-                for i in list(range(datetime.datetime.utcnow().day, [x for x in calendar.monthcalendar(year, month)[-1] if x != 0][-1] + 1)):
-                    dom.append(i)
-                # return dom[0]
-                return dom
-            elif self._expression_field_values['DoM'].upper() == 'L':
-                for y in year:
-                    a = {}
-                    for m in month:
-                        # Get the last day of the month (e.g. 31 or 29 or 30 etc.)
-                        a[m] = [x for x in calendar.monthcalendar(y, m)[-1] if x != 0][-1]
-                    dom.append(a)
-                # return dom[0]
-                return dom
-            elif self._expression_field_values['DoM'] == '?':
-                # '?' wildcard renders this field ineffective
-                return ''
-            elif 'W' in self._expression_field_values['DoM'].upper():
-                date = int(self._expression_field_values['DoM'].upper().strip('W'))
-                a = calendar.weekday(year, month, date)
-                # In calender module, 5 == Saturday, 6 == Sunday, 1 == Monday
-                _time_string = '{0}-{1}-{2}'.format(year, month, date)
-                _format_string = r'%Y-%m-%d'
-                if a == 5 or a == 6:
-                    if a == 5:
-                        # Get the last day if Saturday and the last day in the same month
-                        b = month
-                        last_day = datetime.datetime.strptime(_time_string, _format_string) - datetime.timedelta(days=1)
-                        if last_day.month == b:
-                            dom.append(last_day.day)
-                            # return dom[0]
-                            return dom
-                        else:
-                            # Else get the day next to Sunday
-                            last_day = datetime.datetime.strptime(_time_string, _format_string) + datetime.timedelta(days=2)
-                            dom.append(last_day.day)
-                            # return dom[0]
-                            return dom
-                    elif a == 6:
-                        # Get the next day if Sunday and the next day in the same month
-                        b = month
-                        next_day = datetime.datetime.strptime(_time_string, _format_string) + datetime.timedelta(days=1)
-                        if next_day.month == b:
-                            dom.append(next_day.day)
-                            # return dom[0]
-                            return dom
-                        else:
-                            # Else get the day before Saturday
-                            next_day = datetime.datetime.strptime(_time_string, _format_string) - datetime.timedelta(days=2)
-                            dom.append(next_day.day)
-                            # return dom[0]
-                            return dom
-                    else:
-                        dom.append(a+2) # There is a difference of 2 in weekdays between calendar days and AWS days (calendar: MON - 0, TUE - 1, ...; AWS: Mon - 2, TUE - 3, ...)
-                        # return dom[0]
-                        return dom
-                else:
-                    dom.append(int(self._expression_field_values['DoM'].upper().strip('W')))
-                    # return dom[0]
-                    return dom
-            else:
-                for i in self._expression_field_values['DoM'].split(','):
-                    try:
-                        dom.append(int(i))
-                    except:
-                        j = i.split('/')
-                        k = j[0].split('-')
-                        if len(j) > 1:
-                            if len(k) > 1:
-                                l = range(int(k[0]), int(k[1])+1, int(j[1]))
-                            else:
-                                # If there is only one value before / e.g. 6/6. It will go upto the next value
-                                l = range(int(k[0]), 2*int(k[0]) + 1, int(j[1]))
-                        else:
-                            if len(k) > 1:
-                                l = range(int(k[0]), int(k[1])+1)
-                            else:
-                                l = range(int(k[0]), 2*int(k[0])+1)
-                        for i in list(l):
-                            dom.append(i) # This one will send a list of lists
-                # return dom[0]
-                return dom
+        if self.schedule.day_field != 'DoM':
+            # '?' wildcard renders this field ineffective
+            return ''
+        if year is None:
+            year = datetime.datetime.utcnow().year
+        return _mask_values(self.schedule.days_mask(year, month), 1)
 
     
     def month_parser(self):
@@ -278,67 +1558,7 @@ class CronParser():
         Return:
         A list with integer month values
         """
-
-        month = []
-        try:
-            month.append(int(self._expression_field_values['Month']))
-            # return month[0]
-            return month
-        except:
-            if self._expression_field_values['Month'] == '*':
-                for i in list(range(datetime.datetime.utcnow().month, 13)):
-                    month.append(i)
-                # return month[0]
-                return month
-            # Check if the below condition is required or already fulfilled by the try block
-            elif self._expression_field_values['Month'] in ALLOWED_VALUES['Month'][0].keys():
-                month.append(self._expression_field_values['Month'])
-                # return month[0]
-                return month
-            elif self._expression_field_values['Month'].upper in ALLOWED_VALUES['Month'][0].values():
-                # Single string month
-                month.append(MONTHS_NUMBER[self._expression_field_values['Month']])
-                # return month[0]
-                return month
-            else:
-                for i in self._expression_field_values['Month'].split(','):
-                    try:
-                        month.append(int(i))
-                    except:
-                        j = i.split('/')
-                        k = j[0].split('-')
-                        try:
-                            if len(j) > 1:
-                                if j[0] == '*':
-                                    l = range(1, 13, int(j[1]))
-                                elif len(k) > 1:
-                                    l = range(int(k[0]), int(k[1])+1, int(j[1]))
-                                else:
-                                    l = range(int(k[0]), 2*int(k[0]) + 1, int(j[1]))
-                            else:
-                                if len(k) > 1:
-                                    l = range(int(k[0]), int(k[1]) + 1)
-                                else:
-                                    l = range(int(k[0]), 2*int(k[0]))
-                            for i in list(l):
-                                month.append(i)
-                        except:
-                            try:
-                                # String months range
-                                p = MONTHS_NUMBER[k[0]]
-                                q = MONTHS_NUMBER[k[1]]
-                                if len(j) > 1:
-                                    l = range(int(p), int(q)+1, int(j[1]))
-                                else:
-                                    l = range(int(p), int(q)+1)
-                                for i in list(l):
-                                    month.append(i)
-                            except Exception as e:
-                                print("Error in parsing month values. Given value is {0}".format(self._expression_field_values['Month']))
-                                print("Error message is {0}".format(e))
-                                raise e
-                # return month[0]
-                return month
+        return _mask_values(self.schedule.months, 1)
 
     
     def dow_parser(self, month=None, year=None):
@@ -349,245 +1569,728 @@ class CronParser():
         year - required to evaluate the nth day of week e.g. 2nd Friday of the month in a given year
 
         Return:
-        A list of days of a week on which this cron will run
-        In case of L, it will return a list containing the date for the next run
+        A list of days of the month on which this cron will run, '' if the field is '?'
         """
-
-        dow = []
-        try:
-            # dow.append(int(self._expression_field_values['DoW']))
-            # return dow[0]
-            _dow_val = int(self._expression_field_values['DoW'])
-
-#             SUN	MON	TUE	WED	THU	FRI	SAT
-# aws	        1	2	3	4	5	6	7
-# calendar	    6	0	1	2	3	4	5
-            _cal_month = calendar.monthcalendar(year, month)
-
-            for week in _cal_month:
-                if _dow_val != 1:
-                    if week[_dow_val-2] != 0:
-                        dow.append(week[_dow_val-2])
-                else:
-                    if week[6] != 0:
-                        dow.append(week[6])
-            return dow
-        except:
-            if self._expression_field_values['DoW'] == '*':
-                # dow.append(datetime.datetime.isoweekday(datetime.datetime.utcnow()))
-                # return dow[0]
-
-#             SUN	MON	TUE	WED	THU	FRI	SAT
-# aws	        1	2	3	4	5	6	7
-# calendar	    6	0	1	2	3	4	5
-                _cal_month = calendar.monthcalendar(year, month)
-
-                for week in _cal_month:
-                    for i in week:
-                        if i != 0:
-                            dow.append(i)
-
-                return dow
-            # Check if the below condition is required or already fulfilled by the try block
-            elif self._expression_field_values['DoW'] in ALLOWED_VALUES['DoW'][0].keys():
-                dow.append(int(self._expression_field_values['DoW']))
-                # return dow[0]
-                return dow
-            elif self._expression_field_values['DoW'].upper in ALLOWED_VALUES['DoW'][0].values():
-                # Single string day of week
-                dow.append(MONTHS_NUMBER[self._expression_field_values['DoW']])
-                # return dow[0]
-                return dow
-            elif self._expression_field_values['DoW'].upper() == 'L':
-                # 'L' in DoW expression stands for the last day of the week
-                # For AWS cron expressions, last day is Saturday (7)
-                # Find the next nearest Saturday
-
-                # Get today's day
-                _day_today = datetime.datetime.isoweekday(datetime.datetime.utcnow()) % 7 + 1
-                _sat = 7
-                # Number of days in between today and the next Saturday
-                _delta = abs(_sat - _day_today)
-
-                # Day on the next Saturday
-                _next_sat = datetime.datetime.utcnow() + datetime.timedelta(days=_delta)
-                dow.append([_next_sat.day, _next_sat.month, _next_sat.year])
-                # return dow[0]
-                return dow
-            elif self._expression_field_values['DoW'] == '?':
-                # '?' wildcard renders this field ineffective
-                return ''
-            
-            elif '#' in self._expression_field_values['DoW']:
-
-                # Refactor the code below
-
-                # Find the _nth _day_of_week in a month e.g. 2nd Friday
-                a = self._expression_field_values['DoW'].split('#')
-                _aws_day_of_week = int(a[0])
-                _nth = int(a[1]) - 1
-                _day_today = datetime.datetime.utcnow()
-                _month_calendar = calendar.monthcalendar(year, month)
-
-                # Check this module's docstring for the below conversion context
-                if 2 <= _aws_day_of_week <= 7:
-                    _calendar_day_of_week = _aws_day_of_week - 2
-                else:
-                    _calendar_day_of_week = 6
-
-                o = []
-                for val in _month_calendar:
-                    if int(val[_calendar_day_of_week]) != 0: # 0 is a placeholder in the calendar output for days of week that don't belong to the current month
-                            o.append(int(val[_calendar_day_of_week]))
-
-                if o[_nth] > _day_today.day:
-                    return o[_nth]
-                else:
-                    _month_calendar = calendar.monthcalendar(year, month)
-
-                    # Check this module's docstring for the below conversion context
-                    if 2 <= _aws_day_of_week <= 7:
-                        _calendar_day_of_week = _aws_day_of_week - 2
-                    else:
-                        _calendar_day_of_week = 6
-
-                    o = []
-                    for val in _month_calendar:
-                        if val[_calendar_day_of_week] != 0: # 0 is a placeholder in the calendar output for days of week that don't belong to the current month
-                                o.append(val[_calendar_day_of_week])
-                    return o[_nth]
-            else:
-                for i in self._expression_field_values['DoW'].split(','):
-                    try:
-                        dow.append(int(i))
-                    except:
-                        k = i.split('-')
-                        try:
-                            if len(k) > 1:
-                                l = range(int(k[0]), int(k[1])+1)
-
-#             SUN	MON	TUE	WED	THU	FRI	SAT
-# aws	        1	2	3	4	5	6	7
-# calendar	    6	0	1	2	3	4	5
-                                _cal_month = calendar.monthcalendar(year, month)
-
-                                for week in _cal_month:
-                                    for i in l:
-                                        if i != 1:
-                                            if week[i-2] != 0:
-                                                dow.append(week[i-2])
-                                        else:
-                                            if week[6] != 0:
-                                                dow.append(week[6])
-                            else:
-                                l = range(int(k[0]), 2 * int(k[0]) + 1)
-
-                                _cal_month = calendar.monthcalendar(year, month)
-
-                                for week in _cal_month:
-                                    for i in l:
-                                        if i != 1:
-                                            if week[i-2] != 0:
-                                                dow.append(week[i-2])
-                                        else:
-                                            if week[6] != 0:
-                                                dow.append(week[6])
-                                # for i in list(l):
-                                #     dow.append(i)
-                        except:
-                            try:
-                                # String day of week range
-                                p = DAYS_NUMBER[k[0]]
-                                q = DAYS_NUMBER[k[1]]
-                                l = range(int(p), int(q)+1)
-                                for i in list(l):
-                                    dow.append(i)
-                            except Exception as e:
-                                print("Error in parsing day of week values. Given value is {0}".format(self._expression_field_values['DoW']))
-                                print("Error message is {0}".format(e))
-                                raise e
-            # return dow[0]
-            return dow
+        if self.schedule.day_field != 'DoW':
+            # '?' wildcard renders this field ineffective
+            return ''
+        _now = datetime.datetime.utcnow()
+        if month is None:
+            month = _now.month
+        if year is None:
+            year = _now.year
+        return _mask_values(self.schedule.days_mask(year, month), 1)
         
     
     def year_parser(self):
         """ Returns a list of year values as per the cron expression"""
+        return _mask_values(self.schedule.years, FIELD_BOUNDS['Year'][0])
 
-        year = []
-        try:
-            year.append(int(self._expression_field_values['Year']))
-            # return year[0]
-            return year
-        except:
-            if self._expression_field_values['Year'] == '*':
-                year.append(datetime.datetime.utcnow().year)
-                # return year[0]
-                return year
-            else:
-                for i in self._expression_field_values['Year'].split(','):
-                    try:
-                        year.append(int(i))
-                    except:
-                        j = i.split('/')
-                        k = j[0].split('-')
-                        if len(j) > 1:
-                            if j[0] == '*':
-                                l = range(datetime.datetime.utcnow().year, 2200, int(j[1]))
-                            elif len(k) > 1:
-                                l = range(int(k[0]), int(k[1])+1, int(j[1]))
-                            else:
-                                l = range(int(k[0]), 2*int(k[0])+1, int(j[1]))
-                        else:
-                            if len(k) > 1:
-                                l = range(int(k[0]), int(k[1])+1)
-                            else:
-                                l = range(int(k[0]), 2*int(k[0])+1)
-                        for i in list(l):
-                            year.append(i)
-                # return year[0]
-                return year
+    
+    def count_runs(self, start, end):
+        """ Returns the number of runs of the cron expression in [start, end) (datetimes, UTC)"""
+        return self._runs.count_runs(start, end)
+
+    
+    def matches(self, value):
+        """ Checks if the cron expression runs at the given time (minute resolution)
+
+        Arguments:
+        value - datetime (UTC)
+
+        Return:
+        True or False
+        """
+        return self._runs.matches(value)
+
+    
+    def matches_many(self, timestamps):
+        """ Returns a NumPy boolean mask telling which of the datetime64 timestamps the cron
+        expression runs at"""
+        return self._runs.matches_many(timestamps)
+
+    
+    def next_fire(self, after=None):
+        """ Returns the first run time of the cron expression strictly after the given time
+
+        Arguments:
+        after - datetime (UTC), defaults to now
+
+        Return:
+        datetime object, None if there are no more runs
+        """
+        return self._runs.next_fire(after)
+
+    
+    def prev_fire(self, before=None):
+        """ Returns the last run time of the cron expression strictly before the given time
+
+        Arguments:
+        before - datetime (UTC), defaults to now
+
+        Return:
+        datetime object, None if there was no earlier run
+        """
+        return self._runs.prev_fire(before)
+
+    
+    def missed_runs(self, since, until, executed, tolerance=datetime.timedelta(minutes=1)):
+        """ Returns the runs in [since, until) (UTC) without a matching time in executed, see
+        CronSchedule.missed_runs"""
+        return self._runs.missed_runs(since, until, executed, tolerance)
+
+    
+    def iter_runs(self, start=None):
+        """ Lazily yields the run times of the cron expression in ascending order
+
+        Arguments:
+        start - datetime (UTC) from which the runs are evaluated, defaults to now
+
+        Return:
+        A generator of datetime objects
+        """
+        return self._runs.iter_runs(start)
 
     
     def create_next_run_value(self):
-        print(self._check_dom_dotw())
+        """ Prints the upcoming run times of the cron expression
+
+        Runs are printed up to the end of the current year if the Year field is '*', else up to
+        the last year in the expression
+        """
         if self._check_dom_dotw():
-            minute = self.minute_parser()
-            hour = self.hour_parser()
-            month = self.month_parser()
-            year = self.year_parser()
-
-            for y in year:
-                for m in month:
-                    for h in hour:
-                        for m2 in minute:
-                            i = self.dom_parser(m, y)
-                            if i == '':
-                                dow = self.dow_parser(m, y)
-                                # for d in dow:
-                                if type(dow) is list:
-                                    for d in dow:
-                                        if datetime.datetime.strptime('{0}-{1}-{2} {3}:{4}'.format(y, m, d, h, m), r'%Y-%m-%d %H:%M') < datetime.datetime.utcnow():
-                                            continue
-                                        else:
-                                            print('{0}-{1}-{2} {3}:{4}'.format(y, m, d, h, m2))
-                                else:
-                                    if datetime.datetime.strptime('{0}-{1}-{2} {3}:{4}'.format(y, m, dow, h, m), r'%Y-%m-%d %H:%M') < datetime.datetime.utcnow():
-                                        continue
-                                    else:
-                                        print('{0}-{1}-{2} {3}:{4}'.format(y, m, dow, h, m2))
-                            else:
-                                for d in self.dom_parser(m, y):
-                                    print('{0}-{1}-{2} {3}:{4}'.format(y, m, d, h, m2))
+            if self._expression_field_values['Year'] == '*':
+                last_year = datetime.datetime.utcnow().year
+            else:
+                last_year = self.schedule.years.bit_length() - 1 + FIELD_BOUNDS['Year'][0]
+
+            for run in self.iter_runs():
+                if run.year > last_year:
+                    break
+                print(run.strftime('%Y-%m-%d %H:%M'))
         else:
             print('Cron expression is not valid')
 
 
-if __name__ == '__main__':
-    # a = CronParser()
-    _time = time.time()
+# Minutes in each unit of a rate expression
+RATE_UNITS = {'MINUTE': 1, 'HOUR': 60, 'DAY': 1440}
+_RATE_RE = re.compile(r'^\s*RATE\(\s*(\d+)\s+(MINUTE|HOUR|DAY)(S?)\s*\)\s*$', re.IGNORECASE | re.ASCII)
+_CRON_RE = re.compile(r'^\s*CRON\((.*)\)\s*$', re.IGNORECASE)
+_EPOCH = datetime.datetime(FIELD_BOUNDS['Year'][0], 1, 1)
+# Runs are limited to the years allowed by the Year field of a cron expression
+_END_MINUTE = (datetime.datetime(FIELD_BOUNDS['Year'][1] + 1, 1, 1) - _EPOCH) // datetime.timedelta(minutes=1)
+
+
+def _epoch_minutes(value):
+    """ Returns the number of whole minutes from 1970-01-01 to a datetime, rounded up"""
+    return (_ceil_minute(_utc_naive(value)) - _EPOCH) // datetime.timedelta(minutes=1)
+
+
+class RateSchedule():
+    """ Compiled form of a rate expression, e.g. rate(5 minutes)
+
+    The rule runs every period minutes from the anchor (the first run), so run times are found
+    with integer arithmetic on the number of minutes since 1970. Objects are immutable and have
+    the same run time API as CronSchedule
+    """
+
+    __slots__ = ('period', 'anchor', '_anchor_minute')
+
+    def __init__(self, period, anchor=None):
+        """ Arguments:
+        period - Minutes between runs
+        anchor - datetime (UTC) of the first run. Defaults to 1970-01-01 00:00, which lines the
+        runs up with the unit (e.g. rate(1 hour) runs on the hour)
+        """
+        if period < 1:
+            raise ValueError("Rate must be at least 1 minute")
+        object.__setattr__(self, 'period', period)
+        object.__setattr__(self, 'anchor', _ceil_minute(_utc_naive(anchor)) if anchor is not None else _EPOCH)
+        object.__setattr__(self, '_anchor_minute', _epoch_minutes(self.anchor))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RateSchedule objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("RateSchedule objects are immutable")
+
+    def __reduce__(self):
+        return (RateSchedule, (self.period, self.anchor))
+
+    def __eq__(self, other):
+        if not isinstance(other, RateSchedule):
+            return NotImplemented
+        return (self.period, self.anchor) == (other.period, other.anchor)
+
+    def __hash__(self):
+        return hash((self.period, self.anchor))
+
+    def __repr__(self):
+        return "RateSchedule('{0}')".format(self.expression)
+
+    @property
+    def expression(self):
+        """ Returns the rate expression in the largest unit that divides the period"""
+        for unit in ('DAY', 'HOUR', 'MINUTE'):
+            if self.period % RATE_UNITS[unit] == 0:
+                value = self.period // RATE_UNITS[unit]
+                return 'rate({0} {1}{2})'.format(value, unit.lower(), 's' if value > 1 else '')
+
+    def _run(self, index):
+        """ Returns the datetime of the run with the given index, None if it's past the end of 2199"""
+        minute = self._anchor_minute + index * self.period
+        if minute >= _END_MINUTE:
+            return None
+        return _EPOCH + datetime.timedelta(minutes=minute)
+
+    def _first_index(self, minute):
+        """ Returns the index of the first run at or after the given minute since 1970"""
+        return max(-((self._anchor_minute - minute) // self.period), 0)
+
+    def next_fire(self, after=None):
+        """ Returns the first run time strictly after the given time (UTC, defaults to now), None
+        if there are no more runs"""
+        after = _utc_naive(after) if after is not None else datetime.datetime.utcnow()
+        after = after.replace(second=0, microsecond=0)
+        return self._run(self._first_index(_epoch_minutes(after) + 1))
+
+    def prev_fire(self, before=None):
+        """ Returns the last run time strictly before the given time (UTC, defaults to now), None
+        if there is none"""
+        before = before if before is not None else datetime.datetime.utcnow()
+        minute = min(_epoch_minutes(before), _END_MINUTE) - 1
+        if minute < self._anchor_minute:
+            return None
+        return self._run((minute - self._anchor_minute) // self.period)
+
+    def missed_runs(self, since, until, executed, tolerance=datetime.timedelta(minutes=1)):
+        """ Returns the runs in [since, until) (UTC) that have no matching execution, see
+        CronSchedule.missed_runs"""
+        return _missed_runs(self, since, until, executed, tolerance)
+
+    def iter_runs(self, start=None):
+        """ Lazily yields the run times in ascending order, from start (UTC, defaults to now)"""
+        start = start if start is not None else datetime.datetime.utcnow()
+        index = self._first_index(_epoch_minutes(start))
+        run = self._run(index)
+        step = datetime.timedelta(minutes=self.period)
+        end = _EPOCH + datetime.timedelta(minutes=_END_MINUTE)
+        while run is not None and run < end:
+            yield run
+            run += step
+
+    def count_runs(self, start, end):
+        """ Returns the number of runs in [start, end) (UTC)"""
+        last = min(_epoch_minutes(end), _END_MINUTE)
+        return max(self._first_index(last) - self._first_index(_epoch_minutes(start)), 0)
+
+    def matches(self, value):
+        """ Checks if the rule runs at the given time (UTC, minute resolution)"""
+        value = _utc_naive(value)
+        minute = (value.replace(second=0, microsecond=0) - _EPOCH) // datetime.timedelta(minutes=1)
+        return self._anchor_minute <= minute < _END_MINUTE and (minute - self._anchor_minute) % self.period == 0
+
+    def matches_many(self, timestamps):
+        """ Vectorised matches over a NumPy datetime64 array of timestamps (UTC)"""
+        if np is None:
+            raise ImportError("numpy is required for matches_many")
+        minutes = np.asarray(timestamps, dtype='datetime64[m]')
+        valid = ~np.isnat(minutes)
+        minutes = minutes.astype('int64')
+        return valid & (minutes >= self._anchor_minute) & (minutes < _END_MINUTE) & ((minutes - self._anchor_minute) % self.period == 0)
+
+
+def compile_rate(expression, anchor=None):
+    """ Compiles a rate expression into a RateSchedule
+
+    Arguments:
+    expression - e.g. rate(5 minutes), rate(1 hour). As in CloudWatch Events, the unit is
+    singular when the value is 1 and plural otherwise
+    anchor - datetime (UTC) of the first run, see RateSchedule
+
+    Return:
+    RateSchedule object
+
+    Raises ValueError if the expression is not valid
+    """
+    match = _RATE_RE.match(expression) if type(expression) is str else None
+    if match is None:
+        raise ValueError("Invalid rate expression {0}".format(expression))
+    value, unit, plural = int(match.group(1)), match.group(2).upper(), match.group(3)
+    if value == 0:
+        raise ValueError("Rate value must be a positive number")
+    if (value == 1) == bool(plural):
+        raise ValueError("Rate unit must be {0} for value {1}".format(unit.lower() + ('' if value == 1 else 's'), value))
+    return RateSchedule(value * RATE_UNITS[unit], anchor)
+
+
+class Schedule():
+    """ Entry point for CloudWatch Events schedule expressions, cron(...) or rate(...)"""
+
+    @staticmethod
+    def parse(expression, tz=None, anchor=None):
+        """ Compiles a schedule expression
+
+        Both forms return an object with the same next_fire, iter_runs, count_runs, matches and
+        matches_many methods
+
+        Arguments:
+        expression - cron(<six fields>) or rate(<value> <unit>). A bare cron expression is
+        accepted as well
+        tz - Time zone the cron fields are matched in (cron only). Defaults to UTC
+        anchor - datetime (UTC) of the first run (rate only). Defaults to 1970-01-01 00:00
+
+        Return:
+        CronSchedule, ZonedSchedule or RateSchedule object
+
+        Raises ValueError if the expression is not valid
+        """
+        if type(expression) is not str:
+            raise ValueError("Schedule expression must be string type and not {0}".format(type(expression)))
+        if expression.strip().upper().startswith('RATE('):
+            return compile_rate(expression, anchor)
+        match = _CRON_RE.match(expression)
+        schedule = CronParser.compile(match.group(1) if match else expression)
+        if tz is not None:
+            return ZonedSchedule(schedule, tz)
+        return schedule
+
+
+# The days of a month on which a schedule runs only depend on its day fields and on the shape of
+# the month, the weekday of its 1st and its number of days (28 shapes). The day fields are one of
+# a few kinds, numbered from these offsets: a plain DoM mask (kind 0, the mask is applied on its
+# own), L, nW, a DoW mask, n#k and nL
+_KIND_DOM_LAST = 1
+_KIND_DOM_WEEKDAY = 1
+_KIND_DOW = 33
+_KIND_DOW_NTH = 161
+_KIND_DOW_LAST = 196
+_KIND_COUNT = 203
+# Days masks by kind * 28 + shape, built on the first call of next_runs_batch by _day_table
+_DAY_TABLE = None
+# Batch rows (see _batch_row) of the expressions and schedules given to next_runs_batch, so that
+# a batch decodes all its fields with one numpy.frombuffer
+BATCH_ROW_CACHE = LRUCache(maxsize=16384)
+# Months looked at by the first pass of next_runs_batch
+BATCH_FIRST_MONTHS = 12
+
+if np is not None:
+    # Fields of a schedule as evaluated by next_runs_batch: the masks, the kind of day fields and
+    # the allowed minutes and hours as values, the first minute_count and hour_count of them set
+    _BATCH_DTYPE = np.dtype([
+        ('minutes', '<u8'), ('hours', '<u4'), ('dom', '<u4'), ('months', '<u2'), ('years', 'u1', 29), ('kind', 'u1'),
+        ('minute_count', 'u1'), ('hour_count', 'u1'), ('minute_values', 'u1', 60), ('hour_values', 'u1', 24)])
+    # Calendar of the months since 1970 (index (year - 1970) * 12 + month - 1): shape, mask of
+    # the days and number of the 1st counted in days since 1970
+    _NP_MONTH_DAYS = np.frombuffer(_MONTH_DAYS, dtype=np.uint8).astype(np.int64)
+    _NP_MONTH_SHAPE = np.frombuffer(_FIRST_WEEKDAY, dtype=np.uint8).astype(np.int64) * 4 + _NP_MONTH_DAYS - 28
+    _NP_MONTH_VALID = (np.int64(1) << _NP_MONTH_DAYS) - 1
+    _NP_MONTH_START = np.concatenate(([0], np.cumsum(_NP_MONTH_DAYS)[:-1]))
+
+
+def _unpack_masks(masks, width):
+    """ Returns a boolean array of shape (len(masks), width) with the bits of each mask"""
+    masks = np.asarray(masks, dtype=np.uint64).reshape(-1, 1)
+    return ((masks >> np.arange(width, dtype=np.uint64)) & np.uint64(1)).astype(bool)
+
+
+def _day_kind(schedule):
+    """ Returns the kind of the day fields of a schedule, see _KIND_DOW"""
+    if schedule.dom_last:
+        return _KIND_DOM_LAST
+    if schedule.dom_weekday:
+        return _KIND_DOM_WEEKDAY + schedule.dom_weekday
+    if schedule.dom:
+        return 0
+    # n#k and nL only have one weekday
+    weekday = (schedule.dow & -schedule.dow).bit_length() - 1
+    if schedule.dow_nth:
+        return _KIND_DOW_NTH + weekday * 5 + schedule.dow_nth - 1
+    if schedule.dow_last:
+        return _KIND_DOW_LAST + weekday
+    return _KIND_DOW + schedule.dow
+
+
+def _day_table():
+    """ Returns the days masks of every kind of day fields in every shape of month, as computed
+    by CronSchedule._resolve_days, in an int64 array indexed by kind * 28 + shape"""
+    global _DAY_TABLE
+    if _DAY_TABLE is None:
+        # A month of each shape
+        months = [int(np.argmax(_NP_MONTH_SHAPE == shape)) for shape in range(28)]
+        kinds = [CronSchedule(0, 0, 0, 0, 0, 0, dom_last=True)]
+        kinds += [CronSchedule(0, 0, 0, 0, 0, 0, dom_weekday=day) for day in range(1, 32)]
+        kinds += [CronSchedule(0, 0, 0, 0, dow, 0) for dow in range(128)]
+        kinds += [CronSchedule(0, 0, 0, 0, 1 << weekday, 0, dow_nth=nth) for weekday in range(7) for nth in range(1, 6)]
+        kinds += [CronSchedule(0, 0, 0, 0, 1 << weekday, 0, dow_last=True) for weekday in range(7)]
+        table = [0] * 28
+        for schedule in kinds:
+            table.extend(schedule._resolve_days(FIELD_BOUNDS['Year'][0] + month // 12, month % 12 + 1) for month in months)
+        _DAY_TABLE = np.array(table, dtype=np.int64)
+    return _DAY_TABLE
+
+
+def _batch_row(schedule):
+    """ Returns the fields of a schedule packed as a row of _BATCH_DTYPE"""
+    row = np.zeros(1, dtype=_BATCH_DTYPE)
+    minutes = _mask_values(schedule.minutes)
+    hours = _mask_values(schedule.hours)
+    row['minutes'], row['hours'], row['dom'], row['months'] = schedule.minutes, schedule.hours, schedule.dom, schedule.months
+    row['years'] = np.frombuffer(schedule.years.to_bytes(29, 'little'), dtype=np.uint8)
+    row['kind'] = _day_kind(schedule)
+    row['minute_count'], row['hour_count'] = len(minutes), len(hours)
+    row['minute_values'][0, :len(minutes)] = minutes
+    row['hour_values'][0, :len(hours)] = hours
+    return row.tobytes()
+
+
+def _bit_counts(values):
+    """ Returns the number of bits set in each value of an int64 array"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values).astype(np.int64)
+    values = np.ascontiguousarray(values, dtype=np.int64)
+    return np.unpackbits(values.view(np.uint8).reshape(values.shape + (8,)), axis=-1).sum(axis=-1, dtype=np.int64)
 
-    cron_expressions = ['4-10/3 0-4,6/6 * * ? *', '0 0-4,6/6 3W 4 ? *', '0 0 ? 5 6#3 *', '0 0 ? * 6#2 *', '30 0 ? 4-8 6#2 *', '30 0 ? * 6#2 2020-2022', '30 0 ? */2 6#2 2020-2022', '30 0 ? */2 ? 2020-2022', '30 0 ? */2 5 2020-2022', '30 0 ? */8 6#2 2020-2022', '30 0 ? */8 6#2 */94', '0 0 ? * 5 *', '0 0 ? * * *']
-    a = CronParser('0 0 ? * * *')
-    a.create_next_run_value()
 
-    print('Total time of execution is {0} seconds'.format(time.time() - _time))
\ No newline at end of file
+def _year_bits(years, year):
+    """ Returns the bits of the given years (offsets from 1970) in the rows of year masks"""
+    return (np.take_along_axis(years, year >> 3, axis=1) >> (year & 7)) & 1
+
+
+def _segment_starts(segments):
+    """ Returns the positions at which the values of a sorted array change, starting with 0"""
+    return np.flatnonzero(np.concatenate(([True], segments[1:] != segments[:-1]))) if len(segments) else segments
+
+
+def _batch_runs(rows, start, n):
+    """ Returns the next n runs at or after start of every schedule of a batch
+
+    All the schedules are evaluated together on a grid of (schedule, month): the days of each
+    month are looked up in _day_table by the kind of day fields of the schedule and the shape of
+    the month. The first pass looks at the BATCH_FIRST_MONTHS months from start for all the
+    schedules, and the ones that still need runs go on with their next allowed years, so a
+    sparse schedule doesn't make the others look at more months. The days of the months that
+    hold the next n runs are then expanded into run times from the hours and minutes
+
+    Arguments:
+    rows - NumPy array of _BATCH_DTYPE, one row per schedule
+    start - datetime (UTC) rounded up to the minute, between 1970 and 2199
+    n - Number of runs per schedule
+
+    Return:
+    A tuple of two arrays, the row of the schedule and the run time (minutes since 1970), sorted
+    by row and then by run time
+    """
+    table = _day_table()
+    count = len(rows)
+    dom = rows['dom'].astype(np.int64)
+    months = rows['months'].astype(np.int64)
+    kind = rows['kind'].astype(np.int64) * 28
+    years = rows['years']
+    minute_counts = rows['minute_count'].astype(np.int64)
+    per_day = minute_counts * rows['hour_count']
+    # Runs of the start day before the start time
+    hours = rows['hours'].astype(np.int64)
+    before = _bit_counts(hours & ((1 << start.hour) - 1)) * minute_counts + ((hours >> start.hour) & 1) * _bit_counts(rows['minutes'].astype(np.int64) & ((1 << start.minute) - 1))
+    month_count = len(_NP_MONTH_DAYS)
+    start_month = (start.year - FIELD_BOUNDS['Year'][0]) * 12 + start.month - 1
+
+    # First pass, the same months for every schedule
+    grid = start_month + np.arange(min(BATCH_FIRST_MONTHS, month_count - start_month))
+    year = np.broadcast_to(grid // 12, (count, len(grid)))
+    days = (dom[:, None] & _NP_MONTH_VALID[grid]) | table[kind[:, None] + _NP_MONTH_SHAPE[grid]]
+    days *= _year_bits(years, year) & ((months[:, None] >> (grid % 12)) & 1)
+    days[:, 0] &= -(1 << (start.day - 1))
+    runs = _bit_counts(days) * per_day[:, None]
+    runs[:, 0] -= ((days[:, 0] >> (start.day - 1)) & 1) * before
+    total = np.cumsum(runs, axis=1)
+    previous = total - runs
+    month_rows, month_cols = np.nonzero((previous < n) & (runs > 0))
+    selected = [(month_rows, grid[month_cols], days[month_rows, month_cols], previous[month_rows, month_cols])]
+
+    # Next passes, the next allowed years of the schedules still short of runs
+    active = np.flatnonzero(total[:, -1] < n)
+    done = total[active, -1]
+    position = np.full(len(active), start_month + BATCH_FIRST_MONTHS)
+    while len(active):
+        allowed_years = np.unpackbits(years[active], axis=1, bitorder='little')[:, :month_count // 12].astype(bool)
+        allowed_years &= np.arange(allowed_years.shape[1]) >= (position // 12)[:, None]
+        # Every allowed year has an allowed month, which has runs but for rare day fields
+        # (e.g. 31 in a month of 30 days), in which case the schedule goes on with a new pass
+        allowed_years &= np.cumsum(allowed_years, axis=1) <= (n - done)[:, None]
+        pair_rows, pair_years = np.nonzero(allowed_years)
+        grid = pair_years[:, None] * 12 + np.arange(12)
+        schedule_rows = active[pair_rows]
+        days = (dom[schedule_rows, None] & _NP_MONTH_VALID[grid]) | table[kind[schedule_rows, None] + _NP_MONTH_SHAPE[grid]]
+        days *= ((months[schedule_rows, None] >> np.arange(12)) & 1) & (grid >= position[pair_rows, None])
+        runs = _bit_counts(days) * per_day[schedule_rows, None]
+        # Runs of each schedule before each month, over all its years
+        flat_runs = runs.ravel()
+        cumulative = np.cumsum(flat_runs) - flat_runs
+        first = _segment_starts(pair_rows)
+        cell_rows = np.repeat(pair_rows, 12)
+        previous = (cumulative - np.repeat(cumulative[first * 12], np.diff(np.append(first, len(pair_rows))) * 12)).reshape(runs.shape) + done[pair_rows, None]
+        month_pairs, month_cols = np.nonzero((previous < n) & (runs > 0))
+        selected.append((schedule_rows[month_pairs], grid[month_pairs, month_cols], days[month_pairs, month_cols], previous[month_pairs, month_cols]))
+
+        done = done + np.bincount(cell_rows, weights=flat_runs, minlength=len(active)).astype(np.int64)
+        last_year = np.zeros(len(active), dtype=np.int64)
+        last_year[pair_rows] = pair_years
+        keep = (done < n) & (last_year > 0)
+        active, done, position = active[keep], done[keep], (last_year[keep] + 1) * 12
+
+    schedule_rows, month_index, day_masks, done = [np.concatenate(values) for values in zip(*selected)]
+    # Days of the selected months, in order within each month
+    owner, day = np.nonzero(np.unpackbits(day_masks.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')[:, :31])
+    day_number = _NP_MONTH_START[month_index[owner]] + day
+    schedule_rows = schedule_rows[owner]
+    skip = np.where((month_index[owner] == start_month) & (day == start.day - 1), before[schedule_rows], 0)
+    day_runs = per_day[schedule_rows] - skip
+    # Runs of the schedule before each day, from the runs before its month
+    cumulative = np.cumsum(day_runs) - day_runs
+    first = _segment_starts(owner)
+    earlier = done[owner] + cumulative - np.repeat(cumulative[first], np.diff(np.append(first, len(owner))))
+    taken = np.clip(n - earlier, 0, day_runs)
+
+    # The kth run of a day is at the (k // minutes)th hour and the (k % minutes)th minute
+    run_days = np.repeat(np.arange(len(taken)), taken)
+    index = np.arange(len(run_days)) - np.repeat(np.cumsum(taken) - taken, taken)
+    run_rows = schedule_rows[run_days]
+    index += skip[run_days]
+    counts = minute_counts[run_rows]
+    hour = rows['hour_values'][run_rows, index // counts].astype(np.int64)
+    minute = rows['minute_values'][run_rows, index % counts]
+    run = day_number[run_days] * 1440 + hour * 60 + minute
+    order = np.argsort(run_rows, kind='stable')
+    return (run_rows[order], run[order])
+
+
+def next_runs_batch(expressions, start=None, n=1):
+    """ Returns the next n run times of many cron expressions as one NumPy array
+
+    The expressions are compiled once into rows of field masks (kept in BATCH_ROW_CACHE) which
+    are evaluated together with NumPy, see _batch_runs, without a Python loop per expression or
+    per run. Expressions that compile to the same fields are evaluated once
+
+    Arguments:
+    expressions - Iterable of cron expressions (strings) or CronSchedule objects
+    start - datetime (UTC) from which the runs are evaluated, defaults to now. A run at start
+    itself is included
+    n - Number of runs per expression
+
+    Return:
+    A NumPy structured array with the fields index (position of the expression in the input)
+    and run (datetime64[m]), sorted by index and then by run time
+
+    Raises ImportError if numpy is not installed and ValueError if any expression is not valid
+    """
+    if np is None:
+        raise ImportError("numpy is required for next_runs_batch")
+    if start is None:
+        start = datetime.datetime.utcnow()
+    start = max(_ceil_minute(_utc_naive(start)), _EPOCH)
+    # Position of each distinct expression, then of each distinct row
+    positions = {}
+    inverse = [positions.setdefault(expression, len(positions)) for expression in expressions]
+    unique = {}
+    row_index = []
+    for index, expression in enumerate(positions):
+        row = BATCH_ROW_CACHE.get(expression)
+        if row is None:
+            try:
+                schedule = expression if isinstance(expression, CronSchedule) else CronParser.compile(expression)
+            except ValueError as e:
+                raise ValueError("Expression {0} at index {1} is not valid: {2}".format(expression, inverse.index(index), e))
+            row = _batch_row(schedule)
+            BATCH_ROW_CACHE.put(expression, row)
+        row_index.append(unique.setdefault(row, len(unique)))
+
+    result = np.zeros(0, dtype=[('index', np.int64), ('run', 'datetime64[m]')])
+    if not inverse or n < 1 or start.year > FIELD_BOUNDS['Year'][1]:
+        return result
+    rows, runs = _batch_runs(np.frombuffer(b''.join(unique), dtype=_BATCH_DTYPE), start, n)
+    # Runs of every expression, copied from the runs of its row
+    inverse = np.array(row_index)[inverse]
+    row_counts = np.bincount(rows, minlength=len(unique))
+    row_offsets = np.cumsum(row_counts) - row_counts
+    lengths = row_counts[inverse]
+    positions = np.repeat(row_offsets[inverse] - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    result = np.zeros(len(positions), dtype=result.dtype)
+    result['index'] = np.repeat(np.arange(len(inverse)), lengths)
+    result['run'] = runs[positions].view('datetime64[m]')
+    return result
+
+
+# Lines per chunk handed to a worker process and chunks in flight per worker, which bound the
+# memory used by the command line tool
+CLI_CHUNK_SIZE = 1000
+CLI_CHUNKS_PER_WORKER = 2
+
+# Results of evaluate_expression, rule exports repeat the same few expressions many times
+RESULT_CACHE = LRUCache(maxsize=4096)
+
+
+def evaluate_expression(expression, start, runs, tz=None):
+    """ Validates a schedule expression and evaluates its next runs
+
+    Arguments:
+    expression - cron(...), rate(...) or a bare cron expression
+    start - datetime (UTC) from which the runs are evaluated
+    runs - Number of runs to return
+    tz - Time zone the cron fields are matched in, defaults to UTC
+
+    Return:
+    A dict with the keys valid and either runs (ISO 8601 UTC times) or errors (a list of dicts
+    with the keys field, position and reason)
+    """
+    try:
+        schedule = Schedule.parse(expression, tz=tz)
+    except ValueError as e:
+        errors = []
+        if type(expression) is str and not expression.strip().upper().startswith('RATE('):
+            match = _CRON_RE.match(expression)
+            errors = validate(match.group(1) if match else expression)
+        if not errors:
+            errors = [CronError(None, 0, str(e))]
+        return {'valid': False, 'errors': [error._asdict() for error in errors]}
+    return {'valid': True, 'runs': [run.isoformat() for run in itertools.islice(schedule.iter_runs(start), runs)]}
+
+
+def _parse_line(line, number):
+    """ Returns the id and expression of an input line
+
+    A line is either a JSON object with the keys id and expression (or Name and
+    ScheduleExpression, as exported by aws events list-rules) or a plain expression, whose id
+    is its line number
+    """
+    if line.startswith('{'):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return (number, line)
+        if type(record) is dict:
+            return (record.get('id', record.get('Name', number)), record.get('expression', record.get('ScheduleExpression')))
+    return (number, line)
+
+
+def _evaluate_chunk(chunk, start, runs, tz):
+    """ Evaluates a list of (line number, line) tuples
+
+    Return:
+    A tuple of the output lines (JSON) and the number of invalid expressions
+    """
+    output = []
+    invalid = 0
+    for number, line in chunk:
+        identifier, expression = _parse_line(line, number)
+        key = (expression, start, runs, tz)
+        evaluated = RESULT_CACHE.get(key) if type(expression) is str else None
+        if evaluated is None:
+            evaluated = evaluate_expression(expression, start, runs, tz)
+            if type(expression) is str:
+                RESULT_CACHE.put(key, evaluated)
+        result = {'id': identifier, 'expression': expression}
+        result.update(evaluated)
+        invalid += not result['valid']
+        output.append(json.dumps(result))
+    return (output, invalid)
+
+
+def _chunks(lines, size):
+    """ Lazily groups the non blank input lines into lists of (line number, line) tuples"""
+    numbered = ((number, line.strip()) for number, line in enumerate(lines, 1) if line.strip())
+    while True:
+        chunk = list(itertools.islice(numbered, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run_cli(lines, out, start, runs=5, tz=None, workers=0, chunk_size=CLI_CHUNK_SIZE):
+    """ Streams input lines through evaluate_expression and writes one JSON line per expression
+
+    Only a bounded number of chunks is held at a time (one without workers, otherwise
+    CLI_CHUNKS_PER_WORKER per worker process), so memory use doesn't depend on the input size.
+    Output is written in input order
+
+    Arguments:
+    lines - Iterable of input lines, see _parse_line
+    out - File object the JSON lines are written to
+    start - datetime (UTC) from which the runs are evaluated
+    runs - Number of runs per expression
+    tz - Time zone the cron fields are matched in, defaults to UTC
+    workers - Number of worker processes, 0 evaluates in this process
+    chunk_size - Number of lines per chunk
+
+    Return:
+    A tuple of the number of expressions and the number of invalid ones
+    """
+    total = invalid = 0
+
+    def write(result):
+        nonlocal total, invalid
+        output, errors = result
+        out.write(''.join(line + '\n' for line in output))
+        total += len(output)
+        invalid += errors
+
+    if not workers:
+        for chunk in _chunks(lines, chunk_size):
+            write(_evaluate_chunk(chunk, start, runs, tz))
+        return (total, invalid)
+
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for chunk in _chunks(lines, chunk_size):
+            if len(pending) >= workers * CLI_CHUNKS_PER_WORKER:
+                write(pending.popleft().result())
+            pending.append(executor.submit(_evaluate_chunk, chunk, start, runs, tz))
+        while pending:
+            write(pending.popleft().result())
+    return (total, invalid)
+
+
+def main(argv=None):
+    """ Command line interface, see python awscronparser.py --help
+
+    Return:
+    Exit status, 0 if all the expressions are valid, 1 otherwise
+    """
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Validates schedule expressions (one per line, or JSON lines with id and expression) and prints their next runs as JSON lines')
+    parser.add_argument('input', nargs='?', default='-', help='Input file, defaults to stdin')
+    parser.add_argument('-o', '--output', default='-', help='Output file, defaults to stdout')
+    parser.add_argument('-n', '--runs', type=int, default=5, help='Number of runs per expression (default 5)')
+    parser.add_argument('--start', help='ISO 8601 time (UTC) from which the runs are evaluated, defaults to now')
+    parser.add_argument('--tz', help='Time zone the cron fields are matched in, defaults to UTC')
+    parser.add_argument('-w', '--workers', type=int, default=0, help='Number of worker processes (default 0, no workers)')
+    parser.add_argument('--chunk-size', type=int, default=CLI_CHUNK_SIZE, help='Lines per chunk handed to a worker (default {0})'.format(CLI_CHUNK_SIZE))
+    args = parser.parse_args(argv)
+
+    try:
+        start = _utc_naive(datetime.datetime.fromisoformat(args.start)) if args.start else datetime.datetime.utcnow()
+    except ValueError:
+        parser.error('Invalid start time {0}'.format(args.start))
+    if args.tz:
+        try:
+            zone_table(args.tz)
+        except (ValueError, ImportError) as e:
+            parser.error(str(e))
+
+    source = sys.stdin if args.input == '-' else open(args.input)
+    target = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        total, invalid = run_cli(source, target, start, args.runs, args.tz, args.workers, max(args.chunk_size, 1))
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if target is not sys.stdout:
+            target.close()
+    return 1 if invalid else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
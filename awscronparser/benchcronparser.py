@@ -0,0 +1,224 @@
+""" Benchmarks of awscronparser with regression thresholds
+
+Usage: python3 benchcronparser.py [--update] [--tolerance 0.25] [--baseline FILE] [benchmark ...]
+
+Each benchmark reports the best time per operation out of a few repeats. Baselines depend on the
+machine, so the times are only compared when a baseline file is given with --baseline, and the
+exit status is then 1 if any of them is slower than its baseline by more than the tolerance.
+Record a baseline with --update on the machine the benchmarks are run on, it's written to
+--baseline or benchcronparser_baseline.json
+"""
+
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+import awscronparser
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchcronparser_baseline.json')
+
+# Expressions the module used to be timed with, one of them ('30 0 ? */2 ? 2020-2022') is invalid
+CORPUS = ['4-10/3 0-4,6/6 * * ? *', '0 0-4,6/6 3W 4 ? *', '0 0 ? 5 6#3 *', '0 0 ? * 6#2 *', '30 0 ? 4-8 6#2 *', '30 0 ? * 6#2 2020-2022', '30 0 ? */2 6#2 2020-2022', '30 0 ? */2 ? 2020-2022', '30 0 ? */2 5 2020-2022', '30 0 ? */8 6#2 2020-2022', '30 0 ? */8 6#2 */94', '0 0 ? * 5 *', '0 0 ? * * *']
+
+START = datetime.datetime(2026, 5, 1, 4, 7, 30)
+
+
+def generate_expressions(count, seed=0):
+    """ Returns a list of random valid cron expressions, the same ones for the same seed"""
+    rng = random.Random(seed)
+    expressions = []
+    for _ in range(count):
+        minutes = rng.choice(['*', '0', '*/5', '15,45', '0-10/3', str(rng.randrange(60))])
+        hours = rng.choice(['*', '2', '0-4,6/6', '*/3', str(rng.randrange(24))])
+        if rng.random() < 0.5:
+            dom, dow = rng.choice(['*', '1', 'L', '15W', '1-10', str(rng.randrange(1, 29))]), '?'
+        else:
+            dom, dow = '?', rng.choice(['*', 'MON-FRI', '6#3', '2L', str(rng.randrange(1, 8))])
+        months = rng.choice(['*', '1-6', '*/2', 'JAN,JUL'])
+        years = rng.choice(['*', '2026', '2027-2030', '*/4'])
+        expressions.append(' '.join([minutes, hours, dom, months, dow, years]))
+    return expressions
+
+
+def _valid(expressions):
+    """ Returns the valid expressions of a list"""
+    return [expression for expression in expressions if not awscronparser.validate(expression)]
+
+
+EXPRESSIONS = CORPUS + generate_expressions(500)
+VALID = _valid(EXPRESSIONS)
+
+
+def bench_validate():
+    """ Validates the expressions, including the invalid ones"""
+    for expression in EXPRESSIONS:
+        awscronparser.validate(expression)
+    return len(EXPRESSIONS)
+
+
+def bench_compile():
+    """ Compiles the valid expressions, bypassing EXPRESSION_CACHE"""
+    for expression in VALID:
+        awscronparser.compile_schedule(expression)
+    return len(VALID)
+
+
+def bench_compile_cached():
+    """ Compiles the valid expressions through CronParser.compile (cache hits)"""
+    for expression in VALID:
+        awscronparser.CronParser.compile(expression)
+    return len(VALID)
+
+
+def bench_next_fire():
+    """ Finds the next run of every schedule"""
+    schedules = [awscronparser.CronParser.compile(expression) for expression in VALID]
+    for schedule in schedules:
+        schedule.next_fire(START)
+    return len(schedules)
+
+
+def bench_prev_fire():
+    """ Finds the previous run of every schedule"""
+    schedules = [awscronparser.CronParser.compile(expression) for expression in VALID]
+    for schedule in schedules:
+        schedule.prev_fire(START)
+    return len(schedules)
+
+
+def bench_iter_runs():
+    """ Enumerates the next 100 runs of every schedule, counted per run"""
+    schedules = [awscronparser.CronParser.compile(expression) for expression in VALID]
+    total = 0
+    for schedule in schedules:
+        total += sum(1 for _ in itertools.islice(schedule.iter_runs(START), 100))
+    return total
+
+
+def bench_count_runs():
+    """ Counts the runs of every schedule over a year"""
+    schedules = [awscronparser.CronParser.compile(expression) for expression in VALID]
+    end = START + datetime.timedelta(days=365)
+    for schedule in schedules:
+        schedule.count_runs(START, end)
+    return len(schedules)
+
+
+def bench_next_runs_batch():
+    """ Evaluates the next 10 runs of all the expressions at once, counted per run"""
+    return len(awscronparser.next_runs_batch(VALID, START, 10))
+
+
+def bench_next_runs_scalar():
+    """ Evaluates the next 10 runs of the expressions one at a time, counted per run, to compare
+    with next_runs_batch"""
+    total = 0
+    for expression in VALID:
+        total += len(list(itertools.islice(awscronparser.CronParser.compile(expression).iter_runs(START), 10)))
+    return total
+
+
+BENCHMARKS = {
+    'validate': bench_validate,
+    'compile': bench_compile,
+    'compile_cached': bench_compile_cached,
+    'next_fire': bench_next_fire,
+    'prev_fire': bench_prev_fire,
+    'iter_runs': bench_iter_runs,
+    'count_runs': bench_count_runs,
+    'next_runs_batch': bench_next_runs_batch,
+    'next_runs_scalar': bench_next_runs_scalar}
+
+
+def measure(function, repeat=5, min_time=0.2):
+    """ Returns the best time per operation of a benchmark function in seconds
+
+    The function returns the number of operations it did. It's called repeatedly until min_time
+    has passed, and that is repeated repeat times
+    """
+    best = None
+    for _ in range(repeat):
+        operations = 0
+        started = time.perf_counter()
+        elapsed = 0
+        while elapsed < min_time:
+            operations += function()
+            elapsed = time.perf_counter() - started
+        per_operation = elapsed / operations
+        best = per_operation if best is None else min(best, per_operation)
+    return best
+
+
+def compare(results, baseline, tolerance):
+    """ Returns the names of the benchmarks slower than their baseline by more than the tolerance
+
+    Arguments:
+    results - Dict of benchmark name to seconds per operation
+    baseline - Dict of benchmark name to seconds per operation
+    tolerance - Allowed slowdown as a fraction e.g. 0.25 for 25%
+    """
+    return [name for name, seconds in results.items() if name in baseline and seconds > baseline[name] * (1 + tolerance)]
+
+
+def main(argv=None):
+    """ Command line interface, see python3 benchcronparser.py --help
+
+    Return:
+    Exit status, 1 if a benchmark regressed against the --baseline file
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmarks awscronparser and compares the results with a baseline')
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run, defaults to all: {0}'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--baseline', help='Baseline file to compare the results with, nothing is compared without it')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown over the baseline as a fraction (default 0.25)')
+    parser.add_argument('--update', action='store_true', help='Write the results to the baseline file (default {0})'.format(os.path.basename(BASELINE_FILE)))
+    args = parser.parse_args(argv)
+
+    names = args.benchmarks or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('Unknown benchmarks {0}'.format(', '.join(unknown)))
+    if 'next_runs_batch' in names and awscronparser.np is None:
+        print('Skipping next_runs_batch, numpy is not installed')
+        names.remove('next_runs_batch')
+
+    baseline_file = args.baseline or BASELINE_FILE
+    if args.baseline and not args.update and not os.path.exists(args.baseline):
+        parser.error('Baseline file {0} not found'.format(args.baseline))
+    baseline = {}
+    if (args.baseline or args.update) and os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            baseline = json.load(f)['benchmarks']
+
+    results = {}
+    for name in names:
+        results[name] = measure(BENCHMARKS[name])
+        change = ''
+        if name in baseline:
+            change = '{0:+.1%}'.format(results[name] / baseline[name] - 1)
+        print('{0:<16} {1:>10.2f} us/op {2:>8}'.format(name, results[name] * 1e6, change))
+
+    if args.update:
+        baseline.update(results)
+        with open(baseline_file, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'benchmarks': baseline}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Baseline written to {0}'.format(baseline_file))
+        return 0
+
+    if not args.baseline:
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print('Slower than the baseline by more than {0:.0%}: {1}'.format(args.tolerance, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
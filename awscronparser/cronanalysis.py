@@ -0,0 +1,297 @@
+""" Analysis of many cron schedules at once, built on the compiled schedules of awscronparser
+
+ScheduleIndex answers which rules run at a given minute without evaluating every schedule. Each
+rule gets a bit in a set of integer bitsets, one per minute of the hour, hour of the day, month
+and year. The rules running at a time are the AND of the bitsets for its minute, hour and
+month, and the rules whose day fields match the date. The day fields are only resolved per
+distinct day field (not per rule) when a date is first looked at, and the result is cached
+
+merge_runs, iter_collisions and overlap_report look at the run times of many schedules (cron,
+rate or time zone) in a window by merging their lazy run streams in time order with
+heapq.merge. Only the runs within the collision gap are held at a time, so a year long window
+over thousands of rules runs in bounded memory
+"""
+
+import collections
+import datetime
+import heapq
+
+import awscronparser
+
+# Two runs of different rules within the gap of each other. second_run - first_run is 0 for a
+# collision (same minute) and up to the gap for a near collision
+Collision = collections.namedtuple('Collision', ['first', 'second', 'first_run', 'second_run'])
+
+
+class ScheduleIndex():
+    """ Reverse index from the minutes of a day to the rules that run in them"""
+
+    def __init__(self, rules=None):
+        """ Arguments:
+        rules - Optional dict or iterable of (rule id, schedule) pairs, see add
+        """
+        self.rule_ids = []
+        self.schedules = []
+        self.minutes = [0] * 60
+        self.hours = [0] * 24
+        self.months = [0] * 12
+        # Rules per distinct day field, with one of the schedules to resolve the days from
+        self._day_groups = {}
+        self._year_cache = {}
+        self._date_cache = awscronparser.LRUCache(maxsize=400)
+        if rules is not None:
+            for rule_id, schedule in (rules.items() if isinstance(rules, dict) else rules):
+                self.add(rule_id, schedule)
+
+    def __len__(self):
+        return len(self.rule_ids)
+
+    def add(self, rule_id, schedule):
+        """ Adds a rule to the index
+
+        Arguments:
+        rule_id - Any value identifying the rule (e.g. the rule name)
+        schedule - Cron expression, CronParser or CronSchedule object. Time zone and rate
+        schedules aren't supported, their runs don't fall on fixed UTC minutes
+
+        Raises ValueError if the schedule is not valid
+        """
+        if type(schedule) is str:
+            schedule = awscronparser.CronParser.compile(schedule)
+        elif isinstance(schedule, awscronparser.CronParser):
+            if schedule.tz is not None:
+                raise ValueError("Schedules in a time zone can't be indexed")
+            schedule = schedule.schedule
+        if not isinstance(schedule, awscronparser.CronSchedule):
+            raise ValueError("Only cron schedules can be indexed and not {0}".format(type(schedule)))
+        bit = 1 << len(self.rule_ids)
+        self.rule_ids.append(rule_id)
+        self.schedules.append(schedule)
+        for minute in awscronparser._iter_mask(schedule.minutes):
+            self.minutes[minute] |= bit
+        for hour in awscronparser._iter_mask(schedule.hours):
+            self.hours[hour] |= bit
+        for month in awscronparser._iter_mask(schedule.months):
+            self.months[month] |= bit
+        group = self._day_groups.get(schedule._day_key)
+        self._day_groups[schedule._day_key] = (group[0] | bit, group[1]) if group else (bit, schedule)
+        self._year_cache.clear()
+        self._date_cache.clear()
+
+    def _ids(self, rules):
+        """ Returns the ids of the rules in a bitset, in the order they were added"""
+        return [self.rule_ids[index] for index in awscronparser._iter_mask(rules)]
+
+    def _year_rules(self, year):
+        """ Returns the bitset of the rules whose Year field allows the year"""
+        rules = self._year_cache.get(year)
+        if rules is None:
+            rules = 0
+            shift = year - awscronparser.FIELD_BOUNDS['Year'][0]
+            if shift >= 0:
+                for index, schedule in enumerate(self.schedules):
+                    if schedule.years >> shift & 1:
+                        rules |= 1 << index
+            self._year_cache[year] = rules
+        return rules
+
+    def rules_on(self, date):
+        """ Returns the bitset of the rules that run on the given date (any time of the day)"""
+        key = (date.year, date.month, date.day)
+        rules = self._date_cache.get(key)
+        if rules is None:
+            rules = 0
+            candidates = self._year_rules(date.year) & self.months[date.month - 1]
+            if candidates:
+                for group, schedule in self._day_groups.values():
+                    if group & candidates and schedule.days_mask(date.year, date.month) >> (date.day - 1) & 1:
+                        rules |= group
+                rules &= candidates
+            self._date_cache.put(key, rules)
+        return rules
+
+    def rules_firing_at(self, value):
+        """ Returns the ids of the rules that run at the given time (UTC, minute resolution)"""
+        value = awscronparser._utc_naive(value)
+        rules = self.hours[value.hour] & self.minutes[value.minute]
+        if rules:
+            rules &= self.rules_on(value)
+        return self._ids(rules)
+
+    def rules_firing_between(self, start, end):
+        """ Lazily yields the minutes in [start, end) (UTC) in which rules run
+
+        Return:
+        A generator of (datetime, list of rule ids) tuples in ascending order of time
+        """
+        minute = awscronparser._ceil_minute(awscronparser._utc_naive(start))
+        end = awscronparser._utc_naive(end)
+        while minute < end:
+            day = datetime.datetime(minute.year, minute.month, minute.day)
+            daily = self.rules_on(day)
+            if daily:
+                for hour in range(minute.hour, 24):
+                    hourly = self.hours[hour] & daily
+                    if not hourly:
+                        continue
+                    for value in range(minute.minute if hour == minute.hour else 0, 60):
+                        rules = self.minutes[value] & hourly
+                        if rules:
+                            run = day + datetime.timedelta(hours=hour, minutes=value)
+                            if run >= end:
+                                return
+                            yield (run, self._ids(rules))
+            minute = day + datetime.timedelta(days=1)
+
+    def histogram(self, date):
+        """ Returns the number of rules running in each minute of the given date (UTC)
+
+        Return:
+        A list of 1440 integers, index hour * 60 + minute
+        """
+        counts = [0] * 1440
+        daily = self.rules_on(date)
+        if daily:
+            for hour in range(24):
+                hourly = self.hours[hour] & daily
+                if hourly:
+                    for minute in range(60):
+                        counts[hour * 60 + minute] = awscronparser._popcount(self.minutes[minute] & hourly)
+        return counts
+
+    def busiest_minutes(self, date, top=10):
+        """ Returns the minutes of the given date (UTC) in which the most rules run
+
+        Arguments:
+        date - date or datetime
+        top - Number of minutes to return
+
+        Return:
+        A list of (datetime, number of rules) tuples, busiest first (earliest first on ties).
+        Minutes in which no rules run are left out
+        """
+        day = datetime.datetime(date.year, date.month, date.day)
+        counts = self.histogram(day)
+        busiest = sorted((index for index in range(1440) if counts[index]), key=lambda index: -counts[index])[:top]
+        return [(day + datetime.timedelta(minutes=index), counts[index]) for index in busiest]
+
+
+def _schedules(rules):
+    """ Returns a list of (rule id, compiled schedule) from a dict or iterable of pairs whose
+    schedules are expressions (cron(...), rate(...) or a bare cron expression), CronParser
+    objects or compiled schedules"""
+    compiled = []
+    for rule_id, schedule in (rules.items() if isinstance(rules, dict) else rules):
+        if type(schedule) is str:
+            schedule = awscronparser.Schedule.parse(schedule)
+        compiled.append((rule_id, schedule))
+    return compiled
+
+
+def _rule_runs(index, rule_id, schedule, start, end):
+    """ Lazily yields the runs of one rule in [start, end) as ((run, index), rule id), so that
+    heapq.merge orders on the run and the rule's position and never compares the rule ids"""
+    for run in schedule.iter_runs(start):
+        if run >= end:
+            return
+        yield ((run, index), rule_id)
+
+
+def merge_runs(rules, start, end):
+    """ Lazily yields the runs of all the rules in [start, end) (UTC) in time order
+
+    Arguments:
+    rules - Dict or iterable of (rule id, schedule) pairs, see _schedules
+    start - datetime (UTC), start of the window
+    end - datetime (UTC), end of the window
+
+    Return:
+    A generator of (run, rule id) tuples. Runs at the same time are ordered by the position of
+    the rule in rules
+    """
+    start = awscronparser._utc_naive(start)
+    end = awscronparser._utc_naive(end)
+    streams = [_rule_runs(index, rule_id, schedule, start, end) for index, (rule_id, schedule) in enumerate(_schedules(rules))]
+    for (run, _), rule_id in heapq.merge(*streams):
+        yield (run, rule_id)
+
+
+def iter_collisions(rules, start, end, gap=datetime.timedelta(0)):
+    """ Lazily yields the pairs of runs of different rules within the gap of each other
+
+    Arguments:
+    rules - Dict or iterable of (rule id, schedule) pairs, see _schedules
+    start - datetime (UTC), start of the window
+    end - datetime (UTC), end of the window
+    gap - Largest time between two runs reported as a near collision, defaults to 0 (only runs
+    in the same minute)
+
+    Return:
+    A generator of Collision tuples, ordered by second_run
+    """
+    recent = collections.deque()
+    for run, rule_id in merge_runs(rules, start, end):
+        while recent and run - recent[0][0] > gap:
+            recent.popleft()
+        for earlier, other in recent:
+            if other != rule_id:
+                yield Collision(other, rule_id, earlier, run)
+        recent.append((run, rule_id))
+
+
+def overlap_report(rules, start, end, gap=datetime.timedelta(0), duration=datetime.timedelta(minutes=1), pairs=False):
+    """ Summarises the collisions and the concurrency of many rules in a window, in one pass
+
+    Arguments:
+    rules - Dict or iterable of (rule id, schedule) pairs, see _schedules
+    start - datetime (UTC), start of the window
+    end - datetime (UTC), end of the window
+    gap - Largest time between two runs counted as a near collision, defaults to 0
+    duration - How long each run is taken to last for the concurrency, defaults to a minute (so
+    the concurrency is the number of rules running in the same minute)
+    pairs - Also count the collisions per pair of rules. This costs time proportional to the
+    number of colliding pairs instead of the number of runs
+
+    Return:
+    A dict with the keys:
+    runs - Number of runs in the window
+    collisions - Number of pairs of runs of different rules in the same minute
+    near_collisions - Number of other pairs of runs of different rules at most gap apart
+    pairs - collections.Counter of (rule id, rule id) to the number of (near) collisions, only
+    if pairs is True
+    peak_concurrency - Largest number of runs in progress at the same time
+    peak_at - First time the peak was reached, None if there are no runs
+    """
+    report = {'runs': 0, 'collisions': 0, 'near_collisions': 0, 'peak_concurrency': 0, 'peak_at': None}
+    if pairs:
+        report['pairs'] = collections.Counter()
+    # Runs within the gap of the current one and the number of them per rule
+    recent = collections.deque()
+    recent_rules = collections.Counter()
+    same_minute = 0
+    # End times of the runs in progress, in ascending order as every run lasts the same time
+    running = collections.deque()
+    for run, rule_id in merge_runs(rules, start, end):
+        report['runs'] += 1
+        while recent and run - recent[0][0] > gap:
+            recent_rules[recent.popleft()[1]] -= 1
+        if recent and recent[-1][0] == run:
+            same_minute += 1
+        else:
+            same_minute = 0
+        # A rule runs at most once a minute, so its own runs in the window are all earlier ones
+        report['collisions'] += same_minute
+        report['near_collisions'] += len(recent) - same_minute - recent_rules[rule_id]
+        if pairs:
+            for earlier, other in recent:
+                if other != rule_id:
+                    report['pairs'][(other, rule_id)] += 1
+        recent.append((run, rule_id))
+        recent_rules[rule_id] += 1
+        while running and running[0] <= run:
+            running.popleft()
+        running.append(run + duration)
+        if len(running) > report['peak_concurrency']:
+            report['peak_concurrency'] = len(running)
+            report['peak_at'] = run
+    return report
@@ -0,0 +1,226 @@
+""" In-process scheduler for many cron/rate jobs, e.g. the aws-auto-start-stop scripts
+
+Usage: python3 scheduler.py <jobs file> [--workers N]
+
+Every line of the jobs file is a schedule expression followed by the command to run:
+
+    cron(0 8 ? * MON-FRI *) python3 startEC2Instance.py us-east-1 Schedule office-hours <topicArn>
+    0 20 ? * MON-FRI * python3 stopEC2Instances.py us-east-1 Schedule office-hours <topicArn>
+    rate(30 minutes) python3 getEC2InstanceName.py
+
+The next run of every job is kept in a min-heap, so the scheduler sleeps until the earliest run
+and each run costs O(log n) heap work irrespective of the number of jobs. Commands are run by a
+thread pool so a slow job doesn't delay the others
+"""
+
+import concurrent.futures
+import datetime
+import heapq
+import itertools
+import logging
+import shlex
+import subprocess
+import threading
+
+import awscronparser
+
+logger = logging.getLogger(__name__)
+
+
+class Job():
+    """ A schedule and the action run on it"""
+
+    def __init__(self, name, schedule, action):
+        """ Arguments:
+        name - Name of the job, used in the log messages
+        schedule - Compiled schedule (CronSchedule, ZonedSchedule or RateSchedule)
+        action - Callable taking the run time (datetime, UTC) as its only argument
+        """
+        self.name = name
+        self.schedule = schedule
+        self.action = action
+
+    def __repr__(self):
+        return 'Job({0!r}, {1!r})'.format(self.name, self.schedule)
+
+
+def command_action(argv, cwd=None, timeout=None):
+    """ Returns an action that runs a command, e.g. one of the aws-auto-start-stop scripts
+
+    Arguments:
+    argv - List of the program and its arguments
+    cwd - Working directory of the command
+    timeout - Seconds after which the command is killed, defaults to no limit
+
+    Return:
+    A callable returning the exit status of the command
+    """
+    def run(when):
+        logger.info('Running {0} for {1}'.format(argv, when))
+        try:
+            result = subprocess.run(argv, cwd=cwd, timeout=timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error('Command {0} failed: {1}'.format(argv, e))
+            return None
+        if result.returncode:
+            logger.error('Command {0} exited with status {1}'.format(argv, result.returncode))
+        return result.returncode
+    return run
+
+
+def parse_job_line(line, cwd=None, tz=None):
+    """ Parses a line of a jobs file into a Job, see the module docstring for the format
+
+    Return:
+    Job object, None for blank lines and comments (#)
+
+    Raises ValueError if the schedule expression or the command is not valid
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if line.lower().startswith(('cron(', 'rate(')):
+        end = line.find(')')
+        if end < 0:
+            raise ValueError('Unterminated schedule expression in {0}'.format(line))
+        expression, command = line[:end + 1], line[end + 1:]
+    else:
+        fields = line.split(None, len(awscronparser.FIELDS))
+        expression = ' '.join(fields[:len(awscronparser.FIELDS)])
+        command = fields[len(awscronparser.FIELDS)] if len(fields) > len(awscronparser.FIELDS) else ''
+    argv = shlex.split(command)
+    if not argv:
+        raise ValueError('No command given in {0}'.format(line))
+    return Job(line, awscronparser.Schedule.parse(expression, tz=tz), command_action(argv, cwd))
+
+
+class Scheduler():
+    """ Runs jobs at their scheduled times from a min-heap of (next run, job)
+
+    Runs are dispatched at minute resolution. If the scheduler falls behind (e.g. the machine
+    was suspended) the runs missed in between are coalesced into the one dispatched late, the
+    same as a cron daemon
+    """
+
+    def __init__(self, workers=4, clock=None):
+        """ Arguments:
+        workers - Number of threads running the actions
+        clock - Function returning the current time (naive datetime, UTC), for tests. Defaults
+        to datetime.datetime.utcnow
+        """
+        self.clock = clock or datetime.datetime.utcnow
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._heap = []
+        # Ties in the heap are broken by the order the jobs were added
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        # Set to wake up the run loop, when stopping or when a job runs before the current wait
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, job, start=None):
+        """ Adds a job, which first runs at its first run time at or after start
+
+        Arguments:
+        job - Job object
+        start - datetime (UTC), defaults to now
+        """
+        run = next(iter(job.schedule.iter_runs(start if start is not None else self.clock())), None)
+        if run is None:
+            logger.info('Job {0} has no more runs'.format(job.name))
+            return
+        with self._lock:
+            earliest = self._heap[0][0] if self._heap else None
+            heapq.heappush(self._heap, (run, next(self._counter), job))
+        if earliest is None or run < earliest:
+            self._wakeup.set()
+
+    def next_run(self):
+        """ Returns the earliest run time of all the jobs, None if there are no jobs"""
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def run_pending(self):
+        """ Dispatches the jobs that are due to the thread pool and reschedules them
+
+        Return:
+        A list of the futures of the dispatched actions
+        """
+        futures = []
+        now = self.clock()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                run, _, job = self._heap[0]
+                futures.append(self.executor.submit(self._dispatch, job, run))
+                following = job.schedule.next_fire(max(run, now))
+                if following is None:
+                    logger.info('Job {0} has no more runs'.format(job.name))
+                    heapq.heappop(self._heap)
+                else:
+                    heapq.heapreplace(self._heap, (following, next(self._counter), job))
+        return futures
+
+    def _dispatch(self, job, run):
+        """ Runs the action of a job, logging instead of raising errors"""
+        try:
+            return job.action(run)
+        except Exception as e:
+            logger.error('Job {0} failed for {1}'.format(job.name, run))
+            logger.error(e)
+
+    def run(self):
+        """ Runs the jobs until stop is called. Blocks the calling thread"""
+        while not self._stopped:
+            self.run_pending()
+            following = self.next_run()
+            timeout = None if following is None else max((following - self.clock()).total_seconds(), 0)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def stop(self, wait=True):
+        """ Stops the run loop and the thread pool
+
+        Arguments:
+        wait - Wait for the running actions to finish
+        """
+        self._stopped = True
+        self._wakeup.set()
+        self.executor.shutdown(wait=wait)
+
+
+def main(argv=None):
+    """ Command line interface, see python3 scheduler.py --help"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Runs the commands of a jobs file on their cron/rate schedules')
+    parser.add_argument('jobs', help='Jobs file, one "<schedule expression> <command>" per line')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Number of commands run at the same time (default 4)')
+    parser.add_argument('--cwd', help='Working directory of the commands, defaults to the current directory')
+    parser.add_argument('--tz', help='Time zone the cron fields are matched in, defaults to UTC')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    scheduler = Scheduler(workers=args.workers)
+    with open(args.jobs) as f:
+        for number, line in enumerate(f, 1):
+            try:
+                job = parse_job_line(line, args.cwd, args.tz)
+            except ValueError as e:
+                parser.error('Line {0}: {1}'.format(number, e))
+            if job is not None:
+                scheduler.add(job)
+    logger.info('Scheduled {0} jobs, first run at {1}'.format(len(scheduler), scheduler.next_run()))
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        logger.info('Stopping')
+    finally:
+        scheduler.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
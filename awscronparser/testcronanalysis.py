@@ -0,0 +1,67 @@
+import unittest
+import awscronparser
+import cronanalysis
+import datetime
+
+
+class TestScheduleIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = cronanalysis.ScheduleIndex([
+            ('stop-ec2', '0 2 ? * MON-FRI *'),
+            ('ami-backup', '0 2 L * ? *'),
+            ('site24x7', '*/30 * * * ? *'),
+            ('start-ec2', awscronparser.CronParser('0 8 ? * MON-FRI *'))])
+
+    def test_rules_firing_at(self):
+        # Friday 29 May 2026
+        self.assertEqual(self.index.rules_firing_at(datetime.datetime(2026, 5, 29, 2, 0)), ['stop-ec2', 'site24x7'])
+        # Sunday 31 May 2026
+        self.assertEqual(self.index.rules_firing_at(datetime.datetime(2026, 5, 31, 2, 0)), ['ami-backup', 'site24x7'])
+        self.assertEqual(self.index.rules_firing_at(datetime.datetime(2026, 5, 31, 2, 1)), [])
+
+    def test_rules_firing_between(self):
+        runs = list(self.index.rules_firing_between(datetime.datetime(2026, 5, 29, 7, 45), datetime.datetime(2026, 5, 29, 9, 0)))
+        self.assertEqual(runs, [
+            (datetime.datetime(2026, 5, 29, 8, 0), ['site24x7', 'start-ec2']),
+            (datetime.datetime(2026, 5, 29, 8, 30), ['site24x7'])])
+
+    def test_busiest_minutes(self):
+        self.assertEqual(self.index.busiest_minutes(datetime.date(2026, 5, 29), 2), [(datetime.datetime(2026, 5, 29, 2, 0), 2), (datetime.datetime(2026, 5, 29, 8, 0), 2)])
+        self.assertEqual(sum(self.index.histogram(datetime.date(2026, 5, 30))), 48)
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, self.index.add, 'rate', awscronparser.Schedule.parse('rate(5 minutes)'))
+
+
+class TestOverlap(unittest.TestCase):
+
+    rules = [
+        ('stop-ec2', '0 20 ? * MON-FRI *'),
+        ('ami-backup', 'cron(2 20 * * ? *)'),
+        ('stop-rds', awscronparser.CronParser('0 20 ? * MON-FRI *')),
+        ('poll', 'rate(1 hour)')]
+    start = datetime.datetime(2026, 5, 29)
+    end = datetime.datetime(2026, 5, 30)
+
+    def test_merge_runs(self):
+        runs = [run for run in cronanalysis.merge_runs(self.rules, self.start, self.end) if run[0].hour == 20]
+        self.assertEqual(runs, [
+            (datetime.datetime(2026, 5, 29, 20, 0), 'stop-ec2'),
+            (datetime.datetime(2026, 5, 29, 20, 0), 'stop-rds'),
+            (datetime.datetime(2026, 5, 29, 20, 0), 'poll'),
+            (datetime.datetime(2026, 5, 29, 20, 2), 'ami-backup')])
+
+    def test_collisions(self):
+        collisions = list(cronanalysis.iter_collisions(self.rules, self.start, self.end, gap=datetime.timedelta(minutes=5)))
+        self.assertEqual([(c.first, c.second) for c in collisions], [('stop-ec2', 'stop-rds'), ('stop-ec2', 'poll'), ('stop-rds', 'poll'), ('stop-ec2', 'ami-backup'), ('stop-rds', 'ami-backup'), ('poll', 'ami-backup')])
+
+    def test_overlap_report(self):
+        report = cronanalysis.overlap_report(self.rules, self.start, self.end, gap=datetime.timedelta(minutes=5), duration=datetime.timedelta(minutes=3), pairs=True)
+        self.assertEqual((report['runs'], report['collisions'], report['near_collisions']), (27, 3, 3))
+        self.assertEqual((report['peak_concurrency'], report['peak_at']), (4, datetime.datetime(2026, 5, 29, 20, 2)))
+        self.assertEqual(report['pairs'][('stop-ec2', 'ami-backup')], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
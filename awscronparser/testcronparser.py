@@ -1,19 +1,370 @@
 import unittest
 import awscronparser
 import datetime
+import itertools
 import calendar
+import copy
+import io
+import json
+import os
+import pickle
+import tempfile
 
 class TestDomParser(unittest.TestCase):
 
     def test_start_value(self):
-        f = awscronparser.CronParser('0 0 * * 4 *')
-        g = f.dom_parser('*')
-        self.assertEqual(g, list(range(datetime.datetime.utcnow().day), [x for x in calendar.monthcalendar(year[0], month[0])[-1] if x != 0][-1]))
+        f = awscronparser.CronParser('0 0 * * ? *')
+        now = datetime.datetime.utcnow()
+        g = f.dom_parser(now.month, now.year)
+        self.assertEqual(g, list(range(1, calendar.monthrange(now.year, now.month)[1] + 1)))
 
     def test_int_range_value(self):
         f = awscronparser.CronParser('0 0 4-6 * ? *')
-        g = f.dom_parser('4-6')
-        self.assertEqual(g, [[4, 5, 6]])
+        g = f.dom_parser(5, 2026)
+        self.assertEqual(g, [4, 5, 6])
+
+
+class TestCompileSchedule(unittest.TestCase):
+
+    def test_field_masks(self):
+        s = awscronparser.compile_schedule('4-10/3 0-4,6/6 * * ? *')
+        self.assertEqual(s.minutes, (1 << 4) | (1 << 7) | (1 << 10))
+        self.assertEqual(s.hours, 0b1000001000001011111)
+        self.assertEqual(s.months, (1 << 12) - 1)
+        self.assertEqual(s.dow, 0)
+
+    def test_names(self):
+        s = awscronparser.compile_schedule('0 8 ? JAN-MAR MON-FRI *')
+        self.assertEqual(s.months, 0b111)
+        self.assertEqual(s.dow, 0b0111110)
+
+    def test_nth_weekday(self):
+        s = awscronparser.compile_schedule('0 0 ? 5 6#3 *')
+        # 3rd Friday of May 2026
+        self.assertEqual(s.days_mask(2026, 5), 1 << 14)
+
+    def test_nearest_weekday(self):
+        s = awscronparser.compile_schedule('0 0 1W * ? *')
+        # 1st of August 2026 is a Saturday, nearest weekday in the month is Monday the 3rd
+        self.assertEqual(s.days_mask(2026, 8), 1 << 2)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, awscronparser.compile_schedule, '0 0 * * 4 *')
+        self.assertRaises(ValueError, awscronparser.compile_schedule, '60 0 * * ? *')
+
+
+class TestIterRuns(unittest.TestCase):
+
+    def test_next_runs(self):
+        f = awscronparser.CronParser('0 0 ? * * *')
+        runs = list(itertools.islice(f.iter_runs(datetime.datetime(2026, 12, 30, 0, 0)), 3))
+        self.assertEqual(runs, [datetime.datetime(2026, 12, 30), datetime.datetime(2026, 12, 31), datetime.datetime(2027, 1, 1)])
+
+    def test_start_rounded_up(self):
+        f = awscronparser.CronParser('4-10/3 0-4,6/6 * * ? *')
+        runs = list(itertools.islice(f.iter_runs(datetime.datetime(2026, 5, 1, 4, 7, 30)), 3))
+        self.assertEqual(runs, [datetime.datetime(2026, 5, 1, 4, 10), datetime.datetime(2026, 5, 1, 6, 4), datetime.datetime(2026, 5, 1, 6, 7)])
+
+    def test_open_ended_year(self):
+        f = awscronparser.CronParser('30 0 ? */8 6#2 */94')
+        runs = list(f.iter_runs(datetime.datetime(2026, 1, 1)))
+        self.assertEqual(runs, [datetime.datetime(2064, 1, 11, 0, 30), datetime.datetime(2064, 9, 12, 0, 30), datetime.datetime(2158, 1, 13, 0, 30), datetime.datetime(2158, 9, 8, 0, 30)])
+
+
+class TestNextFire(unittest.TestCase):
+
+    def test_carry_into_year(self):
+        f = awscronparser.CronParser('30 0 ? */8 6#2 *')
+        self.assertEqual(f.next_fire(datetime.datetime(2026, 9, 12, 0, 30)), datetime.datetime(2027, 1, 8, 0, 30))
+
+    def test_strictly_after(self):
+        f = awscronparser.CronParser('0 8 ? * MON-FRI *')
+        # Friday 8:00 -> Monday 8:00
+        self.assertEqual(f.next_fire(datetime.datetime(2026, 5, 1, 8, 0)), datetime.datetime(2026, 5, 4, 8, 0))
+
+    def test_matches_iter_runs(self):
+        f = awscronparser.CronParser('4-10/3 0-4,6/6 L * ? *')
+        after = datetime.datetime(2026, 1, 31, 18, 10)
+        self.assertEqual(f.next_fire(after), next(f.iter_runs(after + datetime.timedelta(minutes=1))))
+
+    def test_no_more_runs(self):
+        f = awscronparser.CronParser('0 0 ? * 6#2 2020-2022')
+        self.assertIsNone(f.next_fire(datetime.datetime(2023, 1, 1)))
+
+
+class TestPrevFire(unittest.TestCase):
+
+    def test_borrow_from_year(self):
+        f = awscronparser.CronParser('30 0 ? */8 6#2 *')
+        self.assertEqual(f.prev_fire(datetime.datetime(2027, 1, 8, 0, 30)), datetime.datetime(2026, 9, 11, 0, 30))
+
+    def test_strictly_before(self):
+        f = awscronparser.CronParser('0 8 ? * MON-FRI *')
+        self.assertEqual(f.prev_fire(datetime.datetime(2026, 5, 4, 8, 0)), datetime.datetime(2026, 5, 1, 8, 0))
+        self.assertEqual(f.prev_fire(datetime.datetime(2026, 5, 4, 8, 0, 1)), datetime.datetime(2026, 5, 4, 8, 0))
+
+    def test_no_earlier_runs(self):
+        self.assertIsNone(awscronparser.CronParser('0 0 ? * 6#2 2020-2022').prev_fire(datetime.datetime(2020, 1, 1)))
+
+    def test_missed_runs(self):
+        f = awscronparser.CronParser('0 */2 * * ? *')
+        executed = [datetime.datetime(2026, 5, 1, 6, 0), datetime.datetime(2026, 5, 1, 0, 0, 5), datetime.datetime(2026, 5, 1, 2, 0, 59), datetime.datetime(2026, 5, 1, 10, 0, 30)]
+        self.assertEqual(f.missed_runs(datetime.datetime(2026, 5, 1), datetime.datetime(2026, 5, 1, 12), executed), [datetime.datetime(2026, 5, 1, 4, 0), datetime.datetime(2026, 5, 1, 8, 0)])
+
+
+class TestDaysCache(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        awscronparser.DAYS_CACHE.clear()
+        s = awscronparser.compile_schedule('0 0 ? * 6#2 *')
+        s.days_mask(2026, 5)
+        s.days_mask(2026, 5)
+        # Same day fields share the cached entry
+        awscronparser.compile_schedule('30 6 ? 5 6#2 *').days_mask(2026, 5)
+        self.assertEqual(awscronparser.DAYS_CACHE.info(), {'hits': 2, 'misses': 1, 'size': 1, 'maxsize': 4096})
+
+    def test_bounded(self):
+        cache = awscronparser.LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(len(cache), 2)
+
+
+class TestCalendarTable(unittest.TestCase):
+
+    def monthrange(self, year, month):
+        # calendar weekdays start with MON - 0, the table's with SUN - 0
+        weekday, days = calendar.monthrange(year, month)
+        return ((weekday + 1) % 7, days)
+
+    def test_month_info(self):
+        for year in range(1970, 2200):
+            for month in range(1, 13):
+                self.assertEqual(awscronparser._month_info(year, month), self.monthrange(year, month))
+
+    def test_outside_the_table(self):
+        for year, month in ((1969, 12), (1900, 2), (2200, 1), (2400, 2)):
+            self.assertEqual(awscronparser._month_info(year, month), self.monthrange(year, month))
+
+    def test_build_calendar_table(self):
+        first_weekday, month_days = awscronparser._build_calendar_table(1899, 1901)
+        self.assertEqual(len(month_days), 36)
+        self.assertEqual([(first_weekday[index], month_days[index]) for index in range(36)], [self.monthrange(1899 + index // 12, index % 12 + 1) for index in range(36)])
+
+
+@unittest.skipIf(awscronparser.np is None, 'numpy is not installed')
+class TestNextRunsBatch(unittest.TestCase):
+
+    def test_matches_iter_runs(self):
+        expressions = ['4-10/3 0-4,6/6 * * ? *', '0 0-4,6/6 3W 4 ? *', '0 0 ? 5 6#3 *', '30 0 ? */8 6#2 */94', '15 9 ? * 6L *', '0 0 L * ? *', '0 8 ? * MON-FRI *', '0 8 ? * 2-6 *']
+        start = datetime.datetime(2026, 5, 1, 4, 7, 30)
+        runs = awscronparser.next_runs_batch(expressions, start, 4)
+        for index, expression in enumerate(expressions):
+            expected = list(itertools.islice(awscronparser.compile_schedule(expression).iter_runs(start), 4))
+            self.assertEqual([r.astype(datetime.datetime) for r in runs['run'][runs['index'] == index]], expected)
+
+    def test_sparse_schedules(self):
+        # Schedules that need more than the first months, some of them run fewer than n times
+        expressions = ['0 0 29 2 ? *', '35 11 ? 4 1#5 2027-2030', '0 0 31 * ? *', '0 0 1 1 ? 2199', '0 0 ? * * *', '0 0 29 2 ? *']
+        for start in (datetime.datetime(2026, 5, 1, 4, 7, 30), datetime.datetime(2198, 12, 31, 23, 59)):
+            runs = awscronparser.next_runs_batch(expressions, start, 10)
+            for index, expression in enumerate(expressions):
+                expected = list(itertools.islice(awscronparser.compile_schedule(expression).iter_runs(start), 10))
+                self.assertEqual([r.astype(datetime.datetime) for r in runs['run'][runs['index'] == index]], expected)
+
+    def test_invalid_expression(self):
+        self.assertRaises(ValueError, awscronparser.next_runs_batch, ['0 0 ? * * *', '0 0 * * * *'])
+
+
+class TestStats(unittest.TestCase):
+
+    def tearDown(self):
+        awscronparser.enable_stats(False)
+
+    def test_counters(self):
+        awscronparser.enable_stats()
+        awscronparser.reset_stats()
+        s = awscronparser.CronParser.compile('0 0 ? * 6#2 2020-2022')
+        # Carries minute -> hour -> day -> month -> year, then runs out of years
+        self.assertIsNone(s.next_fire(datetime.datetime(2022, 12, 9)))
+        stats = awscronparser.stats()
+        self.assertEqual((stats['compile_calls'], stats['next_fire'], stats['candidates'], stats['rejected']), (1, 1, 5, 4))
+        awscronparser.reset_stats()
+        self.assertEqual(awscronparser.stats()['candidates'], 0)
+
+    def test_disabled(self):
+        awscronparser.CronParser.compile('0 0 ? * 6#2 *').next_fire(datetime.datetime(2026, 1, 1))
+        self.assertFalse(awscronparser.stats()['enabled'])
+        self.assertEqual(awscronparser.stats()['next_fire'], 0)
+
+
+class TestCompileCache(unittest.TestCase):
+
+    def test_equivalent_expressions_shared(self):
+        a = awscronparser.CronParser.compile('0 8 ? * MON-FRI *')
+        b = awscronparser.CronParser.compile(' 0  8 ? *   2-6 */1 ')
+        self.assertIs(a, b)
+        self.assertEqual(a.expression, '0 8 ? * 2-6 *')
+
+    def test_immutable(self):
+        s = awscronparser.CronParser.compile('0 0 ? * 6#2 *')
+        with self.assertRaises(AttributeError):
+            s.minutes = 1
+
+
+class TestMatches(unittest.TestCase):
+
+    def test_matches(self):
+        f = awscronparser.CronParser('0 0 ? 5 6#3 *')
+        self.assertTrue(f.matches(datetime.datetime(2026, 5, 15, 0, 0, 42)))
+        self.assertFalse(f.matches(datetime.datetime(2026, 5, 8, 0, 0)))
+        self.assertFalse(f.matches(datetime.datetime(2200, 5, 15, 0, 0)))
+
+    @unittest.skipIf(awscronparser.np is None, 'numpy is not installed')
+    def test_matches_many(self):
+        f = awscronparser.CronParser('15 9 ? * 6L *')
+        timestamps = awscronparser.np.array(['2026-05-29T09:15', '2026-05-22T09:15', '2026-05-29T09:16', 'NaT'], dtype='datetime64[m]')
+        self.assertEqual(f.matches_many(timestamps).tolist(), [True, False, False, False])
+
+
+class TestCountRuns(unittest.TestCase):
+
+    def test_year(self):
+        f = awscronparser.CronParser('*/5 * ? * MON-FRI *')
+        # 261 weekdays in 2026, 288 runs each
+        self.assertEqual(f.count_runs(datetime.datetime(2026, 1, 1), datetime.datetime(2027, 1, 1)), 261 * 288)
+
+    def test_partial_days(self):
+        f = awscronparser.CronParser('4-10/3 0-4,6/6 * * ? *')
+        start = datetime.datetime(2026, 5, 1, 4, 7, 30)
+        end = datetime.datetime(2026, 5, 3, 1, 7)
+        expected = len(list(itertools.takewhile(lambda run: run < end, f.iter_runs(start))))
+        self.assertEqual(f.count_runs(start, end), expected)
+
+
+class TestValidate(unittest.TestCase):
+
+    def test_valid(self):
+        for expression in ['4-10/3 0-4,6/6 * * ? *', '0 0-4,6/6 3W 4 ? *', '30 0 ? */8 FRI#2 */94', '15 9 ? * 6L *']:
+            self.assertEqual(awscronparser.validate(expression), [])
+
+    def test_errors(self):
+        self.assertEqual(awscronparser.validate('0 0 ? JAN-FOO 2 *'), [awscronparser.CronError('Month', 10, 'Invalid name FOO')])
+        self.assertEqual(awscronparser.validate('0 24 1 * 6#7 *'), [
+            awscronparser.CronError('Hours', 2, 'Value 24 is out of range 0-23'),
+            awscronparser.CronError('DoW', 11, 'Occurrence after # must be 1-5'),
+            awscronparser.CronError('DoW', 9, "Out of DoM and DoW, exactly one field must be '?'")])
+
+    def test_never_raises(self):
+        for expression in [None, '', '0 0', '5,,6 0 ? * * *', '*/0 0 ? * * *', '0 $ 1 * ? *', '\u0661 0 1 1 ? *', '0 0 ? * \u0662#1 *', '5 0 ' + '9' * 5000 + ' * ? *']:
+            self.assertNotEqual(awscronparser.validate(expression), [])
+        # A step longer than the field only matches its first value
+        self.assertEqual(awscronparser.validate('*/99999999999999999999 * * * ? *'), [])
+        self.assertEqual(awscronparser.validate('*/3000000000 */000024 * * ? 2026/400'), [])
+
+    def test_long_steps(self):
+        f = awscronparser.CronParser('*/3000000000 1/99 * * ? *')
+        self.assertEqual(f.next_fire(datetime.datetime(2026, 1, 1, 2)), datetime.datetime(2026, 1, 2, 1, 0))
+
+
+@unittest.skipIf(awscronparser.zoneinfo is None, 'zoneinfo is not available')
+class TestTimeZone(unittest.TestCase):
+
+    def test_clocks_forward(self):
+        f = awscronparser.CronParser('30 2 * * ? *', tz='America/New_York')
+        runs = list(itertools.islice(f.iter_runs(datetime.datetime(2026, 3, 7)), 3))
+        # 2:30 doesn't exist on 8 March 2026, the run happens when the clocks go forward
+        self.assertEqual(runs, [datetime.datetime(2026, 3, 7, 7, 30), datetime.datetime(2026, 3, 8, 7, 0), datetime.datetime(2026, 3, 9, 6, 30)])
+        self.assertEqual(f.count_runs(datetime.datetime(2026, 3, 7), datetime.datetime(2026, 3, 10)), 3)
+
+    def test_clocks_back(self):
+        f = awscronparser.CronParser('30 1 * * ? *', tz='America/New_York')
+        # 1:30 happens twice on 1 November 2026, the cron runs on the first one
+        self.assertEqual(f.next_fire(datetime.datetime(2026, 11, 1)), datetime.datetime(2026, 11, 1, 5, 30))
+        self.assertEqual(f.next_fire(datetime.datetime(2026, 11, 1, 5, 30)), datetime.datetime(2026, 11, 2, 6, 30))
+        self.assertFalse(f.matches(datetime.datetime(2026, 11, 1, 6, 30)))
+
+    def test_aware_datetimes(self):
+        # 2026-01-01 05:00 at UTC+5 is midnight UTC, with or without tz='UTC'
+        after = datetime.datetime(2026, 1, 1, 4, 59, tzinfo=datetime.timezone(datetime.timedelta(hours=5)))
+        midnight = datetime.datetime(2026, 1, 1, 5, tzinfo=after.tzinfo)
+        for tz in (None, 'UTC'):
+            f = awscronparser.CronParser('0 0 ? * * *', tz=tz)
+            self.assertEqual(f.next_fire(datetime.datetime(2026, 1, 1, tzinfo=after.tzinfo)), datetime.datetime(2026, 1, 1))
+            self.assertEqual(f.prev_fire(midnight + datetime.timedelta(minutes=1)), datetime.datetime(2026, 1, 1))
+            self.assertEqual(next(f.iter_runs(after)), datetime.datetime(2026, 1, 1))
+            self.assertTrue(f.matches(midnight))
+            self.assertEqual(f.count_runs(after, midnight + datetime.timedelta(days=2)), 2)
+
+    def test_unknown_zone(self):
+        self.assertRaises(ValueError, awscronparser.zone_table, 'Mars/Olympus_Mons')
+
+
+class TestSchedule(unittest.TestCase):
+
+    def test_rate(self):
+        s = awscronparser.Schedule.parse('rate(7 minutes)', anchor=datetime.datetime(2026, 5, 1, 4, 8))
+        self.assertEqual(s.next_fire(datetime.datetime(2026, 5, 1, 4, 15)), datetime.datetime(2026, 5, 1, 4, 22))
+        self.assertEqual(list(itertools.islice(s.iter_runs(datetime.datetime(2026, 4, 1)), 2)), [datetime.datetime(2026, 5, 1, 4, 8), datetime.datetime(2026, 5, 1, 4, 15)])
+        self.assertEqual(s.count_runs(datetime.datetime(2026, 5, 1), datetime.datetime(2026, 5, 2)), 171)
+        self.assertEqual(awscronparser.Schedule.parse('rate(120 minutes)').expression, 'rate(2 hours)')
+
+    def test_cron(self):
+        self.assertIs(awscronparser.Schedule.parse('cron(0 8 ? * MON-FRI *)'), awscronparser.CronParser.compile('0 8 ? * 2-6 *'))
+
+    def test_invalid(self):
+        for expression in ['rate(1 minutes)', 'rate(5 minute)', 'rate(0 minutes)', 'rate(5 weeks)', 'cron(0 0 * * * *)']:
+            self.assertRaises(ValueError, awscronparser.Schedule.parse, expression)
+
+
+class TestCli(unittest.TestCase):
+
+    def test_json_lines(self):
+        lines = ['0 8 ? * MON-FRI *', '', '{"id": "r1", "expression": "rate(5 minutes)"}', '{"Name": "stop-ec2", "ScheduleExpression": "cron(0 24 * * ? *)"}']
+        out = io.StringIO()
+        self.assertEqual(awscronparser.run_cli(lines, out, datetime.datetime(2026, 5, 1, 4, 7), runs=2), (3, 1))
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(results[0], {'id': 1, 'expression': '0 8 ? * MON-FRI *', 'valid': True, 'runs': ['2026-05-01T08:00:00', '2026-05-04T08:00:00']})
+        self.assertEqual(results[1]['runs'], ['2026-05-01T04:10:00', '2026-05-01T04:15:00'])
+        self.assertEqual(results[2]['id'], 'stop-ec2')
+        self.assertEqual(results[2]['errors'], [{'field': 'Hours', 'position': 2, 'reason': 'Value 24 is out of range 0-23'}])
+
+
+class TestBinaryRecords(unittest.TestCase):
+
+    def test_round_trip(self):
+        for expression in ['4-10/3 0-4,6/6 * * ? *', '0 0-4,6/6 3W 4 ? *', '15 9 ? * 6L *', '0 0 L * ? *', '30 0 ? */8 6#2 */94']:
+            s = awscronparser.compile_schedule(expression)
+            data = s.to_bytes()
+            self.assertEqual(len(data), awscronparser.RECORD_SIZE)
+            self.assertEqual(awscronparser.CronSchedule.from_bytes(data), s)
+        self.assertRaises(ValueError, awscronparser.CronSchedule.from_bytes, b'0')
+
+    def test_pickle_and_copy(self):
+        schedules = [awscronparser.compile_schedule('30 0 ? */8 6#2 */94'), awscronparser.compile_schedule('0 0 L * ? *'), awscronparser.Schedule.parse('rate(7 minutes)', anchor=datetime.datetime(2026, 5, 1, 4, 8))]
+        for s in schedules:
+            for other in (pickle.loads(pickle.dumps(s)), copy.copy(s), copy.deepcopy(s)):
+                self.assertEqual(other, s)
+                self.assertIs(type(other), type(s))
+                self.assertEqual(other.next_fire(datetime.datetime(2026, 5, 1)), s.next_fire(datetime.datetime(2026, 5, 1)))
+
+    def test_schedule_file(self):
+        schedules = [awscronparser.CronParser.compile(e) for e in ['0 8 ? * MON-FRI *', '0 2 L * ? *', '0 8 ? * MON-FRI *']]
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.assertEqual(awscronparser.dump_schedules(schedules, path), 3)
+            with awscronparser.ScheduleFile(path) as f:
+                self.assertEqual(len(f), 3)
+                self.assertEqual(list(f), schedules)
+                self.assertIs(f[-1], schedules[0])
+        finally:
+            os.remove(path)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
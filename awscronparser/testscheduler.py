@@ -0,0 +1,51 @@
+import unittest
+import awscronparser
+import scheduler
+import datetime
+import sys
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime(2026, 5, 1, 7, 59, 30)
+        self.scheduler = scheduler.Scheduler(workers=2, clock=lambda: self.now)
+        self.runs = []
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def add(self, name, expression):
+        self.scheduler.add(scheduler.Job(name, awscronparser.Schedule.parse(expression), lambda when: self.runs.append((name, when))))
+
+    def test_run_pending(self):
+        self.add('start', '0 8 ? * MON-FRI *')
+        self.add('poll', 'rate(30 minutes)')
+        self.assertEqual(self.scheduler.next_run(), datetime.datetime(2026, 5, 1, 8, 0))
+        self.assertEqual(self.scheduler.run_pending(), [])
+        self.now = datetime.datetime(2026, 5, 1, 8, 0, 1)
+        for future in self.scheduler.run_pending():
+            future.result()
+        self.assertEqual(sorted(self.runs), [('poll', datetime.datetime(2026, 5, 1, 8, 0)), ('start', datetime.datetime(2026, 5, 1, 8, 0))])
+        self.assertEqual(self.scheduler.next_run(), datetime.datetime(2026, 5, 1, 8, 30))
+
+    def test_missed_runs_coalesced(self):
+        self.add('poll', 'rate(30 minutes)')
+        self.now = datetime.datetime(2026, 5, 1, 10, 10)
+        for future in self.scheduler.run_pending():
+            future.result()
+        self.assertEqual(self.runs, [('poll', datetime.datetime(2026, 5, 1, 8, 0))])
+        self.assertEqual(self.scheduler.next_run(), datetime.datetime(2026, 5, 1, 10, 30))
+
+    def test_parse_job_line(self):
+        job = scheduler.parse_job_line('0 20 ? * MON-FRI * {0} -c "import sys; sys.exit(3)"'.format(sys.executable))
+        self.assertEqual(job.schedule, awscronparser.CronParser.compile('0 20 ? * 2-6 *'))
+        with self.assertLogs(scheduler.logger, 'ERROR') as logs:
+            self.assertEqual(job.action(self.now), 3)
+        self.assertEqual(logs.records[0].getMessage(), "Command ['{0}', '-c', 'import sys; sys.exit(3)'] exited with status 3".format(sys.executable))
+        self.assertIsNone(scheduler.parse_job_line('# comment'))
+        self.assertRaises(ValueError, scheduler.parse_job_line, 'rate(5 minutes)')
+
+
+if __name__ == '__main__':
+    unittest.main()
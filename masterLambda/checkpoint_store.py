@@ -0,0 +1,421 @@
+"""
+Checkpoint stores for the master lambda function
+
+Instead of sending the whole payload (agent data, CommandData and AgentStatusData) to the next
+instance of the master lambda function, the progress of a run is kept in a store and the next
+instance is only sent {"RunId": <run id>}. Every change is written as it happens and only for
+the commands that changed, and an instance only reads back the commands that are still running.
+
+Set the CHECKPOINT_STORE environment variable of the master lambda function to one of:
+
+sqlite:///<path>      SQLite database file, for tests and local runs
+dynamodb://<table>    DynamoDB table with the partition key RunId (String) and the sort key Item
+                      (String). Enable TTL on the ExpiresAt attribute to remove old runs
+
+The DynamoDB store needs the dynamodb:PutItem, dynamodb:GetItem, dynamodb:Query,
+dynamodb:BatchWriteItem and dynamodb:DeleteItem permissions on the table
+"""
+
+import abc
+import copy
+import json
+import sqlite3
+import time
+import uuid
+
+# Runs are kept for a week in DynamoDB
+RUN_TTL = 7 * 24 * 3600
+
+
+class CheckpointStore(abc.ABC):
+    """ Interface of the stores. Commands are identified by (agent, region, instance) """
+
+    def create_run(self, payload):
+        """ Save the payload of a new run and return its run ID"""
+        run_id = uuid.uuid4().hex
+        self.put_run(run_id, payload)
+        return run_id
+
+    @abc.abstractmethod
+    def put_run(self, run_id, payload):
+        """ Save the payload (agent data and MasterLambda) of a run"""
+
+    @abc.abstractmethod
+    def load_payload(self, run_id):
+        """ Return the payload of a run, None if the run doesn't exist"""
+
+    @abc.abstractmethod
+    def invoked_agents(self, run_id):
+        """ Return the set of the agents whose installer has been invoked"""
+
+    @abc.abstractmethod
+    def add_commands(self, run_id, agent, command_data):
+        """ Record the commands sent by the installer of an agent and mark the agent as invoked
+
+        Arguments:
+        run_id - Run ID
+        agent - Name of the agent
+        command_data - Dict of region to a list of dicts of instance ID to SSM command ID, as
+        returned by the installer
+        """
+
+    @abc.abstractmethod
+    def set_statuses(self, run_id, records):
+        """ Record the final status of commands, which are then no longer pending
+
+        Arguments:
+        run_id - Run ID
+        records - List of (agent, region, instance, status) tuples. status is None for commands
+        whose status couldn't be verified
+        """
+
+    @abc.abstractmethod
+    def pending(self, run_id):
+        """ Return the commands still running, as a dict of agent name to CommandData (region
+        to a list of dicts of instance ID to SSM command ID)"""
+
+    @abc.abstractmethod
+    def statuses(self, run_id):
+        """ Return the AgentStatusData of a run (agent -> region -> instance -> status) with
+        an entry for every invoked agent"""
+
+    @abc.abstractmethod
+    def delete_run(self, run_id):
+        """ Remove everything stored for a run"""
+
+    @abc.abstractmethod
+    def find_command(self, ssm_command_id, instance):
+        """ Return the (run ID, agent, region) of the command sent to an instance, None if it
+        isn't in the store"""
+
+    def set_command_statuses(self, records):
+        """ Record the final status of commands identified by their SSM command ID
+
+        Arguments:
+        records - List of (SSM command ID, instance, status) tuples
+
+        Return:
+        A tuple of the set of the IDs of the runs updated and the list of the records whose
+        command isn't in the store
+        """
+        # The same status can come more than once (redelivered or from several event sources),
+        # the last one wins
+        latest = {}
+        for ssm_command_id, instance, status in records:
+            latest[(ssm_command_id, instance)] = status
+        runs = {}
+        unmatched = []
+        for (ssm_command_id, instance), status in latest.items():
+            found = self.find_command(ssm_command_id, instance)
+            if found is None:
+                unmatched.append((ssm_command_id, instance, status))
+                continue
+            run_id, agent, region = found
+            runs.setdefault(run_id, []).append((agent, region, instance, status))
+        for run_id, run_records in runs.items():
+            self.set_statuses(run_id, run_records)
+        return (set(runs), unmatched)
+
+    @abc.abstractmethod
+    def finish_run(self, run_id):
+        """ Mark a run as finished (which also clears its deadline). Return True the first time
+        only, so that a run is reported once when several consumers see it finish"""
+
+    @abc.abstractmethod
+    def set_deadline(self, run_id, deadline):
+        """ Set the time (seconds since the epoch) after which the commands of a run still
+        pending are given up on, see command_events.sweep_runs"""
+
+    @abc.abstractmethod
+    def open_runs(self):
+        """ Return a list of (run ID, deadline) of the runs with a deadline not finished yet"""
+
+    @abc.abstractmethod
+    def load_polls(self, run_id):
+        """ Return the polling state of the pending commands of a run, a dict of SSM command ID
+        to [time first seen, number of polls]"""
+
+    @abc.abstractmethod
+    def save_polls(self, run_id, polls):
+        """ Replace the polling state of the pending commands of a run"""
+
+    @abc.abstractmethod
+    def load_history(self):
+        """ Return the completion history of the SSM commands (shared by all the runs), a dict
+        of "agent/platform" to seconds"""
+
+    @abc.abstractmethod
+    def save_history(self, history):
+        """ Save the completion history of the SSM commands"""
+
+    def checkpoint(self, run_id):
+        """ Return a Checkpoint buffering the status changes of a run"""
+        return Checkpoint(self, run_id)
+
+
+class Checkpoint():
+    """ Buffers the status changes of a run between two writes to the store"""
+
+    def __init__(self, store, run_id):
+        self.store = store
+        self.run_id = run_id
+        # Event that makes the next instance of the master lambda function resume this run
+        self.event = {'RunId': run_id}
+        self._records = []
+        # SSM command ID -> [time first seen, number of polls], updated by the caller
+        self.polls = store.load_polls(run_id)
+        self._saved_polls = copy.deepcopy(self.polls)
+
+    def record(self, agent, region, instance, status):
+        """ Buffer the final status of a command (None if it couldn't be verified)"""
+        self._records.append((agent, region, instance, status))
+
+    def flush(self):
+        """ Write the buffered status changes and the changed polling state to the store"""
+        if self._records:
+            self.store.set_statuses(self.run_id, self._records)
+            self._records = []
+        if self.polls != self._saved_polls:
+            self.store.save_polls(self.run_id, self.polls)
+            self._saved_polls = copy.deepcopy(self.polls)
+
+
+def _commands(command_data):
+    """ Yield (region, instance, command ID) for the CommandData of an agent"""
+    for region, region_data in command_data.items():
+        if type(region_data) is not list:
+            continue
+        for instance_data in region_data:
+            if type(instance_data) is dict:
+                for instance, ssm_command_id in instance_data.items():
+                    yield (region, instance, ssm_command_id)
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """ Checkpoint store in a SQLite database file"""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, payload TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS agents (run_id TEXT, agent TEXT, PRIMARY KEY (run_id, agent))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS commands (run_id TEXT, agent TEXT, region TEXT, instance TEXT, command_id TEXT, done INTEGER DEFAULT 0, status INTEGER, PRIMARY KEY (run_id, agent, region, instance))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS pending_commands ON commands (run_id, done)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS command_ids ON commands (command_id, instance)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS finished (run_id TEXT PRIMARY KEY)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS deadlines (run_id TEXT PRIMARY KEY, deadline REAL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS polls (run_id TEXT, command_id TEXT, first_seen REAL, count INTEGER, PRIMARY KEY (run_id, command_id))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS history (key TEXT PRIMARY KEY, seconds REAL)')
+
+    def put_run(self, run_id, payload):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?)', (run_id, json.dumps(payload)))
+
+    def load_payload(self, run_id):
+        row = self.connection.execute('SELECT payload FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def invoked_agents(self, run_id):
+        return set(row[0] for row in self.connection.execute('SELECT agent FROM agents WHERE run_id = ?', (run_id,)))
+
+    def add_commands(self, run_id, agent, command_data):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO commands (run_id, agent, region, instance, command_id) VALUES (?, ?, ?, ?, ?)',
+                [(run_id, agent, region, instance, json.dumps(ssm_command_id)) for region, instance, ssm_command_id in _commands(command_data)])
+            self.connection.execute('INSERT OR REPLACE INTO agents VALUES (?, ?)', (run_id, agent))
+
+    def set_statuses(self, run_id, records):
+        with self.connection:
+            self.connection.executemany('UPDATE commands SET done = 1, status = ? WHERE run_id = ? AND agent = ? AND region = ? AND instance = ?',
+                [(status, run_id, agent, region, instance) for agent, region, instance, status in records])
+
+    def pending(self, run_id):
+        pending = {}
+        for agent, region, instance, ssm_command_id in self.connection.execute('SELECT agent, region, instance, command_id FROM commands WHERE run_id = ? AND done = 0', (run_id,)):
+            pending.setdefault(agent, {}).setdefault(region, [{}])[0][instance] = json.loads(ssm_command_id)
+        return pending
+
+    def statuses(self, run_id):
+        statuses = dict((agent, {}) for agent in self.invoked_agents(run_id))
+        for agent, region, instance, status in self.connection.execute('SELECT agent, region, instance, status FROM commands WHERE run_id = ? AND done = 1', (run_id,)):
+            region_statuses = statuses.setdefault(agent, {}).setdefault(region, {})
+            if status is not None:
+                region_statuses[instance] = status
+        return statuses
+
+    def find_command(self, ssm_command_id, instance):
+        return self.connection.execute('SELECT run_id, agent, region FROM commands WHERE command_id = ? AND instance = ?', (json.dumps(ssm_command_id), instance)).fetchone()
+
+    def finish_run(self, run_id):
+        with self.connection:
+            self.connection.execute('DELETE FROM deadlines WHERE run_id = ?', (run_id,))
+            return self.connection.execute('INSERT OR IGNORE INTO finished VALUES (?)', (run_id,)).rowcount == 1
+
+    def set_deadline(self, run_id, deadline):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO deadlines VALUES (?, ?)', (run_id, deadline))
+
+    def open_runs(self):
+        return self.connection.execute('SELECT run_id, deadline FROM deadlines').fetchall()
+
+    def load_polls(self, run_id):
+        return dict((command_id, [first_seen, count]) for command_id, first_seen, count in self.connection.execute('SELECT command_id, first_seen, count FROM polls WHERE run_id = ?', (run_id,)))
+
+    def save_polls(self, run_id, polls):
+        with self.connection:
+            self.connection.execute('DELETE FROM polls WHERE run_id = ?', (run_id,))
+            self.connection.executemany('INSERT INTO polls VALUES (?, ?, ?, ?)', [(run_id, command_id, first_seen, count) for command_id, (first_seen, count) in polls.items()])
+
+    def load_history(self):
+        return dict(self.connection.execute('SELECT key, seconds FROM history'))
+
+    def save_history(self, history):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO history VALUES (?, ?)', history.items())
+
+    def delete_run(self, run_id):
+        with self.connection:
+            for table in ('runs', 'agents', 'commands', 'finished', 'polls', 'deadlines'):
+                self.connection.execute('DELETE FROM {0} WHERE run_id = ?'.format(table), (run_id,))
+
+
+class DynamoDBCheckpointStore(CheckpointStore):
+    """ Checkpoint store in a DynamoDB table
+
+    Items of a run (partition key RunId, sort key Item):
+    RUN - Payload
+    AGENT#<agent> - Installer invoked
+    PENDING#<agent>#<region>#<instance> - Running command, CommandId
+    DONE#<agent>#<region>#<instance> - Finished command, Status
+
+    FINISHED - Run reported to agent_data_parser
+    POLLS - Polling state of the pending commands, Polls
+
+    Every command also has an item with RunId COMMAND#<command ID> and Item <instance> holding
+    its RunId, Agent and Region, to find it from its status events, and every run with a
+    deadline has an item with RunId OPEN and Item <run ID> holding its Deadline until it
+    finishes. The completion history is the item with RunId and Item HISTORY, without an expiry
+
+    A finished command's PENDING item is replaced with a DONE item, so loading the pending
+    commands is a query on the PENDING# prefix that doesn't read the finished ones
+    """
+
+    def __init__(self, table_name, resource=None):
+        if resource is None:
+            import boto3
+            resource = boto3.resource('dynamodb')
+        self.table = resource.Table(table_name)
+
+    def _item(self, run_id, key, **attributes):
+        item = {'RunId': run_id, 'Item': key, 'ExpiresAt': int(time.time()) + RUN_TTL}
+        item.update(attributes)
+        return item
+
+    def _query(self, run_id, prefix):
+        """ Yield the items of a partition whose Item starts with prefix (all of them for None)"""
+        from boto3.dynamodb.conditions import Key
+        condition = Key('RunId').eq(run_id)
+        if prefix:
+            condition = condition & Key('Item').begins_with(prefix)
+        kwargs = {'KeyConditionExpression': condition, 'ConsistentRead': True}
+        while True:
+            response = self.table.query(**kwargs)
+            for item in response['Items']:
+                yield item
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def put_run(self, run_id, payload):
+        self.table.put_item(Item=self._item(run_id, 'RUN', Payload=json.dumps(payload)))
+
+    def load_payload(self, run_id):
+        item = self.table.get_item(Key={'RunId': run_id, 'Item': 'RUN'}).get('Item')
+        return json.loads(item['Payload']) if item else None
+
+    def invoked_agents(self, run_id):
+        return set(item['Item'].split('#', 1)[1] for item in self._query(run_id, 'AGENT#'))
+
+    def add_commands(self, run_id, agent, command_data):
+        with self.table.batch_writer(overwrite_by_pkeys=['RunId', 'Item']) as batch:
+            for region, instance, ssm_command_id in _commands(command_data):
+                batch.put_item(Item=self._item(run_id, 'PENDING#{0}#{1}#{2}'.format(agent, region, instance), CommandId=json.dumps(ssm_command_id)))
+                if type(ssm_command_id) is str:
+                    batch.put_item(Item=self._item('COMMAND#' + ssm_command_id, instance, CommandRunId=run_id, Agent=agent, Region=region))
+            batch.put_item(Item=self._item(run_id, 'AGENT#{0}'.format(agent)))
+
+    def set_statuses(self, run_id, records):
+        with self.table.batch_writer(overwrite_by_pkeys=['RunId', 'Item']) as batch:
+            for agent, region, instance, status in records:
+                key = '{0}#{1}#{2}'.format(agent, region, instance)
+                batch.put_item(Item=self._item(run_id, 'DONE#' + key, **({} if status is None else {'Status': status})))
+                batch.delete_item(Key={'RunId': run_id, 'Item': 'PENDING#' + key})
+
+    def pending(self, run_id):
+        pending = {}
+        for item in self._query(run_id, 'PENDING#'):
+            agent, region, instance = item['Item'].split('#', 3)[1:]
+            pending.setdefault(agent, {}).setdefault(region, [{}])[0][instance] = json.loads(item['CommandId'])
+        return pending
+
+    def statuses(self, run_id):
+        statuses = dict((agent, {}) for agent in self.invoked_agents(run_id))
+        for item in self._query(run_id, 'DONE#'):
+            agent, region, instance = item['Item'].split('#', 3)[1:]
+            region_statuses = statuses.setdefault(agent, {}).setdefault(region, {})
+            if 'Status' in item:
+                region_statuses[instance] = int(item['Status'])
+        return statuses
+
+    def find_command(self, ssm_command_id, instance):
+        item = self.table.get_item(Key={'RunId': 'COMMAND#{0}'.format(ssm_command_id), 'Item': instance}).get('Item')
+        return (item['CommandRunId'], item['Agent'], item['Region']) if item else None
+
+    def finish_run(self, run_id):
+        self.table.delete_item(Key={'RunId': 'OPEN', 'Item': run_id})
+        try:
+            self.table.put_item(Item=self._item(run_id, 'FINISHED'), ConditionExpression='attribute_not_exists(RunId)')
+            return True
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def set_deadline(self, run_id, deadline):
+        self.table.put_item(Item=self._item('OPEN', run_id, Deadline=json.dumps(deadline)))
+
+    def open_runs(self):
+        return [(item['Item'], json.loads(item['Deadline'])) for item in self._query('OPEN', None)]
+
+    def load_polls(self, run_id):
+        item = self.table.get_item(Key={'RunId': run_id, 'Item': 'POLLS'}).get('Item')
+        return json.loads(item['Polls']) if item else {}
+
+    def save_polls(self, run_id, polls):
+        self.table.put_item(Item=self._item(run_id, 'POLLS', Polls=json.dumps(polls)))
+
+    def load_history(self):
+        item = self.table.get_item(Key={'RunId': 'HISTORY', 'Item': 'HISTORY'}).get('Item')
+        return json.loads(item['Seconds']) if item else {}
+
+    def save_history(self, history):
+        self.table.put_item(Item={'RunId': 'HISTORY', 'Item': 'HISTORY', 'Seconds': json.dumps(history)})
+
+    def delete_run(self, run_id):
+        with self.table.batch_writer(overwrite_by_pkeys=['RunId', 'Item']) as batch:
+            for prefix in ('RUN', 'AGENT#', 'PENDING#', 'DONE#', 'FINISHED', 'POLLS'):
+                for item in self._query(run_id, prefix):
+                    batch.delete_item(Key={'RunId': run_id, 'Item': item['Item']})
+
+
+def get_checkpoint_store(url):
+    """ Return the checkpoint store for a CHECKPOINT_STORE value (see the module docstring),
+    None if url is empty
+
+    Raises ValueError for an unknown kind of store
+    """
+    if not url:
+        return None
+    if url.startswith('sqlite://'):
+        return SQLiteCheckpointStore(url[len('sqlite://'):])
+    if url.startswith('dynamodb://'):
+        return DynamoDBCheckpointStore(url[len('dynamodb://'):])
+    raise ValueError('Unknown checkpoint store {0}'.format(url))
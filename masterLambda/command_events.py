@@ -0,0 +1,247 @@
+"""
+Consumer of the SSM command status events, for the event driven mode of the master lambda function
+
+Set COMMAND_EVENTS=true (and CHECKPOINT_STORE, see checkpoint_store.py) on the master lambda
+function to stop it from polling SSM. It then invokes the installers, records their commands
+in the checkpoint store and exits. The status events of the commands are delivered to an SQS
+queue and this function (with the same CHECKPOINT_STORE) records them in batches. The batch
+that finishes the last pending command of a run invokes the agent_data_parser function.
+
+The events can come from either source:
+
+1. The NotificationConfig of send_command (NotificationType Invocation) with the SNS topic
+subscribed to the SQS queue, as in misc/dsm_installer.py
+2. An EventBridge rule on "EC2 Command Invocation Status-change Notification" targeting the
+SQS queue
+
+Set up the queue as an event source of this function with ReportBatchItemFailures. Events of
+commands that aren't in the store yet (the installer's response hasn't been recorded) are
+reported as failures, so SQS delivers them again. Set a redrive policy to move events that
+never match a command to a dead-letter queue
+
+Events can be lost, and the installers that don't set a NotificationConfig send none. Schedule
+sweep_handler (e.g. an EventBridge rule with rate(5 minutes)) to poll the pending commands of
+the open runs once per sweep. Runs past their deadline (SSM_MAX_WAIT after they started) have
+their remaining commands recorded as not verified and are finished
+
+Add the following policies to the role of the function:
+
+lambda:InvokeFunction on agent_data_parser
+sqs:ReceiveMessage, sqs:DeleteMessage and sqs:GetQueueAttributes on the queue
+sts:AssumeRole on the cross-account roles, for the sweep
+"""
+
+import boto3
+import json
+import logging
+import os
+import queue
+import time
+
+import checkpoint_store
+import master_lambda_function
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def parse_status_event(body):
+    """ Parse the body of a status event message
+
+    Arguments:
+    body - JSON string of an EventBridge event, an SNS notification or an SSM notification
+
+    Return:
+    A tuple of command ID, instance ID and status, None if the message isn't the status of a
+    command invocation
+    """
+    try:
+        message = json.loads(body)
+        if message.get('Type') == 'Notification':
+            message = json.loads(message['Message'])
+        if 'detail' in message:
+            detail = message['detail']
+            return (detail['command-id'], detail['instance-id'], detail['status'])
+        return (message['commandId'], message['instanceId'], message['status'])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def record_status_events(store, messages):
+    """ Record a batch of status event messages in the checkpoint store
+
+    Arguments:
+    store - checkpoint_store.CheckpointStore
+    messages - List of (message ID, body) tuples
+
+    Return:
+    A tuple of the IDs of the messages whose command isn't in the store and the IDs of the runs
+    that have no pending commands left
+    """
+    records = []
+    message_ids = {}
+    for message_id, body in messages:
+        event = parse_status_event(body)
+        if event is None:
+            logger.info("Ignoring message {0}: {1}".format(message_id, body))
+            continue
+        ssm_command_id, instance, status = event
+        if status not in master_lambda_function.SSM_FINAL_STATUSES:
+            continue
+        records.append((ssm_command_id, instance, master_lambda_function.SSM_FINAL_STATUSES[status]))
+        message_ids.setdefault((ssm_command_id, instance), []).append(message_id)
+    runs, unmatched = store.set_command_statuses(records)
+    failed = []
+    for ssm_command_id, instance, status in unmatched:
+        logger.info("Command {0} on instance {1} isn't in the checkpoint store yet".format(ssm_command_id, instance))
+        failed.extend(message_ids[(ssm_command_id, instance)])
+    drained = [run_id for run_id in runs if master_lambda_function.run_drained(store, run_id)]
+    return (failed, drained)
+
+
+def finish_runs(store, run_ids, client_lambda):
+    """ Invoke agent_data_parser with the AgentStatusData of each drained run, once per run"""
+    for run_id in run_ids:
+        if store.finish_run(run_id):
+            logger.info("Run {0} finished, calling the parser function".format(run_id))
+            master_lambda_function.invoke_lambda_function(client_lambda, 'agent_data_parser', json.dumps(store.statuses(run_id)).encode())
+
+
+def poll_pending_commands(store, run_id, give_up=False):
+    """ Poll the pending commands of a run once and record the ones that have finished
+
+    Arguments:
+    store - checkpoint_store.CheckpointStore
+    run_id - Run ID
+    give_up - Record the commands still running (or that couldn't be polled) as not verified
+
+    Return:
+    The number of commands still pending
+    """
+    # (region, command ID) -> list of (agent, instance)
+    commands = {}
+    for agent, command_data in store.pending(run_id).items():
+        for region, instance, ssm_command_id in checkpoint_store._commands(command_data):
+            commands.setdefault((region, ssm_command_id), []).append((agent, instance))
+    if not commands:
+        return 0
+    master_lambda_data = (store.load_payload(run_id) or {}).get('MasterLambda', {})
+    creds = master_lambda_function.get_temp_creds(master_lambda_data.get('Role_ARN'), master_lambda_data.get('External_Id'))
+    records = []
+    clients = {}
+    for (region, ssm_command_id), instances in commands.items():
+        invocations = {}
+        try:
+            if region not in clients:
+                clients[region] = boto3.client('ssm',
+                    region_name=region,
+                    aws_access_key_id=creds[0],
+                    aws_secret_access_key=creds[1],
+                    aws_session_token=creds[2])
+            invocations = master_lambda_function.list_ssm_command_invocations(ssm_command_id, clients[region])
+        except Exception as e:
+            logger.info('Error in checking the status of command id {0}'.format(ssm_command_id))
+            logger.error(e)
+        for agent, instance in instances:
+            status = invocations.get(instance, {}).get('Status')
+            if status in master_lambda_function.SSM_FINAL_STATUSES:
+                records.append((agent, region, instance, master_lambda_function.SSM_FINAL_STATUSES[status]))
+            elif give_up:
+                logger.info("Couldn't verify the status of command id {0} on instance {1}".format(ssm_command_id, instance))
+                records.append((agent, region, instance, None))
+    if records:
+        store.set_statuses(run_id, records)
+    return sum(len(instances) for instances in commands.values()) - len(records)
+
+
+def sweep_runs(store, client_lambda, now=None):
+    """ Poll the pending commands of every open run once, give up on the ones of the runs past
+    their deadline and finish the runs that have drained
+
+    Return:
+    The IDs of the runs finished
+    """
+    if now is None:
+        now = time.time()
+    finished = []
+    for run_id, deadline in store.open_runs():
+        overdue = deadline <= now
+        try:
+            poll_pending_commands(store, run_id, give_up=overdue)
+        except Exception as e:
+            logger.info('Error in sweeping run {0}'.format(run_id))
+            logger.error(e)
+            if not overdue:
+                continue
+        if overdue or master_lambda_function.run_drained(store, run_id):
+            finished.append(run_id)
+    finish_runs(store, finished, client_lambda)
+    return finished
+
+
+class LocalEventQueue():
+    """ In-process stand-in for the SQS queue, for tests and local runs"""
+
+    def __init__(self):
+        self.messages = queue.Queue()
+        self._count = 0
+
+    def send(self, body):
+        """ Add a message to the queue"""
+        self._count += 1
+        self.messages.put(('{0}'.format(self._count), body))
+
+    def receive(self, max_messages=10, wait_seconds=0):
+        """ Return up to max_messages (message ID, body) tuples, waiting up to wait_seconds for
+        the first one"""
+        batch = []
+        try:
+            batch.append(self.messages.get(timeout=wait_seconds) if wait_seconds else self.messages.get_nowait())
+            while len(batch) < max_messages:
+                batch.append(self.messages.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+
+def consume(event_queue, store, client_lambda, max_messages=10):
+    """ Record the status events of a local queue in batches until it is empty
+
+    Events whose command isn't in the store are put back at the end of the queue once
+
+    Return:
+    The number of messages read
+    """
+    count = 0
+    retried = set()
+    while True:
+        batch = event_queue.receive(max_messages)
+        if not batch:
+            return count
+        count += len(batch)
+        failed, drained = record_status_events(store, batch)
+        bodies = dict(batch)
+        for message_id in failed:
+            if message_id not in retried:
+                retried.add(message_id)
+                event_queue.messages.put((message_id, bodies[message_id]))
+        finish_runs(store, drained, client_lambda)
+
+
+def sweep_handler(event, context):
+    """ Handler for the scheduled sweep of the open runs"""
+    store = checkpoint_store.get_checkpoint_store(os.environ.get('CHECKPOINT_STORE'))
+    client_lambda = boto3.client('lambda', region_name=boto3.session.Session().region_name)
+    finished = sweep_runs(store, client_lambda)
+    logger.info("Finished runs {0}".format(finished))
+
+
+def lambda_handler(event, context):
+    """ Handler for the SQS event source (with ReportBatchItemFailures)"""
+    store = checkpoint_store.get_checkpoint_store(os.environ.get('CHECKPOINT_STORE'))
+    messages = [(record['messageId'], record['body']) for record in event.get('Records', [])]
+    logger.info("Received {0} status events".format(len(messages)))
+    failed, drained = record_status_events(store, messages)
+    client_lambda = boto3.client('lambda', region_name=boto3.session.Session().region_name)
+    finish_runs(store, drained, client_lambda)
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]}
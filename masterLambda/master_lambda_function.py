@@ -1,11 +1,20 @@
 """
-No environment variables (as of now)
+Environment variables:
+
+CHECKPOINT_STORE (optional) - Where the progress of a run is kept, see checkpoint_store.py. When
+set, the next instance of the function is only sent {"RunId": <run id>} instead of the whole
+payload. When not set, the payload (with CommandData and AgentStatusData) is sent as before
+COMMAND_EVENTS (optional) - Set to true to not poll SSM. The function exits once the commands
+are recorded in the checkpoint store and command_events.py records their status events and
+calls agent_data_parser. Commands without an event are polled by command_events.sweep_handler
+and given up on SSM_MAX_WAIT seconds after the run started. Needs CHECKPOINT_STORE
 
 Set the timeout according to the normal time of execution of all the Lambda function
 
 Note: Now we need to add the following policy to the cross-account-role in Customer's environment
 
 ssm:GetInvocationStatus
+ssm:ListCommandInvocations
 
 In the Lambda role, add the ARN of the master role as well so that it can invoke itself
 
@@ -18,6 +27,11 @@ import time
 import logging
 import re
 import copy
+import random
+import concurrent.futures
+import os
+
+import checkpoint_store
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -28,6 +42,23 @@ AGENT2FUNCTION = dict(zip(AGENT_NAMES, FUNCTION_NAMES))
 
 SSM_COMMAND_PATTERN = re.compile(r'\b([a-z0-9]+-){4}[a-z0-9]{12}\b')
 
+# Final statuses of an SSM command invocation and the value recorded in agent_status_data
+SSM_FINAL_STATUSES = {'Success': 1, 'TimedOut': 2, 'Failed': 0, 'Cancelled': 0}
+# Polling of the SSM commands. A command is first polled SSM_POLL_FIRST seconds after it is seen
+# (or near its expected finish, going by the completion history of its agent) and then with an
+# exponential backoff with jitter, up to SSM_POLL_MAX_INTERVAL seconds between polls. Commands
+# still running after SSM_MAX_WAIT seconds are reported as not verified
+SSM_POLL_FIRST = 5
+SSM_POLL_BACKOFF = 2
+SSM_POLL_MAX_INTERVAL = 60
+SSM_MAX_WAIT = 600
+# Fraction of the expected completion time at which polling starts
+SSM_EXPECTED_FRACTION = 0.9
+# Number of concurrent list_command_invocations calls
+SSM_POLL_WORKERS = 10
+# Remaining milliseconds below which the next instance of the function is invoked
+SSM_TIME_BUDGET = 60000
+
 _continue = True
 
 def get_temp_creds(role_arn, external_id):
@@ -53,17 +84,83 @@ def get_temp_creds(role_arn, external_id):
         logger.error(e)
         return (None, None, None)
 
-def check_ssm_command_status(ssm_command_id, instance, client_ssm):
-    logger.info('Checking status of command id {0}'.format(ssm_command_id))
-    response = client_ssm.get_command_invocation(
-        CommandId=ssm_command_id,
-        InstanceId=instance
-    )
+def list_ssm_command_invocations(ssm_command_id, client_ssm):
+    """ Retrieve the invocations of a command on all of its instances in one paginated call
 
-    if response['Status'] == 'TimedOut' or response['Status'] == 'Success' or response['Status'] == 'Failed':
-        return (True, response['Status'])
-    else:
-        return (False, None)
+    Arguments:
+    ssm_command_id - SSM command ID
+    client_ssm - SSM client of the region the command was sent in
+
+    Return:
+    A dict of instance ID to the invocation (Status, DocumentName, RequestedDateTime...)
+    """
+    invocations = {}
+    kwargs = {'CommandId': ssm_command_id}
+    while True:
+        response = client_ssm.list_command_invocations(**kwargs)
+        for invocation in response['CommandInvocations']:
+            invocations[invocation['InstanceId']] = invocation
+        if not response.get('NextToken'):
+            return invocations
+        kwargs['NextToken'] = response['NextToken']
+
+def invocation_requested_time(invocation, default):
+    """ Return the time (seconds since the epoch) a command invocation was sent, default if
+    the invocation doesn't say"""
+    try:
+        return invocation['RequestedDateTime'].timestamp()
+    except (KeyError, AttributeError):
+        return default
+
+class CompletionHistory():
+    """ Typical completion time of the SSM commands per agent and platform
+
+    The platform is the document the command ran (AWS-RunShellScript on Linux,
+    AWS-RunPowerShellScript on Windows). Completion times are kept as exponentially weighted
+    moving averages so that the history follows changes of the installers
+    """
+
+    def __init__(self, weight=0.3):
+        self.weight = weight
+        # "agent/platform" -> seconds
+        self.seconds = {}
+
+    def update(self, seconds):
+        """ Merge in a history saved earlier (a dict like self.seconds)"""
+        for key, value in seconds.items():
+            self.seconds.setdefault(key, value)
+
+    def add(self, agent, platform, seconds):
+        """ Record the completion time of a command"""
+        key = '{0}/{1}'.format(agent, platform)
+        if key in self.seconds:
+            self.seconds[key] += self.weight * (seconds - self.seconds[key])
+        else:
+            self.seconds[key] = seconds
+
+    def expected(self, agent, platform=None):
+        """ Return the expected completion time in seconds of a command of the agent, None if
+        there's no history. Without the platform, the shortest over the agent's platforms"""
+        if platform is not None:
+            return self.seconds.get('{0}/{1}'.format(agent, platform))
+        times = [value for key, value in self.seconds.items() if key.split('/', 1)[0] == agent]
+        return min(times) if times else None
+
+# Kept across the invocations served by the same Lambda container, and in the checkpoint store
+completion_history = CompletionHistory()
+
+def first_poll_delay(agent):
+    """ Return the seconds to wait before first polling a command of the agent"""
+    expected = completion_history.expected(agent)
+    if expected is None:
+        return SSM_POLL_FIRST
+    return max(SSM_POLL_FIRST, expected * SSM_EXPECTED_FRACTION)
+
+def poll_backoff(polls):
+    """ Return the seconds to wait before the next poll of a command polled polls times,
+    exponential with jitter so that the polls of many commands don't line up"""
+    delay = min(SSM_POLL_FIRST * SSM_POLL_BACKOFF ** polls, SSM_POLL_MAX_INTERVAL)
+    return random.uniform(delay / 2.0, delay)
 
 def get_lambda_payload(secretname):
     client_session = boto3.session.Session()
@@ -91,7 +188,7 @@ def invoke_lambda_function(client_lambda, function_name, payload):
 
 def out_of_time(client_lambda, payload, context):
     remaining_time = int(context.get_remaining_time_in_millis())
-    if remaining_time < 60000:
+    if remaining_time < SSM_TIME_BUDGET:
         payload_to_send = payload
         logger.info('Invoking next instance of master lambda function with the payload data {0}'.format(payload_to_send))
         # invoke another lambda function here with the payload
@@ -102,88 +199,307 @@ def out_of_time(client_lambda, payload, context):
     else:
         return True
 
-def get_status_command_ids(retval, creds, payload, payload_copy, client_lambda, context, agent_status_data, agent=None):
-    _continue = True
-    for region in retval.keys():
-        client_ssm = boto3.client('ssm', 
-            region_name=region, 
-            aws_access_key_id=creds[0], 
-            aws_secret_access_key=creds[1], 
-            aws_session_token=creds[2])
-        
-        # Add the region key to agent_status_data dict
-        agent_status_data[agent][region] = {}
-        
-        region_data = retval.get(region)
-        agent_status_data[agent][region] = {}
-        try:
-            if type(region_data) is list:
-                for instance_data in region_data:
-                    if type(instance_data) is dict:
-                        # instance_data_keys = instance_data.keys()
-                        for instance in instance_data.keys():
-                            ssm_command_id = instance_data.get(instance)
-                            _st = True
-                            match = re.fullmatch(SSM_COMMAND_PATTERN, ssm_command_id)
-                            if match:
-                                _count = 0
-                                _current_command_status = False
-                                while not (_current_command_status):
-                                    # check the remaining time
-                                    _continue = out_of_time(client_lambda, payload_copy, context)
-                                    if not _continue:
-                                        return False
-                                    time.sleep(10)
-                                    if _count < 60:
-                                        _count += 1
-                                    else:
-                                        logging.info('Couldn\'t verify the status of command id {0}'.format(ssm_command_id))
-                                        _st = False
-                                        # pop the command ID as the execution state couldn't be verified
-                                        try:
-                                            payload_copy['CommandData'][region][region_data.index(instance_data)].pop(instance)
-                                        except:
-                                            pass
-                                        break
-                                    _current_command_status = check_ssm_command_status(ssm_command_id, instance, client_ssm)[0]
-                                    
-                                    if _current_command_status is not None:
-                                        if _current_command_status[1] == 'TimedOut':
-                                            agent_status_data[agent][region][instance] = 2
-                                        elif _current_command_status[1] == 'Success':
-                                            agent_status_data[agent][region][instance] = 1
-                                        else:
-                                            agent_status_data[agent][region][instance] = 0
-                                
-                                # pop the command ID if it exists and the execution has finished or timedout
-                                try:
-                                    logger.info("Removing the data for {0}".format(instance))
-                                    payload_copy['CommandData'][region][region_data.index(instance_data)].pop(instance)
-                                except:
-                                    pass
-                                if _st:
-                                    logging.info('Command ID {0} execution finished'.format(ssm_command_id))
-                            else:
-                                # If the data for instance id is not a valid SSM command ID
-                                agent_status_data[agent][region][instance] = 0
-                try:
-                    logger.info("Removing command data for region {0}".format(region))
-                    payload_copy['CommandData'].pop(region)
-                    logger.info("Command data is now: {0}".format(payload_copy['CommandData']))
-                except:
-                    pass
-            else:
+def remove_command_data(command_data, region, index, instance):
+    """ Remove the command ID of an instance from the CommandData of the payload for the next
+    invocation of the master lambda function, so that it doesn't check it again"""
+    try:
+        command_data[region][index].pop(instance)
+    except:
+        pass
+
+def get_status_command_ids(retval, creds, payload, payload_copy, client_lambda, context, agent_status_data, agent=None, checkpoint=None):
+    """ Wait for the SSM commands of the agent installations to finish and record their status
+
+    All the outstanding commands of all the agents and regions are checked together. Each
+    command ID is polled with list_command_invocations on its own schedule (see
+    first_poll_delay and poll_backoff), the due ones concurrently, and the remaining time is
+    checked before every call
+
+    Arguments:
+    retval - CommandData. With agent, a dict of region to a list of dicts of instance ID to SSM
+    command ID (plus the AgentName key). Without agent, a dict of agent name to such a dict
+    creds - Tuple of access key, secret access key and session token
+    payload - Payload of this invocation
+    payload_copy - Payload for the next invocation, finished commands are removed from its
+    CommandData (which has the same layout as retval)
+    client_lambda - Lambda client used to invoke the next instance of the function
+    context - Lambda context
+    agent_status_data - Dict updated with agent -> region -> instance -> status (1 success,
+    2 timed out, 0 failed)
+    The number of polls and the time each command was first seen are kept in the CommandPolls
+    key of payload_copy (or in the checkpoint) for the next instances
+    agent - Name of the agent for the single agent layout of CommandData
+    checkpoint - checkpoint_store.Checkpoint of the run. The final statuses are written to it
+    after every sweep and the next instance is sent its event instead of payload_copy
+
+    Return:
+    False if the function ran out of time (the next instance has been invoked), else True
+    """
+    # Agent -> (its command data, its command data in payload_copy)
+    if agent is not None:
+        agents = {agent: (retval, payload_copy['CommandData'])}
+    else:
+        agents = dict((name, (data, payload_copy['CommandData'].get(name, {}))) for name, data in retval.items() if type(data) is dict)
+    # (agent, region, command ID) -> list of (instance ID, index in the region data) still running
+    pending = {}
+    clients = {}
+    for name, (command_data, command_data_copy) in agents.items():
+        for region in list(command_data.keys()):
+            region_data = command_data.get(region)
+            if region == 'AgentName':
+                continue
+            if type(region_data) is not list:
                 logger.info("Removing the empty region field for region {0}".format(region))
-                payload_copy['CommandData'].pop(region)
-        except Exception as e:
-            logger.info('Error in parsing information for region {0}'.format(region))
-            logger.error(e)
+                command_data_copy.pop(region, None)
+                continue
+            agent_status_data.setdefault(name, {}).setdefault(region, {})
+            try:
+                if region not in clients:
+                    clients[region] = boto3.client('ssm',
+                        region_name=region,
+                        aws_access_key_id=creds[0],
+                        aws_secret_access_key=creds[1],
+                        aws_session_token=creds[2])
+                for index, instance_data in enumerate(region_data):
+                    if type(instance_data) is not dict:
+                        continue
+                    for instance, ssm_command_id in instance_data.items():
+                        if type(ssm_command_id) is str and re.fullmatch(SSM_COMMAND_PATTERN, ssm_command_id):
+                            pending.setdefault((name, region, ssm_command_id), []).append((instance, index))
+                        else:
+                            # If the data for instance id is not a valid SSM command ID
+                            agent_status_data[name][region][instance] = 0
+                            if checkpoint is not None:
+                                checkpoint.record(name, region, instance, 0)
+            except Exception as e:
+                logger.info('Error in parsing information for region {0}'.format(region))
+                logger.error(e)
+
+    if checkpoint is not None:
+        checkpoint.flush()
+    # Command ID -> [time it was first seen or sent, number of polls], carried over to the next
+    # instances so that the backoff and SSM_MAX_WAIT span all of them
+    if checkpoint is not None:
+        command_polls = checkpoint.polls
+    else:
+        command_polls = payload_copy.setdefault('CommandPolls', {})
+    # Command key -> [time of the next poll, number of polls, time it was first seen or sent]
+    _now = time.time()
+    schedule = {}
+    for key in pending:
+        first_seen, polls = command_polls.setdefault(key[2], [_now, 0])
+        schedule[key] = [_now + (poll_backoff(polls) if polls else first_poll_delay(key[0])), polls, first_seen]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SSM_POLL_WORKERS) as executor:
+        while pending:
+            # Sleep until the next poll is due, but not into the time left for invoking the next instance
+            _now = time.time()
+            _due = min(entry[0] for entry in schedule.values())
+            _spare = (int(context.get_remaining_time_in_millis()) - SSM_TIME_BUDGET) / 1000.0
+            if _due > _now and _spare > 0:
+                time.sleep(min(_due - _now, _spare))
+            futures = {}
+            for key, entry in schedule.items():
+                if entry[0] > time.time():
+                    continue
+                # check the remaining time before every call
+                _continue = out_of_time(client_lambda, payload_copy if checkpoint is None else checkpoint.event, context)
+                if not _continue:
+                    for future in futures:
+                        future.cancel()
+                    return False
+                name, region, ssm_command_id = key
+                futures[executor.submit(list_ssm_command_invocations, ssm_command_id, clients[region])] = key
+            if not futures:
+                _continue = out_of_time(client_lambda, payload_copy if checkpoint is None else checkpoint.event, context)
+                if not _continue:
+                    return False
+                continue
+            for future in concurrent.futures.as_completed(futures):
+                key = futures[future]
+                name, region, ssm_command_id = key
+                entry = schedule[key]
+                entry[1] += 1
+                try:
+                    invocations = future.result()
+                except Exception as e:
+                    logger.info('Error in checking the status of command id {0}'.format(ssm_command_id))
+                    logger.error(e)
+                    invocations = {}
+                running = []
+                finish = None
+                for instance, index in pending[key]:
+                    invocation = invocations.get(instance, {})
+                    status = invocation.get('Status')
+                    requested = invocation_requested_time(invocation, entry[2])
+                    entry[2] = min(entry[2], requested)
+                    if status in SSM_FINAL_STATUSES:
+                        agent_status_data[name][region][instance] = SSM_FINAL_STATUSES[status]
+                        if checkpoint is not None:
+                            checkpoint.record(name, region, instance, SSM_FINAL_STATUSES[status])
+                        completion_history.add(name, invocation.get('DocumentName'), time.time() - requested)
+                        logger.info("Removing the data for {0}".format(instance))
+                        remove_command_data(agents[name][1], region, index, instance)
+                    else:
+                        running.append((instance, index))
+                        # Expected finish of the instance going by the history of its agent and platform
+                        expected = completion_history.expected(name, invocation.get('DocumentName'))
+                        if expected is not None:
+                            finish = max(finish or 0, requested + expected * SSM_EXPECTED_FRACTION)
+                command_polls[ssm_command_id] = [entry[2], entry[1]]
+                if not running:
+                    logging.info('Command ID {0} execution finished'.format(ssm_command_id))
+                    pending.pop(key)
+                    schedule.pop(key)
+                    command_polls.pop(ssm_command_id, None)
+                elif time.time() - entry[2] >= SSM_MAX_WAIT:
+                    # Left to be reported as not verified
+                    pending[key] = running
+                    schedule[key][0] = float('inf')
+                else:
+                    pending[key] = running
+                    entry[0] = max(time.time() + poll_backoff(entry[1]), finish or 0)
+            if checkpoint is not None:
+                checkpoint.flush()
+            if all(entry[0] == float('inf') for entry in schedule.values()):
+                break
+
+    for (name, region, ssm_command_id), instances in pending.items():
+        logging.info('Couldn\'t verify the status of command id {0}'.format(ssm_command_id))
+        # pop the command ID as the execution state couldn't be verified
+        command_polls.pop(ssm_command_id, None)
+        for instance, index in instances:
+            remove_command_data(agents[name][1], region, index, instance)
+            if checkpoint is not None:
+                checkpoint.record(name, region, instance, None)
+    if checkpoint is not None:
+        checkpoint.flush()
+    for name, (command_data, command_data_copy) in agents.items():
+        for region in agent_status_data.get(name, {}):
+            logger.info("Removing command data for region {0}".format(region))
+            command_data_copy.pop(region, None)
     # Test the validity
     logger.info("CommandData is now {0}".format(payload_copy["CommandData"]))
     logger.info("Removing the CommandData section from the payload")
     payload_copy.pop("CommandData")
+    payload_copy.pop("CommandPolls", None)
     return True
 
+def invoke_agent_installers(client_lambda, payload, agents):
+    """ Invoke the installer lambda functions of the agents concurrently
+
+    Arguments:
+    client_lambda - Lambda client
+    payload - Payload with the data of every agent
+    agents - Names of the agents to install
+
+    Return:
+    A dict of agent name to the CommandData returned by its installer. Agents whose installer
+    failed are left out
+    """
+    def invoke(agent):
+        _agent_data = json.dumps(payload.get(agent)).encode()
+        logger.info("Invoking {0} for agent {1}".format(AGENT2FUNCTION[agent], agent))
+        res = invoke_lambda_function(client_lambda, AGENT2FUNCTION[agent], _agent_data)
+        streaming_body = res['Payload']
+        return json.loads(streaming_body.read().decode('utf-8'))
+
+    command_data = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(agents), 1)) as executor:
+        futures = dict((executor.submit(invoke, agent), agent) for agent in agents)
+        for future in concurrent.futures.as_completed(futures):
+            agent = futures[future]
+            try:
+                retval = future.result()
+            except Exception as e:
+                logger.info("Error in invoking the installer for agent {0}".format(agent))
+                logger.error(e)
+                continue
+            if type(retval) is dict:
+                command_data[agent] = retval
+            else:
+                logger.info("Unexpected response from the installer for agent {0}: {1}".format(agent, retval))
+    return command_data
+
+def run_drained(store, run_id):
+    """ Return True if the installers of all the agents of a run have been invoked and none of
+    their commands are pending"""
+    payload = store.load_payload(run_id) or {}
+    invoked = store.invoked_agents(run_id)
+    if any(agent in AGENT2FUNCTION and agent not in invoked for agent in payload):
+        return False
+    return not store.pending(run_id)
+
+def record_invalid_commands(store, run_id, retval):
+    """ Record the status 0 for the instances of the installers' CommandData that have no valid
+    SSM command ID, as no status event will come for them"""
+    records = []
+    for agent, command_data in retval.items():
+        if type(command_data) is not dict:
+            continue
+        for region, instance, ssm_command_id in checkpoint_store._commands(command_data):
+            if not (type(ssm_command_id) is str and re.fullmatch(SSM_COMMAND_PATTERN, ssm_command_id)):
+                records.append((agent, region, instance, 0))
+    if records:
+        store.set_statuses(run_id, records)
+
+def run_with_checkpoint(store, run_id, payload, creds, client_lambda, context, events=False):
+    """ Run (or resume) the installation of the agents keeping its progress in a checkpoint store
+
+    The commands still running from the previous instances are checked first, then the
+    installers of the agents not invoked yet are invoked and their commands checked. With
+    events, the commands aren't checked and the run is finished by command_events.py
+
+    Arguments:
+    store - checkpoint_store.CheckpointStore
+    run_id - Run ID in the store
+    payload - Payload of the run
+    creds - Tuple of access key, secret access key and session token
+    client_lambda - Lambda client
+    context - Lambda context
+    events - Leave the commands to the status events instead of polling SSM
+
+    Return:
+    The AgentStatusData of the run, None if the function ran out of time (the next instance
+    has been invoked) or if the run is left to the status events
+    """
+    checkpoint = store.checkpoint(run_id)
+    try:
+        completion_history.update(store.load_history())
+        pending = store.pending(run_id)
+        logger.info("Run {0} has commands pending for agents: {1}".format(run_id, list(pending.keys())))
+        if pending and not events:
+            if not get_status_command_ids(pending, creds, payload, {'CommandData': copy.deepcopy(pending)}, client_lambda, context, {}, checkpoint=checkpoint):
+                logger.info("Ran out of time.")
+                return None
+
+        invoked = store.invoked_agents(run_id)
+        agents = [agent for agent in payload.keys() if agent in AGENT2FUNCTION and agent not in invoked]
+        if agents:
+            retval = invoke_agent_installers(client_lambda, payload, agents)
+            # Recording the agents as invoked prevents the next instances from invoking them again
+            for agent in agents:
+                store.add_commands(run_id, agent, retval.get(agent, {}))
+            if events:
+                record_invalid_commands(store, run_id, retval)
+            elif not get_status_command_ids(retval, creds, payload, {'CommandData': copy.deepcopy(retval)}, client_lambda, context, {}, checkpoint=checkpoint):
+                logger.info("Ran out of time.")
+                return None
+    except Exception as e:
+        logger.info("Exiting due to the below error")
+        logger.error(e)
+    finally:
+        try:
+            store.save_history(completion_history.seconds)
+        except Exception as e:
+            logger.info("Error in saving the completion history")
+            logger.error(e)
+    if events:
+        # The status events may all have been recorded already, then the run finishes here
+        if not (run_drained(store, run_id) and store.finish_run(run_id)):
+            logger.info("Waiting for the status events of run {0}".format(run_id))
+            return None
+    return store.statuses(run_id)
+
 def lambda_handler(event, context):
 
     _time = time.time()
@@ -192,8 +508,16 @@ def lambda_handler(event, context):
     client_session = boto3.session.Session()
     region = client_session.region_name
 
+    store = checkpoint_store.get_checkpoint_store(os.environ.get('CHECKPOINT_STORE'))
+    run_id = None
+
     # Get the payload
-    if type(event) != dict:
+    if store is not None and type(event) == dict and 'RunId' in event:
+        run_id = event['RunId']
+        logger.info("Resuming run {0}".format(run_id))
+        _payload = store.load_payload(run_id)
+        _payload_copy = _payload
+    elif type(event) != dict:
         secret_name = event
         _payload = get_lambda_payload(secret_name)
         # Dictionary changed size during runtime fix
@@ -212,52 +536,59 @@ def lambda_handler(event, context):
     external_id = _master_lambda_data.get('External_Id')
     creds = get_temp_creds(role_arn, external_id)
 
-    # Initialize agent_status_data dict
-    agent_status_data = {}
+    if store is not None:
+        events = os.environ.get('COMMAND_EVENTS', '').lower() == 'true'
+        if run_id is None:
+            run_id = store.create_run(_payload)
+            logger.info("Started run {0}".format(run_id))
+            if events:
+                store.set_deadline(run_id, time.time() + SSM_MAX_WAIT)
+        agent_status_data = run_with_checkpoint(store, run_id, _payload, creds, client_lambda, context, events)
+        if agent_status_data is None:
+            return True #Exit the execution of Lambda function
+        logger.info('Calling the parser function')
+        invoke_lambda_function(client_lambda, 'agent_data_parser', json.dumps(agent_status_data).encode())
+        return
+
+    # Initialize agent_status_data dict, carrying over the status recorded by the previous
+    # invocations
+    agent_status_data = _payload_copy.get('AgentStatusData', {})
+    _payload_copy['AgentStatusData'] = agent_status_data
     
     try:
         if 'CommandData' in _payload.keys():
             if len(list(_payload['CommandData'].keys())) == 0:
                 logger.info("CommandData is empty. Removing it.")
                 _payload.pop('CommandData')
+                _payload_copy.pop('CommandData', None)
                 logger.info("Current payload is {0}".format(_payload))
             # Pop the CommandData if it contains only agent name
             elif len(list(_payload['CommandData'].keys())) == 1 and list(_payload['CommandData'].keys())[0] == 'AgentName':
                 logger.info("CommandData is empty. Removing it.")
                 _payload.pop('CommandData')
+                _payload_copy.pop('CommandData', None)
                 logger.info("Current payload is {0}".format(_payload))
             else:
                 retval = _payload.get("CommandData")
-                get_status_command_ids(retval, creds, _payload, _payload_copy, client_lambda, context, agent_status_data, agent=_payload.get("CommandData").get("AgentName"))
+                # CommandData of a single agent (AgentName key) or of all the agents by name
+                if not get_status_command_ids(retval, creds, _payload, _payload_copy, client_lambda, context, agent_status_data, agent=retval.get("AgentName")):
+                    logger.info("Ran out of time.")
+                    return True #Exit the execution of Lambda function
         
-        for agent in _payload.keys():
-            if agent != 'CommandData' and agent != 'MasterLambda':
-                _agent_data = json.dumps(_payload.get(agent)).encode()
-                function_name = AGENT2FUNCTION[agent]
+        agents = [agent for agent in _payload.keys() if agent in AGENT2FUNCTION]
+        if agents:
+            # Launch all the installers at once, then wait for all of their commands together
+            retval = invoke_agent_installers(client_lambda, _payload, agents)
+            for agent in agents:
                 agent_status_data[agent] = {}
-                logger.info("Agent status data is {0}".format(agent_status_data))
-                logger.info(_agent_data)
-                
-                # Call another method to invoke agent installer lambda
-                res = invoke_lambda_function(client_lambda, function_name, _agent_data)
-                streaming_body = res['Payload']
-                retval = json.loads(streaming_body.read().decode('utf-8'))
-                _payload_copy['CommandData'] = copy.deepcopy(retval)
-                
-                # Add the agent name to the command data
-                _payload_copy['CommandData']['AgentName'] = agent
-                
-                # Add the agent status data to the payload for next invocation
-                # Should we move it to the end??
-                _payload_copy['AgentStatusData'] = agent_status_data
-                
                 # VERY IMPORTANT!!! Prevents the Lambda function from infinitely invoking itself
                 logger.info("Removing data for {0} agent".format(agent))
                 _payload_copy.pop(agent)
-                logger.info("Payload copy now contains data for agents: {0}".format(_payload_copy.keys()))
-                if not get_status_command_ids(retval, creds, _payload, _payload_copy, client_lambda, context, agent_status_data, agent=agent):
-                    logger.info("Ran out of time.")
-                    return True #Exit the execution of Lambda function
+            logger.info("Payload copy now contains data for agents: {0}".format(_payload_copy.keys()))
+            _payload_copy['CommandData'] = copy.deepcopy(retval)
+            if not get_status_command_ids(retval, creds, _payload, _payload_copy, client_lambda, context, agent_status_data):
+                logger.info("Ran out of time.")
+                return True #Exit the execution of Lambda function
                     
     except Exception as e:
         logger.info("Exiting due to the below error")
@@ -0,0 +1,143 @@
+import unittest
+
+import checkpoint_store
+
+try:
+    import boto3
+    import moto
+except ImportError:
+    moto = None
+
+
+class CheckpointStoreChecks():
+    """ Checks run against every store, the test cases set self.store"""
+
+    def setUp(self):
+        self.payload = {'MasterLambda': {'Role_ARN': 'role', 'External_Id': 'id'}, 'Site24x7': {'key': 'value'}, 'DesktopCentral': {}}
+        self.run_id = self.store.create_run(self.payload)
+
+    def add_commands(self):
+        self.store.add_commands(self.run_id, 'Site24x7', {'us-east-1': [{'i-1': 'cmd-1', 'i-2': 'cmd-1'}], 'us-west-2': 'No instances'})
+        self.store.add_commands(self.run_id, 'DesktopCentral', {'eu-west-1': [{'i-3': 'cmd-2'}, {'i-4': 'cmd-3'}]})
+
+    def test_run(self):
+        self.assertEqual(self.store.load_payload(self.run_id), self.payload)
+        self.assertIsNone(self.store.load_payload('missing'))
+        self.assertEqual(self.store.invoked_agents(self.run_id), set())
+        self.add_commands()
+        self.assertEqual(self.store.invoked_agents(self.run_id), {'Site24x7', 'DesktopCentral'})
+        self.assertEqual(self.store.pending(self.run_id), {'Site24x7': {'us-east-1': [{'i-1': 'cmd-1', 'i-2': 'cmd-1'}]}, 'DesktopCentral': {'eu-west-1': [{'i-3': 'cmd-2', 'i-4': 'cmd-3'}]}})
+
+        self.store.set_statuses(self.run_id, [('Site24x7', 'us-east-1', 'i-1', 1), ('DesktopCentral', 'eu-west-1', 'i-3', 2), ('DesktopCentral', 'eu-west-1', 'i-4', None)])
+        self.assertEqual(self.store.pending(self.run_id), {'Site24x7': {'us-east-1': [{'i-2': 'cmd-1'}]}})
+        # Commands whose status couldn't be verified are left out of the statuses
+        self.assertEqual(self.store.statuses(self.run_id), {'Site24x7': {'us-east-1': {'i-1': 1}}, 'DesktopCentral': {'eu-west-1': {'i-3': 2}}})
+
+        self.store.set_statuses(self.run_id, [('Site24x7', 'us-east-1', 'i-2', 0)])
+        self.assertEqual(self.store.pending(self.run_id), {})
+        self.assertEqual(self.store.statuses(self.run_id), {'Site24x7': {'us-east-1': {'i-1': 1, 'i-2': 0}}, 'DesktopCentral': {'eu-west-1': {'i-3': 2}}})
+
+    def test_duplicate_records(self):
+        self.store.add_commands(self.run_id, 'Site24x7', {'us-east-1': [{'i-1': 'cmd-1'}, {'i-1': 'cmd-1'}]})
+        self.store.set_statuses(self.run_id, [('Site24x7', 'us-east-1', 'i-1', 1), ('Site24x7', 'us-east-1', 'i-1', 1)])
+        self.assertEqual(self.store.statuses(self.run_id), {'Site24x7': {'us-east-1': {'i-1': 1}}})
+        self.assertEqual(self.store.set_command_statuses([('cmd-1', 'i-1', 2), ('cmd-1', 'i-1', 2)]), ({self.run_id}, []))
+        self.assertEqual(self.store.statuses(self.run_id), {'Site24x7': {'us-east-1': {'i-1': 2}}})
+
+    def test_runs_are_separate(self):
+        self.add_commands()
+        other = self.store.create_run(self.payload)
+        self.assertNotEqual(other, self.run_id)
+        self.assertEqual(self.store.pending(other), {})
+        self.assertEqual(self.store.statuses(other), {})
+        self.store.delete_run(self.run_id)
+        self.assertIsNone(self.store.load_payload(self.run_id))
+        self.assertEqual(self.store.pending(self.run_id), {})
+        self.assertEqual(self.store.load_payload(other), self.payload)
+
+    def test_find_command(self):
+        self.add_commands()
+        self.assertEqual(tuple(self.store.find_command('cmd-1', 'i-2')), (self.run_id, 'Site24x7', 'us-east-1'))
+        self.assertEqual(tuple(self.store.find_command('cmd-3', 'i-4')), (self.run_id, 'DesktopCentral', 'eu-west-1'))
+        self.assertIsNone(self.store.find_command('cmd-1', 'i-3'))
+        self.assertIsNone(self.store.find_command('cmd-4', 'i-1'))
+        self.assertEqual(self.store.set_command_statuses([('cmd-1', 'i-1', 1), ('cmd-3', 'i-4', 0), ('cmd-4', 'i-1', 1)]), ({self.run_id}, [('cmd-4', 'i-1', 1)]))
+        self.assertEqual(self.store.pending(self.run_id), {'Site24x7': {'us-east-1': [{'i-2': 'cmd-1'}]}, 'DesktopCentral': {'eu-west-1': [{'i-3': 'cmd-2'}]}})
+
+    def test_finish_run(self):
+        other = self.store.create_run(self.payload)
+        self.store.set_deadline(self.run_id, 100.5)
+        self.store.set_deadline(other, 200.0)
+        self.assertEqual(sorted(self.store.open_runs()), sorted([(self.run_id, 100.5), (other, 200.0)]))
+        self.assertTrue(self.store.finish_run(self.run_id))
+        self.assertFalse(self.store.finish_run(self.run_id))
+        # Finishing a run clears its deadline
+        self.assertEqual([tuple(run) for run in self.store.open_runs()], [(other, 200.0)])
+        self.assertTrue(self.store.finish_run(other))
+        self.assertEqual(self.store.open_runs(), [])
+
+    def test_checkpoint(self):
+        self.add_commands()
+        checkpoint = self.store.checkpoint(self.run_id)
+        self.assertEqual(checkpoint.event, {'RunId': self.run_id})
+        checkpoint.record('DesktopCentral', 'eu-west-1', 'i-3', 1)
+        # Nothing is written before the flush
+        self.assertIn('DesktopCentral', self.store.pending(self.run_id))
+        checkpoint.flush()
+        self.assertEqual(self.store.pending(self.run_id)['DesktopCentral'], {'eu-west-1': [{'i-4': 'cmd-3'}]})
+
+    def test_polls(self):
+        self.assertEqual(self.store.load_polls(self.run_id), {})
+        checkpoint = self.store.checkpoint(self.run_id)
+        checkpoint.polls['cmd-1'] = [100.0, 3]
+        checkpoint.flush()
+        self.assertEqual(self.store.load_polls(self.run_id), {'cmd-1': [100.0, 3]})
+        # A new instance starts from the saved state
+        checkpoint = self.store.checkpoint(self.run_id)
+        self.assertEqual(checkpoint.polls, {'cmd-1': [100.0, 3]})
+        checkpoint.polls.pop('cmd-1')
+        checkpoint.flush()
+        self.assertEqual(self.store.load_polls(self.run_id), {})
+
+    def test_history(self):
+        self.assertEqual(self.store.load_history(), {})
+        self.store.save_history({'Site24x7/Linux': 42.5, 'DesktopCentral/Windows': 120.0})
+        self.assertEqual(self.store.load_history(), {'Site24x7/Linux': 42.5, 'DesktopCentral/Windows': 120.0})
+        # The history is shared by the runs and outlives them
+        self.store.delete_run(self.run_id)
+        self.assertEqual(self.store.load_history(), {'Site24x7/Linux': 42.5, 'DesktopCentral/Windows': 120.0})
+
+
+class TestSQLiteCheckpointStore(CheckpointStoreChecks, unittest.TestCase):
+
+    def setUp(self):
+        self.store = checkpoint_store.get_checkpoint_store('sqlite://:memory:')
+        super().setUp()
+
+    def test_get_checkpoint_store(self):
+        self.assertIsNone(checkpoint_store.get_checkpoint_store(''))
+        self.assertIsNone(checkpoint_store.get_checkpoint_store(None))
+        self.assertRaises(ValueError, checkpoint_store.get_checkpoint_store, 's3://bucket')
+
+    def test_interface_is_abstract(self):
+        self.assertRaises(TypeError, checkpoint_store.CheckpointStore)
+
+
+@unittest.skipIf(moto is None, 'moto is not available')
+class TestDynamoDBCheckpointStore(CheckpointStoreChecks, unittest.TestCase):
+
+    def setUp(self):
+        mock_aws = moto.mock_aws()
+        mock_aws.start()
+        self.addCleanup(mock_aws.stop)
+        resource = boto3.resource('dynamodb', region_name='us-east-1', aws_access_key_id='testing', aws_secret_access_key='testing')
+        resource.create_table(TableName='runs',
+            KeySchema=[{'AttributeName': 'RunId', 'KeyType': 'HASH'}, {'AttributeName': 'Item', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'RunId', 'AttributeType': 'S'}, {'AttributeName': 'Item', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        self.store = checkpoint_store.DynamoDBCheckpointStore('runs', resource)
+        super().setUp()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import checkpoint_store
+import command_events
+import master_lambda_function
+from testmasterlambda import FakeContext, MasterLambdaTestCase, command_id
+
+
+class EventsTestCase(MasterLambdaTestCase):
+    """ Runs the master lambda function in the event driven mode with a SQLite checkpoint store"""
+
+    commands = {command_id(1): (['i-1'], 1, 'Success'), command_id(2): (['i-2'], None, 'Success')}
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patch = mock.patch.dict(os.environ, {'CHECKPOINT_STORE': 'sqlite:///' + os.path.join(directory, 'runs.db'), 'COMMAND_EVENTS': 'true'})
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.store = checkpoint_store.get_checkpoint_store(os.environ['CHECKPOINT_STORE'])
+        self.client_lambda.responses = {
+            'x_account_site247_installer': {'us-east-1': [{'i-1': command_id(1)}]},
+            'x_account_dc_installer': {'eu-west-1': [{'i-2': command_id(2)}]}}
+
+    def start_run(self):
+        """ Runs the orchestrator and returns the run ID"""
+        event = {'MasterLambda': {'Role_ARN': 'role', 'External_Id': 'id'}, 'Site24x7': {}, 'DesktopCentral': {}}
+        self.assertTrue(master_lambda_function.lambda_handler(event, FakeContext(60)))
+        (run_id, deadline), = self.store.open_runs()
+        return run_id
+
+
+def eventbridge_event(ssm_command_id, instance, status):
+    return json.dumps({'detail-type': 'EC2 Command Invocation Status-change Notification', 'source': 'aws.ssm', 'detail': {'command-id': ssm_command_id, 'instance-id': instance, 'status': status}})
+
+
+def ssm_notification(ssm_command_id, instance, status):
+    return json.dumps({'commandId': ssm_command_id, 'instanceId': instance, 'status': status, 'eventTime': '2020-01-01T00:00:00.000Z'})
+
+
+def sns_notification(ssm_command_id, instance, status):
+    return json.dumps({'Type': 'Notification', 'MessageId': 'id', 'Message': ssm_notification(ssm_command_id, instance, status)})
+
+
+class TestParseStatusEvent(unittest.TestCase):
+
+    def test_message_shapes(self):
+        for message in (eventbridge_event, sns_notification, ssm_notification):
+            self.assertEqual(command_events.parse_status_event(message('cmd-1', 'i-1', 'Success')), ('cmd-1', 'i-1', 'Success'))
+
+    def test_not_a_status_event(self):
+        for body in ('not json', '[]', '{}', json.dumps({'Type': 'Notification', 'Message': 'text'}), json.dumps({'detail': {'command-id': 'cmd-1'}})):
+            self.assertIsNone(command_events.parse_status_event(body))
+
+
+class TestConsumer(EventsTestCase):
+
+    commands = {command_id(1): (['i-1'], None, 'Success'), command_id(2): (['i-2'], None, 'Success')}
+
+    def test_unknown_commands_are_redelivered(self):
+        messages = [('1', eventbridge_event(command_id(1), 'i-1', 'Success')), ('2', sns_notification(command_id(2), 'i-2', 'Failed')), ('3', 'not json')]
+        # The installers haven't answered yet
+        self.assertEqual(command_events.record_status_events(self.store, messages), (['1', '2'], []))
+        run_id = self.start_run()
+        self.assertEqual(command_events.record_status_events(self.store, messages), ([], [run_id]))
+        self.assertEqual(self.store.statuses(run_id), {'Site24x7': {'us-east-1': {'i-1': 1}}, 'DesktopCentral': {'eu-west-1': {'i-2': 0}}})
+
+    def test_duplicate_events(self):
+        run_id = self.start_run()
+        # A redelivered message and the same status from both event sources in one batch
+        body = ssm_notification(command_id(1), 'i-1', 'Success')
+        messages = [('1', body), ('2', body), ('3', eventbridge_event(command_id(1), 'i-1', 'Success'))]
+        self.assertEqual(command_events.record_status_events(self.store, messages), ([], []))
+        self.assertEqual(self.store.statuses(run_id), {'Site24x7': {'us-east-1': {'i-1': 1}}, 'DesktopCentral': {}})
+
+    def test_intermediate_statuses_are_skipped(self):
+        run_id = self.start_run()
+        messages = [('1', ssm_notification(command_id(1), 'i-1', 'InProgress'))]
+        self.assertEqual(command_events.record_status_events(self.store, messages), ([], []))
+        self.assertIn('Site24x7', self.store.pending(run_id))
+
+    def test_consume_retries_once(self):
+        event_queue = command_events.LocalEventQueue()
+        event_queue.send(ssm_notification(command_id(1), 'i-1', 'Success'))
+        self.assertEqual(command_events.consume(event_queue, self.store, self.client_lambda), 2)
+        self.assertEqual(event_queue.receive(), [])
+
+    def test_consume(self):
+        run_id = self.start_run()
+        event_queue = command_events.LocalEventQueue()
+        event_queue.send(eventbridge_event(command_id(1), 'i-1', 'TimedOut'))
+        self.assertEqual(command_events.consume(event_queue, self.store, self.client_lambda), 1)
+        self.assertEqual(self.client_lambda.payloads('agent_data_parser'), [])
+        event_queue.send(sns_notification(command_id(2), 'i-2', 'Success'))
+        self.assertEqual(command_events.consume(event_queue, self.store, self.client_lambda), 1)
+        self.assertEqual(self.client_lambda.payloads('agent_data_parser'), [{'Site24x7': {'us-east-1': {'i-1': 2}}, 'DesktopCentral': {'eu-west-1': {'i-2': 1}}}])
+        self.assertEqual(self.store.open_runs(), [])
+
+    def test_run_finishes_once(self):
+        run_id = self.start_run()
+        event_queue = command_events.LocalEventQueue()
+        event_queue.send(ssm_notification(command_id(1), 'i-1', 'Success'))
+        event_queue.send(ssm_notification(command_id(2), 'i-2', 'Success'))
+        # The consumer and a resumed orchestrator both see the run drain
+        command_events.consume(event_queue, self.store, self.client_lambda)
+        self.assertTrue(master_lambda_function.lambda_handler({'RunId': run_id}, FakeContext(60)))
+        failed, drained = command_events.record_status_events(self.store, [('3', ssm_notification(command_id(2), 'i-2', 'Success'))])
+        command_events.finish_runs(self.store, drained, self.client_lambda)
+        self.assertEqual(drained, [run_id])
+        self.assertEqual(len(self.client_lambda.payloads('agent_data_parser')), 1)
+
+    def test_orchestrator_finishes_first(self):
+        run_id = self.start_run()
+        # The events are recorded before the orchestrator's last instance checks the run
+        failed, drained = command_events.record_status_events(self.store, [('1', ssm_notification(command_id(1), 'i-1', 'Success')), ('2', ssm_notification(command_id(2), 'i-2', 'Success'))])
+        self.assertEqual(drained, [run_id])
+        self.assertIsNone(master_lambda_function.lambda_handler({'RunId': run_id}, FakeContext(60)))
+        command_events.finish_runs(self.store, drained, self.client_lambda)
+        self.assertEqual(self.client_lambda.payloads('agent_data_parser'), [{'Site24x7': {'us-east-1': {'i-1': 1}}, 'DesktopCentral': {'eu-west-1': {'i-2': 1}}}])
+
+
+class TestSweep(EventsTestCase):
+
+    def test_orchestrator_does_not_poll(self):
+        run_id = self.start_run()
+        self.assertEqual(self.ssm.calls, [])
+        self.assertEqual(self.client_lambda.payloads('agent_data_parser'), [])
+        self.assertEqual(self.store.pending(run_id), {'Site24x7': {'us-east-1': [{'i-1': command_id(1)}]}, 'DesktopCentral': {'eu-west-1': [{'i-2': command_id(2)}]}})
+
+    def test_overdue_commands_are_not_verified(self):
+        run_id = self.start_run()
+        # Before the deadline the finished commands are recorded and the run stays open
+        self.assertEqual(command_events.sweep_runs(self.store, self.client_lambda), [])
+        self.assertEqual(self.store.pending(run_id), {'DesktopCentral': {'eu-west-1': [{'i-2': command_id(2)}]}})
+
+        later = time.time() + master_lambda_function.SSM_MAX_WAIT + 1
+        self.assertEqual(command_events.sweep_runs(self.store, self.client_lambda, now=later), [run_id])
+        self.assertEqual(self.client_lambda.payloads('agent_data_parser'), [{'Site24x7': {'us-east-1': {'i-1': 1}}, 'DesktopCentral': {'eu-west-1': {}}}])
+        self.assertEqual(self.store.open_runs(), [])
+        self.assertEqual(command_events.sweep_runs(self.store, self.client_lambda, now=later), [])
+
+    def test_commands_without_events(self):
+        # No event ever comes for the commands of installers without a NotificationConfig
+        self.ssm.commands = {command_id(1): (['i-1'], 1, 'Success'), command_id(2): (['i-2'], 2, 'Failed')}
+        run_id = self.start_run()
+        self.assertEqual(command_events.sweep_runs(self.store, self.client_lambda), [])
+        self.assertEqual(command_events.sweep_runs(self.store, self.client_lambda), [run_id])
+        self.assertEqual(self.client_lambda.payloads('agent_data_parser'), [{'Site24x7': {'us-east-1': {'i-1': 1}}, 'DesktopCentral': {'eu-west-1': {'i-2': 0}}}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,319 @@
+import datetime
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import checkpoint_store
+import master_lambda_function
+
+
+def command_id(number):
+    """ Returns a valid looking SSM command ID"""
+    return 'aaaaaaaa-bbbb-cccc-dddd-{0:012d}'.format(number)
+
+
+class FakeSSM():
+    """ SSM client whose commands finish after a given number of list_command_invocations calls
+
+    Arguments:
+    commands - Dict of command ID to (list of instance IDs, polls needed, final status). Polls
+    needed None means the command never finishes
+    """
+
+    def __init__(self, commands, page_size=None, requested=None):
+        self.commands = commands
+        self.page_size = page_size
+        # RequestedDateTime of the invocations, left out when None
+        self.requested = requested
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def list_command_invocations(self, CommandId, NextToken=None):
+        with self._lock:
+            self.calls.append(CommandId)
+            polls = self.calls.count(CommandId)
+        instances, needed, status = self.commands[CommandId]
+        finished = needed is not None and polls >= needed
+        invocations = [{'InstanceId': instance, 'Status': status if finished else 'InProgress', 'DocumentName': 'AWS-RunShellScript'} for instance in instances]
+        if self.requested is not None:
+            for invocation in invocations:
+                invocation['RequestedDateTime'] = self.requested
+        if self.page_size is None:
+            return {'CommandInvocations': invocations}
+        start = int(NextToken or 0)
+        response = {'CommandInvocations': invocations[start:start + self.page_size]}
+        if start + self.page_size < len(invocations):
+            response['NextToken'] = str(start + self.page_size)
+        return response
+
+
+class FakeLambda():
+    """ Lambda client recording the invocations, installers answer with their CommandData
+
+    Arguments:
+    responses - Dict of function name to the CommandData it returns, or an exception it raises
+    delay - Seconds each installer takes
+    """
+
+    def __init__(self, responses=None, delay=0):
+        self.responses = responses or {}
+        self.delay = delay
+        self.invoked = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        with self._lock:
+            self.invoked.append((FunctionName, Payload))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            if FunctionName in self.responses:
+                time.sleep(self.delay)
+                response = self.responses[FunctionName]
+                if isinstance(response, Exception):
+                    raise response
+                return {'Payload': io.BytesIO(json.dumps(response).encode())}
+            return {}
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def payloads(self, function_name):
+        """ Returns the decoded payloads the function was invoked with"""
+        return [json.loads(payload) for name, payload in self.invoked if name == function_name]
+
+
+class FakeContext():
+    """ Lambda context with the given seconds left before the time budget of the function"""
+
+    def __init__(self, seconds):
+        self.deadline = time.time() + seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000) + master_lambda_function.SSM_TIME_BUDGET
+
+
+class FakeSTS():
+
+    def assume_role(self, **kwargs):
+        return {'Credentials': {'AccessKeyId': 'a', 'SecretAccessKey': 'b', 'SessionToken': 'c'}}
+
+
+class MasterLambdaTestCase(unittest.TestCase):
+    """ Patches boto3.client with the fake clients and shortens the polling intervals"""
+
+    commands = {}
+
+    def setUp(self):
+        self.ssm = FakeSSM(self.commands)
+        self.client_lambda = FakeLambda()
+        clients = {'lambda': self.client_lambda, 'sts': FakeSTS()}
+        patches = [
+            mock.patch.object(master_lambda_function.boto3, 'client', side_effect=lambda name, **kwargs: clients.get(name, self.ssm)),
+            mock.patch.object(master_lambda_function, 'SSM_POLL_FIRST', 0.01),
+            mock.patch.object(master_lambda_function, 'SSM_POLL_MAX_INTERVAL', 0.02)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        master_lambda_function.completion_history.seconds.clear()
+        logging.disable(logging.INFO)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+
+class TestGetStatusCommandIds(MasterLambdaTestCase):
+
+    commands = {
+        command_id(1): (['i-1', 'i-2'], 1, 'Success'),
+        command_id(2): (['i-3'], 3, 'TimedOut'),
+        command_id(3): (['i-4'], 2, 'Failed')}
+
+    def command_data(self):
+        return {
+            'Site24x7': {'us-east-1': [{'i-1': command_id(1), 'i-2': command_id(1)}, {'i-3': command_id(2)}]},
+            'DesktopCentral': {'eu-west-1': [{'i-4': command_id(3), 'i-5': 'error'}]}}
+
+    def test_one_call_per_command(self):
+        statuses = {}
+        payload_copy = {'CommandData': self.command_data()}
+        self.assertTrue(master_lambda_function.get_status_command_ids(self.command_data(), ('a', 'b', 'c'), {}, payload_copy, self.client_lambda, FakeContext(60), statuses))
+        self.assertEqual(statuses, {'Site24x7': {'us-east-1': {'i-1': 1, 'i-2': 1, 'i-3': 2}}, 'DesktopCentral': {'eu-west-1': {'i-4': 0, 'i-5': 0}}})
+        # One call per command ID (not per instance) until it finishes, then it is dropped
+        self.assertEqual(self.ssm.calls.count(command_id(1)), 1)
+        self.assertEqual(self.ssm.calls.count(command_id(2)), 3)
+        self.assertEqual(self.ssm.calls.count(command_id(3)), 2)
+        self.assertNotIn('CommandData', payload_copy)
+
+    def test_out_of_time_sends_trimmed_command_data(self):
+        self.ssm.commands = dict(self.commands)
+        self.ssm.commands[command_id(2)] = (['i-3'], None, 'Success')
+        statuses = {}
+        payload_copy = {'CommandData': self.command_data()}
+        self.assertFalse(master_lambda_function.get_status_command_ids(self.command_data(), ('a', 'b', 'c'), {}, payload_copy, self.client_lambda, FakeContext(0.5), statuses))
+        sent = self.client_lambda.payloads('master_lambda_function_2')
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]['CommandData'], {'Site24x7': {'us-east-1': [{}, {'i-3': command_id(2)}]}, 'DesktopCentral': {'eu-west-1': [{'i-5': 'error'}]}})
+
+    def test_paginated_invocations(self):
+        ssm = FakeSSM({command_id(1): (['i-1', 'i-2', 'i-3'], 1, 'Success')}, page_size=2)
+        self.assertEqual(sorted(master_lambda_function.list_ssm_command_invocations(command_id(1), ssm)), ['i-1', 'i-2', 'i-3'])
+        self.assertEqual(len(ssm.calls), 2)
+
+
+class TestInstallers(MasterLambdaTestCase):
+
+    commands = {command_id(1): (['i-1'], 1, 'Success'), command_id(2): (['i-2'], 2, 'Failed')}
+
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch.dict(os.environ)
+        patch.start()
+        self.addCleanup(patch.stop)
+        os.environ.pop('CHECKPOINT_STORE', None)
+        os.environ.pop('COMMAND_EVENTS', None)
+
+    def test_installers_run_concurrently(self):
+        self.client_lambda.responses = {
+            'x_account_site247_installer': {'us-east-1': [{'i-1': command_id(1)}]},
+            'x_account_dc_installer': {'eu-west-1': [{'i-2': command_id(2)}]},
+            'x_account_dsm_installer': {}}
+        self.client_lambda.delay = 0.2
+        started = time.time()
+        retval = master_lambda_function.invoke_agent_installers(self.client_lambda, {'Site24x7': {}, 'DesktopCentral': {}, 'TrendMicro': {}}, ['Site24x7', 'DesktopCentral', 'TrendMicro'])
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(self.client_lambda.max_running, 3)
+        self.assertEqual(retval, {'Site24x7': {'us-east-1': [{'i-1': command_id(1)}]}, 'DesktopCentral': {'eu-west-1': [{'i-2': command_id(2)}]}, 'TrendMicro': {}})
+
+    def test_failing_installer_is_skipped(self):
+        self.client_lambda.responses = {
+            'x_account_site247_installer': {'us-east-1': [{'i-1': command_id(1)}]},
+            'x_account_dc_installer': RuntimeError('installer failed')}
+        with self.assertLogs(master_lambda_function.logger, 'ERROR') as logs:
+            retval = master_lambda_function.invoke_agent_installers(self.client_lambda, {'Site24x7': {}, 'DesktopCentral': {}}, ['Site24x7', 'DesktopCentral'])
+        self.assertEqual(retval, {'Site24x7': {'us-east-1': [{'i-1': command_id(1)}]}})
+        self.assertIn('installer failed', logs.output[0])
+
+    def test_handler_installs_all_agents(self):
+        self.client_lambda.responses = {
+            'x_account_site247_installer': {'us-east-1': [{'i-1': command_id(1)}]},
+            'x_account_dc_installer': {'eu-west-1': [{'i-2': command_id(2)}]}}
+        event = {'MasterLambda': {'Role_ARN': 'role', 'External_Id': 'id'}, 'Site24x7': {}, 'DesktopCentral': {}}
+        master_lambda_function.lambda_handler(event, FakeContext(60))
+        self.assertEqual(self.client_lambda.payloads('agent_data_parser'), [{'Site24x7': {'us-east-1': {'i-1': 1}}, 'DesktopCentral': {'eu-west-1': {'i-2': 0}}}])
+
+    def test_resume_single_agent_layout(self):
+        # Continuation payload of the versions that installed one agent at a time
+        event = {
+            'MasterLambda': {'Role_ARN': 'role', 'External_Id': 'id'},
+            'CommandData': {'AgentName': 'DesktopCentral', 'eu-west-1': [{'i-2': command_id(2)}]},
+            'AgentStatusData': {'Site24x7': {'us-east-1': {'i-1': 1}}, 'DesktopCentral': {'eu-west-1': {}}}}
+        master_lambda_function.lambda_handler(event, FakeContext(60))
+        self.assertEqual(self.ssm.calls, [command_id(2), command_id(2)])
+        self.assertEqual(self.client_lambda.payloads('agent_data_parser'), [{'Site24x7': {'us-east-1': {'i-1': 1}}, 'DesktopCentral': {'eu-west-1': {'i-2': 0}}}])
+
+
+class TestCheckpointRun(MasterLambdaTestCase):
+
+    commands = {command_id(1): (['i-1'], 1, 'Success'), command_id(2): (['i-2'], None, 'Success')}
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patch = mock.patch.dict(os.environ, {'CHECKPOINT_STORE': 'sqlite:///' + os.path.join(directory, 'runs.db')})
+        patch.start()
+        self.addCleanup(patch.stop)
+        os.environ.pop('COMMAND_EVENTS', None)
+        self.client_lambda.responses = {
+            'x_account_site247_installer': {'us-east-1': [{'i-1': command_id(1)}]},
+            'x_account_dc_installer': {'eu-west-1': [{'i-2': command_id(2)}]}}
+
+    def test_resume_from_run_id(self):
+        event = {'MasterLambda': {'Role_ARN': 'role', 'External_Id': 'id'}, 'Site24x7': {}, 'DesktopCentral': {}}
+        self.assertTrue(master_lambda_function.lambda_handler(event, FakeContext(0.3)))
+        # The next instance only gets the run ID
+        sent = self.client_lambda.payloads('master_lambda_function_2')
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(list(sent[0]), ['RunId'])
+        store = checkpoint_store.get_checkpoint_store(os.environ['CHECKPOINT_STORE'])
+        self.assertEqual(store.pending(sent[0]['RunId']), {'DesktopCentral': {'eu-west-1': [{'i-2': command_id(2)}]}})
+        self.assertEqual(self.client_lambda.payloads('agent_data_parser'), [])
+
+        # The command finishes while the next instance runs
+        self.ssm.commands = {command_id(2): (['i-2'], 0, 'TimedOut')}
+        self.ssm.calls = []
+        self.client_lambda.invoked = []
+        master_lambda_function.lambda_handler(sent[0], FakeContext(60))
+        self.assertEqual(self.ssm.calls, [command_id(2)])
+        self.assertEqual([name for name, payload in self.client_lambda.invoked], ['agent_data_parser'])
+        self.assertEqual(self.client_lambda.payloads('agent_data_parser'), [{'Site24x7': {'us-east-1': {'i-1': 1}}, 'DesktopCentral': {'eu-west-1': {'i-2': 2}}}])
+
+
+class TestWaitLimit(MasterLambdaTestCase):
+    """ SSM_MAX_WAIT applies across the instances of the function, not to each one"""
+
+    commands = {command_id(1): (['i-1'], 1, 'Success'), command_id(2): (['i-2'], None, 'Success')}
+
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch.object(master_lambda_function, 'SSM_MAX_WAIT', 0.5)
+        patch.start()
+        self.addCleanup(patch.stop)
+        patch = mock.patch.dict(os.environ)
+        patch.start()
+        self.addCleanup(patch.stop)
+        os.environ.pop('COMMAND_EVENTS', None)
+        self.client_lambda.responses = {
+            'x_account_site247_installer': {'us-east-1': [{'i-1': command_id(1)}]},
+            'x_account_dc_installer': {'eu-west-1': [{'i-2': command_id(2)}]}}
+
+    def run_hops(self, hops=20):
+        """ Runs the handler with 0.15 s per instance until it stops invoking itself
+
+        Return:
+        A tuple of the number of instances and the payloads sent to agent_data_parser
+        """
+        event = {'MasterLambda': {'Role_ARN': 'role', 'External_Id': 'id'}, 'Site24x7': {}, 'DesktopCentral': {}}
+        for hop in range(1, hops + 1):
+            self.client_lambda.invoked = []
+            master_lambda_function.lambda_handler(event, FakeContext(0.15))
+            sent = self.client_lambda.payloads('master_lambda_function_2')
+            if not sent:
+                return (hop, self.client_lambda.payloads('agent_data_parser'))
+            event = sent[0]
+        self.fail('Still polling after {0} instances'.format(hops))
+
+    def test_payload_continuation(self):
+        os.environ.pop('CHECKPOINT_STORE', None)
+        hops, parsed = self.run_hops()
+        self.assertGreater(hops, 1)
+        self.assertEqual(parsed, [{'Site24x7': {'us-east-1': {'i-1': 1}}, 'DesktopCentral': {'eu-west-1': {}}}])
+
+    def test_checkpoint_continuation(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.environ['CHECKPOINT_STORE'] = 'sqlite:///' + os.path.join(directory, 'runs.db')
+        hops, parsed = self.run_hops()
+        self.assertGreater(hops, 1)
+        self.assertEqual(parsed, [{'Site24x7': {'us-east-1': {'i-1': 1}}, 'DesktopCentral': {'eu-west-1': {}}}])
+
+    def test_requested_time(self):
+        # Commands sent long ago are given up on at their first poll
+        self.ssm.requested = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
+        statuses = {}
+        command_data = {'DesktopCentral': {'eu-west-1': [{'i-2': command_id(2)}]}}
+        self.assertTrue(master_lambda_function.get_status_command_ids(command_data, ('a', 'b', 'c'), {}, {'CommandData': {}}, self.client_lambda, FakeContext(60), statuses))
+        self.assertEqual(self.ssm.calls, [command_id(2)])
+        self.assertEqual(statuses, {'DesktopCentral': {'eu-west-1': {}}})
+
+
+if __name__ == '__main__':
+    unittest.main()